@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmarks dvot's find and list operations against the local fake Datera API
+at several tenant sizes.
+
+    ./benchmarks/bench_find.py --scales 100,1000,10000 --latency 2
+
+For every scale a fresh fake API is started with that many AppInstances and
+each operation reports wall time, number of API requests, peak extra threads,
+peak traced memory and the traced memory still held by its result.  Lookups
+always target the last AppInstance so they measure the worst case.
+legacy_find_snaps is the entity based find_snaps kept as a memory baseline.
+"""
+from __future__ import unicode_literals, print_function, division
+
+import argparse
+import sys
+
+from common import FakeApi, measure, report, scales
+
+HEADERS = ['ais', 'op', 'wall_s', 'requests', 'peak_threads', 'peak_mem_kb',
+           'retained_kb']
+
+
+def legacy_find_snaps(api):
+    """ find_snaps as it was before records, holding full SDK entities """
+    from dvot.utils import Parallel
+    app_snaps, vol_snaps = [], []
+
+    def _snap_helper(ai):
+        app_snaps.extend(ai.snapshots.list())
+        for si in ai.storage_instances.list():
+            for vol in si.volumes.list():
+                vol_snaps.extend(vol.snapshots.list())
+    ais = api.app_instances.list()
+    p = Parallel([_snap_helper] * len(ais), args_list=[(ai,) for ai in ais],
+                 max_workers=max(len(ais), 20))
+    p.run_threads()
+    return app_snaps, vol_snaps
+
+
+def get_ops(api, targets):
+    from dvot import main as dvot
+
+    def _find_vol():
+        dvot.find_vol(api, None, targets['vol_uuid'])
+
+    def _find_snap():
+        dvot.find_snap(api, targets['vol_snap_ts'])
+
+    def _find_snaps():
+        return dvot.find_snaps(api, None, None)
+
+    def _legacy_find_snaps():
+        return legacy_find_snaps(api)
+
+    snaps = []
+
+    def _list_snaps():
+        snaps[:] = dvot.find_snaps(api, None, None)
+
+    def _print_pretty_snaps():
+        dvot.print_pretty_snaps(api, snaps[0], snaps[1])
+
+    # (name, setup, func), setup runs outside of the measurement
+    return [('find_vol', None, _find_vol),
+            ('find_snap', None, _find_snap),
+            ('find_snaps', None, _find_snaps),
+            ('legacy_find_snaps', None, _legacy_find_snaps),
+            ('print_pretty_snaps', _list_snaps, _print_pretty_snaps)]
+
+
+def main(args):
+    rows = []
+    wanted = args.ops.split(',') if args.ops else None
+    for scale in scales(args.scales):
+        with FakeApi(ais=scale, vols=args.vols, snaps=args.snaps,
+                     latency=args.latency, page_size=args.page_size) as fake:
+            api = fake.api()
+            if args.api_cache_ttl:
+                from dvot.apicache import enable_cache
+                enable_cache(api, args.api_cache_ttl)
+            for name, setup, func in get_ops(api, fake.targets()):
+                if wanted and name not in wanted:
+                    continue
+                if setup:
+                    setup()
+                row = measure(func, fake, memory=not args.no_memory)
+                row.update(ais=scale, op=name)
+                rows.append(row)
+                print("{} {}: {}s".format(scale, name, row['wall_s']),
+                      file=sys.stderr)
+    report(rows, HEADERS, args.json)
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scales', default='100,1000,10000',
+                        help='Comma separated AppInstance counts')
+    parser.add_argument('--ops', help='Comma separated subset of operations')
+    parser.add_argument('--vols', type=int, default=1)
+    parser.add_argument('--snaps', type=int, default=2)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Milliseconds of API latency per request')
+    parser.add_argument('--page-size', type=int, default=100)
+    parser.add_argument('--api-cache-ttl', type=float, default=0,
+                        help='Enable dvot\'s API response cache')
+    parser.add_argument('--no-memory', action='store_true',
+                        help='Skip the traced memory measurement pass')
+    parser.add_argument('--json', help='Also write results to this file')
+    sys.exit(main(parser.parse_args()))
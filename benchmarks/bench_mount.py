@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmarks dvot's mount path (mount_volumes and clean_mounts) against the
+fake Datera API and the simulated host data plane.
+
+    ./benchmarks/bench_mount.py --ais 1,4 --vols 1,2 --portals 1,2
+
+Every combination of AppInstances x Volumes x portals gets a fresh fake API
+and a fresh sandboxed host.  Each row reports wall time, API requests, host
+commands run and peak extra threads.  Use --loop (as root) to back every LUN
+with a real loop device so mkfs and mount run for real.
+"""
+from __future__ import unicode_literals, print_function, division
+
+import argparse
+import itertools
+import sys
+
+from common import FakeApi, measure, report, scales
+from fake_host import FakeHost
+
+HEADERS = ['ais', 'vols', 'portals', 'op', 'wall_s', 'requests', 'commands',
+           'peak_threads']
+
+
+def bench(args, nais, nvols, nportals):
+    from dvot.host import set_host
+    from dvot.mount import mount_volumes, clean_mounts, clone_and_mount
+    from dvot.clones import CloneRegistry
+    from dvot.main import find_snaps, new_app_from_snap, set_rollback
+    from dvot.rollback import rollback_remount
+    rows = []
+    with FakeApi(ais=nais, vols=nvols, portals=nportals, snaps=0,
+                 app_snaps=max(args.clone_snaps, int(args.rollback)),
+                 latency=args.latency) as fake, \
+            FakeHost(luns=nvols, arrival_delay=args.arrival_delay / 1000.0,
+                     jitter=args.jitter / 1000.0,
+                     cmd_delay=args.cmd_delay / 1000.0,
+                     mkfs_delay=args.mkfs_delay / 1000.0,
+                     loop=args.loop) as host:
+        set_host(host)
+        api = fake.api()
+        ais = api.app_instances.list()
+        multipath = not args.no_multipath
+
+        def _mount():
+            mount_volumes(api, ais, multipath, args.fstype, '', host.mnt,
+                          args.workers, False)
+
+        def _clean():
+            clean_mounts(api, ais, host.mnt, args.workers)
+
+        snaps = []
+
+        def _serial_clone_mount():
+            registry = CloneRegistry(api)
+            clones = [new_app_from_snap(api, snap, registry)
+                      for snap in snaps]
+            mount_volumes(api, clones, multipath, args.fstype, '', host.mnt,
+                          1, False)
+
+        def _clone_and_mount():
+            registry = CloneRegistry(api)
+
+            def _clone(api, snap):
+                return new_app_from_snap(api, snap, registry)
+            clone_and_mount(api, snaps, _clone, multipath,
+                            args.fstype, '', host.mnt, args.clone_workers,
+                            args.workers, False)
+
+        def _legacy_rollback():
+            clean_mounts(api, ais, host.mnt, 1)
+            for ai in ais:
+                set_rollback(api, ai.snapshots.list()[0], None)
+            mount_volumes(api, ais, multipath, args.fstype, '', host.mnt,
+                          1, False)
+
+        def _rollback_remount():
+            rollback_remount(api, [ai.snapshots.list()[0].path for ai in ais],
+                             multipath, max(args.workers, len(ais)))
+
+        ops = [('mount_volumes', _mount)]
+        if args.rollback:
+            ops.extend([('legacy_rollback_remount', _legacy_rollback),
+                        ('rollback_remount', _rollback_remount)])
+        ops.append(('clean_mounts', _clean))
+        if args.clone_snaps:
+            snaps.extend(find_snaps(api, None, ais[0]['id'])[0])
+            ops.extend([('serial_clone_mount', _serial_clone_mount),
+                        ('clone_and_mount', _clone_and_mount)])
+        for name, func in ops:
+            before = sum(host.counts.values())
+            # Mounting changes host state, so it can't be run a second time
+            # for the memory measurement
+            row = measure(func, fake, memory=False)
+            row.update(ais=nais, vols=nvols, portals=nportals, op=name,
+                       commands=sum(host.counts.values()) - before)
+            rows.append(row)
+            print("{}x{}x{} {}: {}s".format(
+                nais, nvols, nportals, name, row['wall_s']), file=sys.stderr)
+    set_host(None)
+    return rows
+
+
+def main(args):
+    rows = []
+    for nais, nvols, nportals in itertools.product(
+            scales(args.ais), scales(args.vols), scales(args.portals)):
+        rows.extend(bench(args, nais, nvols, nportals))
+    report(rows, HEADERS, args.json)
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--ais', default='1,4',
+                        help='Comma separated AppInstance counts')
+    parser.add_argument('--vols', default='1,2',
+                        help='Comma separated Volume per AppInstance counts')
+    parser.add_argument('--portals', default='1,2',
+                        help='Comma separated portal counts')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Workers passed to mount_volumes/clean_mounts')
+    parser.add_argument('--clone-snaps', type=int, default=0,
+                        help='Snapshots per AppInstance to clone and mount')
+    parser.add_argument('--rollback', action='store_true',
+                        help='Also time rolling back mounted AppInstances')
+    parser.add_argument('--clone-workers', type=int, default=10,
+                        help='Clone workers passed to clone_and_mount')
+    parser.add_argument('--fstype', default='xfs')
+    parser.add_argument('--no-multipath', action='store_true')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Milliseconds of API latency per request')
+    parser.add_argument('--arrival-delay', type=float, default=50.0,
+                        help='Milliseconds between login and device arrival')
+    parser.add_argument('--jitter', type=float, default=0.0,
+                        help='Max random milliseconds added to arrival')
+    parser.add_argument('--cmd-delay', type=float, default=0.0,
+                        help='Milliseconds of overhead per host command')
+    parser.add_argument('--mkfs-delay', type=float, default=0.0,
+                        help='Milliseconds taken by each mkfs')
+    parser.add_argument('--loop', action='store_true',
+                        help='Back LUNs with real loop devices (needs root)')
+    parser.add_argument('--json', help='Also write results to this file')
+    sys.exit(main(parser.parse_args()))
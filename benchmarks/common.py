@@ -0,0 +1,187 @@
+"""
+Shared helpers for the dvot benchmarks
+"""
+from __future__ import unicode_literals, print_function, division
+
+import gc
+import io
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+try:
+    import resource
+except ImportError:
+    resource = None
+
+import requests
+from tabulate import tabulate
+
+DIR = os.path.dirname(os.path.abspath(__file__))
+SRC = os.path.join(os.path.dirname(DIR), 'src')
+if SRC not in sys.path:
+    sys.path.insert(0, SRC)
+FAKE_API = os.path.join(DIR, 'fake_api.py')
+HOST = '127.0.0.1'
+PORT = 7717
+
+
+class FakeApi(object):
+
+    """
+    Runs benchmarks/fake_api.py in a subprocess so the server's own memory
+    and threads don't show up in the measurements of the code under test
+    """
+
+    def __init__(self, **opts):
+        self.opts = opts
+        self.proc = None
+        self.url = 'http://{}:{}'.format(HOST, PORT)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def start(self, timeout=300):
+        cmd = [sys.executable, FAKE_API, '--host', HOST, '--port', str(PORT)]
+        for k, v in sorted(self.opts.items()):
+            cmd.extend(('--' + k.replace('_', '-'), str(v)))
+        self.proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+        # The server prints a line once it is populated and listening
+        self.proc.stdout.readline()
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            try:
+                socket.create_connection((HOST, PORT), 1).close()
+                return
+            except socket.error:
+                if self.proc.poll() is not None:
+                    raise EnvironmentError("Fake API exited early")
+                time.sleep(0.1)
+        raise EnvironmentError("Fake API did not start in time")
+
+    def stop(self):
+        if self.proc:
+            self.proc.terminate()
+            self.proc.wait()
+            self.proc = None
+
+    def get(self, path):
+        return requests.get(self.url + path).json()
+
+    def reset(self):
+        requests.put(self.url + '/_fake/reset')
+
+    def stats(self):
+        return self.get('/_fake/stats')
+
+    def targets(self):
+        return self.get('/_fake/targets')
+
+    def api(self, tenant='/root'):
+        from dfs_sdk import get_api
+        schema = os.path.join(tempfile.gettempdir(), '.dvot-bench-schema')
+        return get_api(HOST, 'admin', 'password', 'v2.2', tenant=tenant,
+                       secure=False, disable_log=True, schema_loc=schema,
+                       refresh=True)
+
+
+class ThreadSampler(object):
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.peak = 0
+        self.running = False
+        self.thread = None
+
+    def _sample(self):
+        while self.running:
+            self.peak = max(self.peak, threading.active_count())
+            time.sleep(self.interval)
+
+    def __enter__(self):
+        self.peak = threading.active_count()
+        self.running = True
+        self.thread = threading.Thread(target=self._sample)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.running = False
+        self.thread.join()
+
+
+class quiet(object):
+
+    """ Swallow stdout of the code under test """
+
+    def __enter__(self):
+        self.stdout = sys.stdout
+        sys.stdout = io.open(os.devnull, 'w')
+
+    def __exit__(self, *args):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+
+
+def measure(func, fake=None, memory=True):
+    """
+    Runs func and returns a dict with its wall time, API request count, peak
+    thread count and (when tracemalloc is available) peak traced memory and
+    the traced memory still held by what func returned.
+
+    Memory is measured in a second run since tracing allocations distorts
+    the timing of the first.
+    """
+    result = {}
+    if fake:
+        fake.reset()
+    base_threads = threading.active_count()
+    with ThreadSampler() as sampler, quiet():
+        start = time.time()
+        func()
+        result['wall_s'] = round(time.time() - start, 4)
+    result['requests'] = fake.stats().get('total', 0) if fake else None
+    result['peak_threads'] = sampler.peak - base_threads
+    result['peak_mem_kb'] = None
+    result['retained_kb'] = None
+    if memory and tracemalloc:
+        gc.collect()
+        tracemalloc.start()
+        with quiet():
+            kept = func()
+        gc.collect()
+        current, peak = tracemalloc.get_traced_memory()
+        result['peak_mem_kb'] = peak // 1024
+        result['retained_kb'] = current // 1024
+        tracemalloc.stop()
+        del kept
+    if resource:
+        result['maxrss_kb'] = resource.getrusage(
+            resource.RUSAGE_SELF).ru_maxrss
+    return result
+
+
+def report(rows, headers, json_file=None):
+    print(tabulate([[row.get(h) for h in headers] for row in rows],
+                   headers=headers))
+    if json_file:
+        with io.open(json_file, 'w') as f:
+            f.write(json.dumps(rows, indent=4, sort_keys=True))
+
+
+def scales(txt):
+    return [int(s) for s in txt.split(',') if s]
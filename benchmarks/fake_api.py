@@ -0,0 +1,557 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Local stand-in for the subset of the Datera v2.2 REST API used by dvot.
+
+Serves plain HTTP on the SDK's non-TLS port (7717) so an API object created
+with ``secure=False`` and ``hostname=127.0.0.1`` talks to it unmodified.
+
+    ./benchmarks/fake_api.py --ais 1000 --vols 2 --snaps 3 --latency 5
+
+Besides the Datera endpoints, a few helper endpoints are served that are
+not counted as API requests:
+
+    GET /_fake/stats    request counters
+    PUT /_fake/reset    reset request counters
+    GET /_fake/targets  sample ids/names useful for lookups
+"""
+from __future__ import unicode_literals, print_function, division
+
+import argparse
+import collections
+import copy
+import json
+import random
+import sys
+import threading
+import time
+import uuid
+
+from six.moves import BaseHTTPServer, socketserver
+from six.moves.urllib.parse import urlparse, parse_qs
+
+API_VERSION = 'v2.2'
+REST_PORT = 7717
+SW_VERSION = '3.3.5.0'
+
+_ENTITIES = [
+    '/app_instances/:app_instance_id',
+    '/app_instances/:app_instance_id/snapshots/:timestamp',
+    '/app_instances/:app_instance_id/storage_instances/:storage_instance_id',
+    '/app_instances/:app_instance_id/storage_instances/:storage_instance_id'
+    '/volumes/:volume_id',
+    '/app_instances/:app_instance_id/storage_instances/:storage_instance_id'
+    '/volumes/:volume_id/snapshots/:timestamp',
+    '/initiators/:initiator_id',
+    '/tenants/:tenant_id',
+]
+_ENDPOINTS = [
+    '/app_instances',
+    '/app_instances/:app_instance_id/snapshots',
+    '/app_instances/:app_instance_id/storage_instances',
+    '/app_instances/:app_instance_id/storage_instances/:storage_instance_id'
+    '/acl_policy',
+    '/app_instances/:app_instance_id/storage_instances/:storage_instance_id'
+    '/acl_policy/initiators',
+    '/app_instances/:app_instance_id/storage_instances/:storage_instance_id'
+    '/volumes',
+    '/app_instances/:app_instance_id/storage_instances/:storage_instance_id'
+    '/volumes/:volume_id/snapshots',
+    '/initiators',
+    '/system',
+    '/system/network',
+    '/system/network/access_vip',
+    '/tenants',
+]
+
+
+def api_schema():
+    """ Minimal /api document accepted by the SDK's schema reader """
+    schema = {}
+    for path in _ENDPOINTS + _ENTITIES:
+        schema[path] = {'read': {}}
+    for kind in ('io', 'hw'):
+        schema['/metrics/{}/:metric'.format(kind)] = {
+            'read': {'urlParamSchema': {'metric': {'enum': []}}}}
+    return schema
+
+
+class ApiError(Exception):
+
+    def __init__(self, status, message):
+        super(ApiError, self).__init__(message)
+        self.status = status
+        self.message = message
+
+
+class Store(object):
+
+    """
+    Flat path -> object storage for a single tenant.  Collections keep their
+    members ordered so listings are stable across pages.
+    """
+
+    def __init__(self, tenant):
+        self.tenant = tenant
+        self.objs = {}
+        self.kids = collections.defaultdict(collections.OrderedDict)
+
+    def add(self, path, data):
+        data['path'] = path
+        data['tenant'] = self.tenant
+        self.objs[path] = data
+        self.kids[path.rsplit('/', 1)[0]][path] = True
+        return data
+
+    def remove(self, path):
+        for coll in ('storage_instances', 'volumes', 'snapshots'):
+            for child in list(self.kids.pop(path + '/' + coll, ())):
+                self.remove(child)
+        self.objs.pop(path, None)
+        self.kids[path.rsplit('/', 1)[0]].pop(path, None)
+
+    def descendants(self, path):
+        for coll in ('storage_instances', 'volumes', 'snapshots'):
+            for child in self.children(path + '/' + coll):
+                yield child
+                for sub in self.descendants(child):
+                    yield sub
+
+    def children(self, path):
+        return list(self.kids.get(path, ()))
+
+
+class FakeCluster(object):
+
+    def __init__(self, ais=100, sis=1, vols=1, snaps=2, app_snaps=1,
+                 tenants=0, latency=0.0, jitter=0.0, page_size=100,
+                 op_delay=0.0, portals=2, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.page_size = page_size
+        self.op_delay = op_delay
+        self.lock = threading.RLock()
+        self.rng = random.Random(seed)
+        self.counts = collections.Counter()
+        self.portals = ['172.28.{}.{}'.format(100 + i, 10 + i)
+                        for i in range(portals)]
+        self.ts = 1500000000.0
+        self.stores = {}
+        self.initiators = {}
+        for tenant in ['/root'] + ['/root/tenant-{}'.format(i)
+                                   for i in range(1, tenants + 1)]:
+            store = Store(tenant)
+            self.stores[tenant] = store
+            for i in range(ais):
+                self._populate_ai(
+                    store, 'bench-ai-{:06d}'.format(i), sis, vols, snaps,
+                    app_snaps)
+
+    # Object construction
+
+    def _uuid(self):
+        return str(uuid.UUID(int=self.rng.getrandbits(128)))
+
+    def _next_ts(self):
+        self.ts += 1.0 + self.rng.random()
+        return '{:.9f}'.format(self.ts)
+
+    def _iqn(self):
+        return 'iqn.2013-05.com.daterainc:tc:01:sn:{}'.format(
+            '{:016x}'.format(self.rng.getrandbits(64)))
+
+    def _ready_at(self):
+        return time.time() + self.op_delay
+
+    def _populate_ai(self, store, name, sis, vols, snaps, app_snaps):
+        aid = self._uuid()
+        ai = self._new_ai(store, aid, name)
+        for s in range(sis):
+            si = self._new_si(store, ai['path'], 'storage-{}'.format(s + 1))
+            for v in range(vols):
+                vol = self._new_vol(store, si['path'],
+                                    'volume-{}'.format(v + 1), 10)
+                for _ in range(snaps):
+                    self._new_snap(store, vol['path'], self._next_ts(),
+                                   ready=True)
+        for _ in range(app_snaps):
+            self._new_snap(store, ai['path'], self._next_ts(), ready=True)
+        return ai
+
+    def _new_ai(self, store, aid, name, **extra):
+        data = {'id': aid, 'name': name, 'admin_state': 'online',
+                'descr': '', 'repair_priority': 'default',
+                'clone_snapshot_src': None, 'clone_volume_src': None}
+        data.update(extra)
+        return store.add('/app_instances/{}'.format(aid), data)
+
+    def _new_si(self, store, ai_path, name):
+        return store.add(
+            '{}/storage_instances/{}'.format(ai_path, name),
+            {'name': name, 'uuid': self._uuid(), 'admin_state': 'online',
+             '_ready_at': self._ready_at(),
+             'access': {'iqn': self._iqn(), 'ips': list(self.portals)},
+             'access_control_mode': 'deny_all',
+             'acl_policy': {'initiators': [], 'initiator_groups': []},
+             'active_initiators': []})
+
+    def _new_vol(self, store, si_path, name, size):
+        return store.add(
+            '{}/volumes/{}'.format(si_path, name),
+            {'name': name, 'uuid': self._uuid(), 'size': size,
+             'placement_mode': 'hybrid', 'replica_count': 3,
+             'capacity_in_use': 0, '_ready_at': self._ready_at()})
+
+    def _new_snap(self, store, parent_path, ts, ready=False):
+        return store.add(
+            '{}/snapshots/{}'.format(parent_path, ts),
+            {'utc_ts': ts, 'timestamp': ts, 'uuid': self._uuid(),
+             '_ready_at': 0 if ready else self._ready_at()})
+
+    # Rendering
+
+    def _state(self, data):
+        if data.get('_ready_at', 0) > time.time():
+            return 'unavailable'
+        return 'available'
+
+    def render(self, store, path):
+        data = store.objs[path]
+        out = dict((k, copy.deepcopy(v)) for k, v in data.items()
+                   if not k.startswith('_'))
+        if '_ready_at' in data:
+            out['op_state'] = self._state(data)
+        kind = path.rsplit('/', 2)[-2]
+        if kind == 'app_instances':
+            out['storage_instances'] = [
+                self.render(store, p) for p in store.children(
+                    path + '/storage_instances')]
+            out['snapshots'] = [
+                {'path': p} for p in store.children(path + '/snapshots')]
+        elif kind == 'storage_instances':
+            out['volumes'] = [
+                self.render(store, p) for p in store.children(
+                    path + '/volumes')]
+        elif kind == 'volumes':
+            out['snapshots'] = [
+                self.render(store, p) for p in store.children(
+                    path + '/snapshots')]
+        return out
+
+    # Request handling
+
+    def handle(self, method, path, params, body, tenant):
+        self.counts['total'] += 1
+        self.counts[method] += 1
+        if self.latency or self.jitter:
+            time.sleep(self.latency + self.rng.random() * self.jitter)
+        path = '/' + path.strip('/')
+        if path == '/login':
+            return {'key': str(uuid.uuid4())}
+        if path == '/api':
+            return api_schema()
+        if path == '/system':
+            return {'data': {'name': 'fake-cluster', 'path': '/system',
+                             'sw_version': SW_VERSION}}
+        if path == '/system/network/access_vip':
+            return {'data': {'network_paths': [
+                {'name': 'Access-{}'.format(i), 'ip': ip}
+                for i, ip in enumerate(self.portals)]}}
+        if path.startswith('/initiators'):
+            return self._initiators(method, path, body, tenant)
+        if path.startswith('/tenants'):
+            return self._tenants(method, path)
+        with self.lock:
+            store = self.stores.get(tenant)
+            if store is None:
+                raise ApiError(404, "No tenant {}".format(tenant))
+            return self._objects(store, method, path, params, body)
+
+    def _page(self, items, params):
+        offset = int(params.get('offset', 0))
+        limit = int(params.get('limit', self.page_size))
+        limit = min(limit, self.page_size) if self.page_size else limit
+        page = items[offset:offset + limit] if limit else items[offset:]
+        return {'data': page,
+                'metadata': {'total_count': len(items),
+                             'request_count': len(page),
+                             'offset': offset,
+                             'limit': limit}}
+
+    def _initiators(self, method, path, body, tenant):
+        parts = path.strip('/').split('/')
+        if method == 'POST' and len(parts) == 1:
+            iid = body['id']
+            data = {'id': iid, 'name': body.get('name', iid),
+                    'path': '/initiators/{}'.format(iid), 'tenant': tenant}
+            self.initiators[iid] = data
+            return {'data': data}
+        if len(parts) == 2:
+            data = self.initiators.get(parts[1])
+            if not data:
+                raise ApiError(404, "No data at {}".format(path))
+            return {'data': data}
+        return {'data': list(self.initiators.values())}
+
+    def _tenants(self, method, path):
+        parts = path.strip('/').split('/')
+        tenants = [{'name': t.rsplit('/', 1)[-1],
+                    'path': '/tenants/{}'.format(t.rsplit('/', 1)[-1])}
+                   for t in sorted(self.stores) if t != '/root']
+        if len(parts) == 1:
+            return {'data': tenants}
+        for t in tenants:
+            if t['name'] == parts[1]:
+                return {'data': t}
+        raise ApiError(404, "No data at {}".format(path))
+
+    def _objects(self, store, method, path, params, body):
+        if path.endswith('/acl_policy/initiators') and method == 'PUT':
+            si = store.objs.get(path.rsplit('/acl_policy', 1)[0])
+            if si is None:
+                raise ApiError(404, "No data at {}".format(path))
+            inits = si['acl_policy']['initiators']
+            if body.get('op') == 'add':
+                if body['path'] in inits:
+                    raise ApiError(409, "Initiator already in acl_policy")
+                inits.append(body['path'])
+            elif body['path'] in inits:
+                inits.remove(body['path'])
+            return {'data': si['acl_policy']}
+        if path in store.objs:
+            return self._entity(store, method, path, body)
+        parent = path.rsplit('/', 1)[0]
+        if (path.rsplit('/', 1)[-1] in ('app_instances', 'storage_instances',
+                                         'volumes', 'snapshots') and
+                (parent == '' or parent in store.objs)):
+            return self._collection(store, method, path, params, body)
+        raise ApiError(404, "No data at {}".format(path))
+
+    def _collection(self, store, method, path, params, body):
+        if method == 'GET':
+            return self._page(
+                [self.render(store, p) for p in store.children(path)], params)
+        if method != 'POST':
+            raise ApiError(405, "Method not allowed")
+        if path == '/app_instances':
+            return {'data': self.render(store, self._create_ai(store, body))}
+        if path.endswith('/snapshots'):
+            snap = self._new_snap(store, path.rsplit('/', 1)[0],
+                                  self._next_ts())
+            return {'data': self.render(store, snap['path'])}
+        raise ApiError(405, "Method not allowed")
+
+    def _create_ai(self, store, body):
+        name = body.get('name')
+        for p in store.children('/app_instances'):
+            if store.objs[p]['name'] == name:
+                raise ApiError(409, "AppInstance {} exists".format(name))
+        aid = self._uuid()
+        src = (body.get('clone_snapshot_src') or {}).get('path')
+        ai = self._new_ai(store, aid, name, descr=body.get('descr', ''),
+                          clone_snapshot_src=body.get('clone_snapshot_src'))
+        if src:
+            if src not in store.objs:
+                raise ApiError(422, "No snapshot at {}".format(src))
+            if '/volumes/' in src:
+                vol_path = src.split('/snapshots/')[0]
+                vols = [(vol_path.split('/')[-3], vol_path)]
+            else:
+                ai_path = src.split('/snapshots/')[0]
+                vols = [(p.split('/')[-3], p)
+                        for si in store.children(
+                            ai_path + '/storage_instances')
+                        for p in store.children(si + '/volumes')]
+            sis = {}
+            for si_name, vol_path in vols:
+                if si_name not in sis:
+                    sis[si_name] = self._new_si(store, ai['path'], si_name)
+                self._new_vol(store, sis[si_name]['path'],
+                              vol_path.rsplit('/', 1)[-1],
+                              store.objs[vol_path]['size'])
+        for si_body in body.get('storage_instances', []):
+            si = self._new_si(store, ai['path'], si_body['name'])
+            for vol_body in si_body.get('volumes', []):
+                self._new_vol(store, si['path'], vol_body['name'],
+                              vol_body.get('size', 1))
+        return ai['path']
+
+    def _entity(self, store, method, path, body):
+        data = store.objs[path]
+        if method == 'GET':
+            return {'data': self.render(store, path)}
+        if method == 'DELETE':
+            if (path.count('/') == 2 and
+                    data.get('admin_state') != 'offline'):
+                raise ApiError(
+                    422, "AppInstance must be offline before deletion")
+            rendered = self.render(store, path)
+            store.remove(path)
+            return {'data': rendered}
+        if method != 'PUT':
+            raise ApiError(405, "Method not allowed")
+        body = dict(body or {})
+        body.pop('force', None)
+        restore = body.pop('restore_point', None)
+        if restore:
+            if data.get('admin_state', 'offline') != 'offline' and \
+                    path.count('/') == 2:
+                raise ApiError(422, "AppInstance must be offline to restore")
+            if '{}/snapshots/{}'.format(path, restore) not in store.objs:
+                raise ApiError(422, "No snapshot {}".format(restore))
+        if 'size' in body and body['size'] < data.get('size', 0):
+            raise ApiError(422, "Volumes can't be shrunk")
+        if restore or body.get('admin_state') == 'online':
+            for p in store.descendants(path):
+                if '/snapshots/' not in p:
+                    store.objs[p]['_ready_at'] = self._ready_at()
+        data.update(body)
+        return {'data': self.render(store, path)}
+
+    def targets(self):
+        store = self.stores['/root']
+        ais = store.children('/app_instances')
+        last = ais[-1]
+        si = store.children(last + '/storage_instances')[-1]
+        vol = store.children(si + '/volumes')[-1]
+        vol_snaps = store.children(vol + '/snapshots')
+        app_snaps = store.children(last + '/snapshots')
+        return {'ai_id': store.objs[last]['id'],
+                'ai_name': store.objs[last]['name'],
+                'si_iqn': store.objs[si]['access']['iqn'],
+                'vol_uuid': store.objs[vol]['uuid'],
+                'vol_name': store.objs[vol]['name'],
+                'vol_snap_ts': (store.objs[vol_snaps[-1]]['utc_ts']
+                                if vol_snaps else None),
+                'app_snap_ts': (store.objs[app_snaps[-1]]['utc_ts']
+                                if app_snaps else None)}
+
+
+class FakeApiHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status, data):
+        payload = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _dispatch(self, method):
+        cluster = self.server.cluster
+        url = urlparse(self.path)
+        params = dict((k, v[-1]) for k, v in parse_qs(url.query).items())
+        length = int(self.headers.get('Content-Length') or 0)
+        body = None
+        if length:
+            raw = self.rfile.read(length)
+            try:
+                body = json.loads(raw.decode('utf-8'))
+            except ValueError:
+                body = None
+        path = url.path
+        if path.startswith('/_fake/'):
+            return self._fake(method, path)
+        prefix = '/' + API_VERSION
+        if not path.startswith(prefix):
+            return self._send(404, {'message': "No data at {}".format(path)})
+        tenant = self.headers.get('tenant') or '/root'
+        try:
+            data = cluster.handle(method, path[len(prefix):], params, body,
+                                  tenant)
+        except ApiError as e:
+            return self._send(e.status, {'message': e.message})
+        self._send(200, data)
+
+    def _fake(self, method, path):
+        cluster = self.server.cluster
+        if path == '/_fake/stats':
+            return self._send(200, dict(cluster.counts))
+        if path == '/_fake/reset':
+            cluster.counts.clear()
+            return self._send(200, {})
+        if path == '/_fake/targets':
+            with cluster.lock:
+                return self._send(200, cluster.targets())
+        self._send(404, {'message': "No data at {}".format(path)})
+
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_PUT(self):
+        self._dispatch('PUT')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+    def do_DELETE(self):
+        self._dispatch('DELETE')
+
+
+class FakeApiServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+    def __init__(self, cluster, host='127.0.0.1', port=REST_PORT):
+        BaseHTTPServer.HTTPServer.__init__(self, (host, port), FakeApiHandler)
+        self.cluster = cluster
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=REST_PORT)
+    parser.add_argument('--ais', type=int, default=100,
+                        help='AppInstances per tenant')
+    parser.add_argument('--sis', type=int, default=1,
+                        help='StorageInstances per AppInstance')
+    parser.add_argument('--vols', type=int, default=1,
+                        help='Volumes per StorageInstance')
+    parser.add_argument('--snaps', type=int, default=2,
+                        help='Snapshots per Volume')
+    parser.add_argument('--app-snaps', type=int, default=1,
+                        help='AppInstance level snapshots per AppInstance')
+    parser.add_argument('--tenants', type=int, default=0,
+                        help='Number of subtenants populated like /root')
+    parser.add_argument('--portals', type=int, default=2,
+                        help='Access VIPs/portals per StorageInstance')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Milliseconds added to every request')
+    parser.add_argument('--jitter', type=float, default=0.0,
+                        help='Max random milliseconds added to every request')
+    parser.add_argument('--op-delay', type=float, default=0.0,
+                        help='Seconds new objects stay unavailable')
+    parser.add_argument('--page-size', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=0)
+    return parser
+
+
+def cluster_from_args(args):
+    return FakeCluster(ais=args.ais, sis=args.sis, vols=args.vols,
+                       snaps=args.snaps, app_snaps=args.app_snaps,
+                       tenants=args.tenants, latency=args.latency / 1000.0,
+                       jitter=args.jitter / 1000.0, page_size=args.page_size,
+                       op_delay=args.op_delay, portals=args.portals,
+                       seed=args.seed)
+
+
+def main(args):
+    server = FakeApiServer(cluster_from_args(args), args.host, args.port)
+    print("Fake Datera API listening on {}:{}".format(args.host, args.port))
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(get_parser().parse_args()))
@@ -0,0 +1,478 @@
+"""
+Sandboxed simulator of the host-side data plane used by dvot's mount path.
+
+FakeHost is a dvot.host.Host whose sysfs, devfs and procfs roots live in a
+temporary directory and whose commands (iscsiadm, multipath, mkfs, blkid,
+mount, ...) are emulated in-process:
+
+* ``iscsiadm --login`` creates one sd device per LUN for that portal after a
+  configurable arrival delay (right away when it is 0), together with its
+  /dev/disk/by-path link and sysfs entry, and a dm-* multipath map holding
+  every path to the LUN
+* ``--logout`` removes the paths, ``multipath -F`` flushes unused maps and
+  ``multipath -f <dev>`` a single unused map
+* filesystems and mounts are tracked per LUN so they survive logout/login
+
+With ``loop=True`` (requires root) every LUN is backed by a real loop device
+and mkfs/blkid/mount/umount run for real against it.
+"""
+from __future__ import unicode_literals, print_function, division
+
+import collections
+import io
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+
+from common import SRC  # noqa
+
+from dvot.host import Host
+from dvot.utils import CmdError, CmdResult, run
+
+INITIATOR = 'iqn.1993-08.org.debian:01:fakehost'
+HOSTNAME = 'fakehost'
+
+
+class FakeHost(Host):
+
+    def __init__(self, luns=1, arrival_delay=0.05, jitter=0.0, cmd_delay=0.0,
+                 mkfs_delay=0.0, loop=False, loop_size_mb=64, seed=0):
+        self.root = tempfile.mkdtemp(prefix='dvot-fake-host-')
+        self.sys_root = os.path.join(self.root, 'sys')
+        self.dev_root = os.path.join(self.root, 'dev')
+        self.proc_root = '/proc' if loop else os.path.join(self.root, 'proc')
+        self.luns = luns
+        self.arrival_delay = arrival_delay
+        self.jitter = jitter
+        self.cmd_delay = cmd_delay
+        self.mkfs_delay = mkfs_delay
+        self.loop = loop
+        self.loop_size_mb = loop_size_mb
+        self.rng = random.Random(seed)
+        self.lock = threading.RLock()
+        self.counts = collections.Counter()
+        self.sessions = set()
+        # (iqn, portal, lun) -> sdX
+        self.paths = {}
+        # (iqn, lun) -> dm-N
+        self.maps = {}
+        # device name (sdX/dm-N) -> (iqn, lun)
+        self.devices = {}
+        # (iqn, lun) -> fstype
+        self.fs = {}
+        # (iqn, lun) -> /dev/loopN
+        self.loops = {}
+        # mount folder -> (device path, (iqn, lun), fstype)
+        self.mounts = collections.OrderedDict()
+        self.timers = []
+        self.next_sd = 0
+        self.next_dm = 0
+        for d in (os.path.join(self.sys_root, 'block'),
+                  os.path.join(self.dev_root, 'disk', 'by-path'),
+                  os.path.join(self.dev_root, 'disk', 'by-id'),
+                  os.path.join(self.dev_root, 'mapper'),
+                  os.path.join(self.root, 'proc'),
+                  os.path.join(self.root, 'etc', 'iscsi'),
+                  os.path.join(self.root, 'mnt')):
+            os.makedirs(d)
+        with io.open(os.path.join(
+                self.root, 'etc', 'iscsi', 'initiatorname.iscsi'), 'w') as f:
+            f.write('InitiatorName={}\n'.format(INITIATOR))
+        with io.open(os.path.join(self.root, 'etc', 'fstab'), 'w') as f:
+            f.write('# /etc/fstab: static file system information.\n')
+        self._write_mounts()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        for timer in self.timers:
+            timer.cancel()
+        if self.loop:
+            for folder in list(self.mounts):
+                run(['umount', folder], sudo=True, fail_ok=True)
+            for loop in self.loops.values():
+                run(['losetup', '-d', loop], sudo=True, fail_ok=True)
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    @property
+    def mnt(self):
+        return os.path.join(self.root, 'mnt')
+
+    # Command emulation
+
+    def run(self, argv, sudo=False, timeout=None, fail_ok=False, input=None):
+        argv = [str(arg) for arg in argv]
+        if self.cmd_delay:
+            time.sleep(self.cmd_delay)
+        name = os.path.basename(argv[0])
+        self.counts[name] += 1
+        handler = getattr(self, '_cmd_' + name.replace('.', '_'), None)
+        if name.startswith('mkfs.'):
+            handler = self._cmd_mkfs
+        if handler is None:
+            rc, out, err = 127, '', '{}: command not found'.format(name)
+        else:
+            rc, out, err = handler(argv, input)
+        result = CmdResult(argv, rc, out, err)
+        if not result.ok and not fail_ok:
+            raise CmdError(result)
+        return result
+
+    def _cmd_hostname(self, argv, input):
+        return 0, HOSTNAME + '\n', ''
+
+    def _cmd_cat(self, argv, input):
+        path = self._sandboxed(argv[1])
+        if not os.path.exists(path):
+            return 1, '', 'cat: {}: No such file or directory'.format(argv[1])
+        with io.open(path) as f:
+            return 0, f.read(), ''
+
+    def _cmd_tee(self, argv, input):
+        with io.open(self._sandboxed(argv[1]), 'w') as f:
+            f.write(input or '')
+        return 0, input or '', ''
+
+    def _cmd_mkdir(self, argv, input):
+        path = self._sandboxed(argv[-1])
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        return 0, '', ''
+
+    def _cmd_rm(self, argv, input):
+        path = self._sandboxed(argv[-1])
+        if os.path.exists(path):
+            os.remove(path)
+        elif '-f' not in argv:
+            return 1, '', 'rm: cannot remove {}'.format(argv[-1])
+        return 0, '', ''
+
+    def _cmd_ls(self, argv, input):
+        if not os.path.exists(self._sandboxed(argv[-1])):
+            return 2, '', "ls: cannot access '{}'".format(argv[-1])
+        return 0, argv[-1] + '\n', ''
+
+    def _cmd_sync(self, argv, input):
+        return 0, '', ''
+
+    def _cmd_cp(self, argv, input):
+        src = self._sandboxed(argv[-2])
+        if not os.path.exists(src):
+            return 1, '', "cp: cannot stat '{}'".format(argv[-2])
+        shutil.copy2(src, self._sandboxed(argv[-1]))
+        return 0, '', ''
+
+    def _cmd_mv(self, argv, input):
+        try:
+            os.rename(self._sandboxed(argv[-2]), self._sandboxed(argv[-1]))
+        except OSError as e:
+            return 1, '', str(e)
+        return 0, '', ''
+
+    def _cmd_systemctl(self, argv, input):
+        return 0, '', ''
+
+    def _cmd_rmdir(self, argv, input):
+        try:
+            os.rmdir(self._sandboxed(argv[-1]))
+        except OSError as e:
+            return 1, '', str(e)
+        return 0, '', ''
+
+    def _cmd_iscsiadm(self, argv, input):
+        opts = self._opts(argv)
+        mode = opts.get('-m')
+        if mode in ('discovery', 'discoverydb'):
+            return 0, '', ''
+        if mode == 'session':
+            return 0, '', ''
+        if mode != 'node':
+            return 7, '', 'iscsiadm: invalid mode'
+        iqn = opts.get('-T')
+        portal = opts.get('-p', '').split(':')[0]
+        with self.lock:
+            if '--login' in argv:
+                if (iqn, portal) in self.sessions:
+                    return 15, '', ('iscsiadm: default: 1 session requested, '
+                                    'but 1 already present.')
+                self.sessions.add((iqn, portal))
+                delay = self.arrival_delay + self.rng.random() * self.jitter
+                if delay:
+                    timer = threading.Timer(delay, self._arrive,
+                                            (iqn, portal))
+                    timer.daemon = True
+                    timer.start()
+                    self.timers.append(timer)
+                else:
+                    # Devices are there once the login returns, which keeps
+                    # microbenchmarks of the login path deterministic
+                    self._arrive(iqn, portal)
+                return 0, 'Login to [iface: default, target: {}, portal: '\
+                    '{},3260] successful.\n'.format(iqn, portal), ''
+            if '--logout' in argv:
+                if (iqn, portal) not in self.sessions:
+                    return 21, '', 'iscsiadm: No matching sessions found'
+                self.sessions.discard((iqn, portal))
+                self._depart(iqn, portal)
+                return 0, '', ''
+        return 0, '', ''
+
+    def _cmd_multipath(self, argv, input):
+        if '-f' in argv:
+            key = self._lun(argv[-1])
+            with self.lock:
+                if key in self.maps:
+                    slaves = os.path.join(self.sys_root, 'block',
+                                          self.maps[key], 'slaves')
+                    if os.listdir(slaves) or any(
+                            m[1] == key for m in self.mounts.values()):
+                        return 1, '', '{}: map in use'.format(argv[-1])
+                    self._remove_map(key)
+            return 0, '', ''
+        if '-F' in argv:
+            with self.lock:
+                for key, dm in list(self.maps.items()):
+                    slaves = os.path.join(self.sys_root, 'block', dm,
+                                          'slaves')
+                    busy = any(m[1] == key for m in self.mounts.values())
+                    if not os.listdir(slaves) and not busy:
+                        self._remove_map(key)
+        return 0, '', ''
+
+    def _cmd_multipathd(self, argv, input):
+        if argv[1:3] == ['resize', 'map']:
+            mapper = os.path.join(self.dev_root, 'mapper', argv[3])
+            if not os.path.islink(mapper):
+                return 1, '', 'fail\n'
+        return 0, 'ok\n', ''
+
+    def _cmd_xfs_growfs(self, argv, input):
+        with self.lock:
+            mount = self.mounts.get(argv[-1])
+        if not mount or mount[2] != 'xfs':
+            return 1, '', '{} is not a mounted XFS filesystem'.format(
+                argv[-1])
+        return 0, '', ''
+
+    def _cmd_resize2fs(self, argv, input):
+        key = self._lun(argv[-1])
+        if key is None or not (self.fs.get(key) or '').startswith('ext'):
+            return 1, '', 'resize2fs: Bad magic number in super-block'
+        return 0, '', ''
+
+    def _cmd_mkfs(self, argv, input):
+        fstype = os.path.basename(argv[0]).split('.', 1)[1]
+        dev = argv[-1]
+        key = self._lun(dev)
+        if key is None:
+            return 1, '', '{}: No such file or directory'.format(dev)
+        if self.loop:
+            return self._real(argv[:-1] + [self.loops[key]])
+        with self.lock:
+            if any(m[1] == key for m in self.mounts.values()):
+                return 1, '', '{} contains a mounted filesystem'.format(dev)
+            if self.fs.get(key) and '-f' not in argv and '-F' not in argv:
+                return 1, '', ('{} appears to contain an existing '
+                               'filesystem ({})'.format(dev, self.fs[key]))
+        if self.mkfs_delay:
+            time.sleep(self.mkfs_delay)
+        with self.lock:
+            self.fs[key] = fstype
+        return 0, '', ''
+
+    def _cmd_blkid(self, argv, input):
+        dev = argv[-1]
+        key = self._lun(dev)
+        if key is None:
+            return 2, '', ''
+        if self.loop:
+            return self._real(argv[:-1] + [self.loops[key]])
+        fstype = self.fs.get(key)
+        if not fstype:
+            return 2, '', ''
+        return 0, fstype + '\n', ''
+
+    def _cmd_mount(self, argv, input):
+        dev, folder = argv[-2], argv[-1]
+        key = self._lun(dev)
+        if key is None:
+            return 32, '', 'mount: special device {} does not exist'.format(
+                dev)
+        if self.loop:
+            rc, out, err = self._real(['mount', dev, folder])
+            if rc == 0:
+                with self.lock:
+                    self.mounts[folder] = (dev, key, None)
+            return rc, out, err
+        with self.lock:
+            if not self.fs.get(key):
+                return 32, '', 'mount: wrong fs type, bad option, bad ' \
+                    'superblock on {}'.format(dev)
+            if not os.path.isdir(self._sandboxed(folder)):
+                return 32, '', 'mount: mount point {} does not ' \
+                    'exist'.format(folder)
+            self.mounts[folder] = (dev, key, self.fs[key])
+            self._write_mounts()
+        return 0, '', ''
+
+    def _cmd_umount(self, argv, input):
+        folder = argv[-1]
+        with self.lock:
+            if folder not in self.mounts:
+                return 32, '', 'umount: {}: not mounted'.format(folder)
+        if self.loop:
+            rc, out, err = self._real(['umount', folder])
+            if rc:
+                return rc, out, err
+        with self.lock:
+            self.mounts.pop(folder)
+            self._write_mounts()
+        return 0, '', ''
+
+    # Device tree
+
+    def _arrive(self, iqn, portal):
+        with self.lock:
+            if (iqn, portal) not in self.sessions:
+                return
+            for lun in range(self.luns):
+                key = (iqn, lun)
+                sd = self._new_sd()
+                self.paths[(iqn, portal, lun)] = sd
+                self.devices[sd] = key
+                block = os.path.join(self.sys_root, 'block', sd)
+                os.makedirs(os.path.join(block, 'queue'))
+                with io.open(os.path.join(block, 'queue', 'scheduler'),
+                             'w') as f:
+                    f.write('[mq-deadline] none\n')
+                self._make_node(sd, key)
+                if key not in self.maps:
+                    self._new_map(key)
+                dm = self.maps[key]
+                io.open(os.path.join(self.sys_root, 'block', dm, 'slaves',
+                                     sd), 'w').close()
+                os.symlink(os.path.join('..', '..', sd), os.path.join(
+                    self.dev_root, 'disk', 'by-path',
+                    'ip-{}:3260-iscsi-{}-lun-{}'.format(portal, iqn, lun)))
+
+    def _depart(self, iqn, portal):
+        for lun in range(self.luns):
+            sd = self.paths.pop((iqn, portal, lun), None)
+            if not sd:
+                continue
+            self.devices.pop(sd, None)
+            os.remove(os.path.join(
+                self.dev_root, 'disk', 'by-path',
+                'ip-{}:3260-iscsi-{}-lun-{}'.format(portal, iqn, lun)))
+            os.remove(os.path.join(self.dev_root, sd))
+            shutil.rmtree(os.path.join(self.sys_root, 'block', sd))
+            dm = self.maps.get((iqn, lun))
+            if dm:
+                os.remove(os.path.join(self.sys_root, 'block', dm, 'slaves',
+                                       sd))
+
+    def _new_sd(self):
+        n = self.next_sd
+        self.next_sd += 1
+        name = ''
+        while True:
+            name = chr(ord('a') + n % 26) + name
+            n = n // 26 - 1
+            if n < 0:
+                return 'sd' + name
+
+    def _new_map(self, key):
+        dm = 'dm-{}'.format(self.next_dm)
+        self.next_dm += 1
+        self.maps[key] = dm
+        self.devices[dm] = key
+        block = os.path.join(self.sys_root, 'block', dm)
+        os.makedirs(os.path.join(block, 'slaves'))
+        os.makedirs(os.path.join(block, 'queue'))
+        os.makedirs(os.path.join(block, 'dm'))
+        with io.open(os.path.join(block, 'dm', 'name'), 'w') as f:
+            f.write('mpath{}\n'.format(dm.split('-')[1]))
+        with io.open(os.path.join(block, 'dm', 'uuid'), 'w') as f:
+            f.write('mpath-{}\n'.format(self._wwid(key)))
+        self._make_node(dm, key)
+        os.symlink(os.path.join('..', dm), os.path.join(
+            self.dev_root, 'mapper', 'mpath{}'.format(dm.split('-')[1])))
+        os.symlink(os.path.join('..', '..', dm), os.path.join(
+            self.dev_root, 'disk', 'by-id',
+            'dm-uuid-mpath-{}'.format(self._wwid(key))))
+
+    def _remove_map(self, key):
+        dm = self.maps.pop(key)
+        self.devices.pop(dm, None)
+        os.remove(os.path.join(self.dev_root, 'mapper',
+                               'mpath{}'.format(dm.split('-')[1])))
+        os.remove(os.path.join(self.dev_root, 'disk', 'by-id',
+                               'dm-uuid-mpath-{}'.format(self._wwid(key))))
+        os.remove(os.path.join(self.dev_root, dm))
+        shutil.rmtree(os.path.join(self.sys_root, 'block', dm))
+
+    def _make_node(self, name, key):
+        node = os.path.join(self.dev_root, name)
+        if self.loop:
+            if key not in self.loops:
+                backing = os.path.join(self.root, 'lun-{}-{}.img'.format(
+                    key[0].rsplit(':', 1)[-1], key[1]))
+                with io.open(backing, 'wb') as f:
+                    f.truncate(self.loop_size_mb * 1024 * 1024)
+                self.loops[key] = run(['losetup', '-f', '--show', backing],
+                                      sudo=True).stdout.strip()
+            os.symlink(self.loops[key], node)
+        else:
+            io.open(node, 'w').close()
+
+    @staticmethod
+    def _wwid(key):
+        # Stable per LUN, like the NAA WWID of a real LUN
+        return '36001405{}{:08x}'.format(key[0].rsplit(':', 1)[-1][-16:],
+                                         key[1])
+
+    def _lun(self, dev):
+        real = os.path.realpath(dev)
+        with self.lock:
+            if self.loop:
+                for key, loop in self.loops.items():
+                    if loop == real:
+                        return key
+                return None
+            return self.devices.get(os.path.basename(real))
+
+    def _write_mounts(self):
+        if self.loop:
+            return
+        with io.open(os.path.join(self.root, 'proc', 'mounts'), 'w') as f:
+            for folder, (dev, _, fstype) in self.mounts.items():
+                f.write('{} {} {} rw 0 0\n'.format(dev, folder, fstype))
+
+    # Helpers
+
+    def _sandboxed(self, path):
+        if path.startswith(self.root):
+            return path
+        return os.path.join(self.root, path.lstrip('/'))
+
+    def exists(self, path):
+        return os.path.exists(self._sandboxed(path))
+
+    def _real(self, argv):
+        result = run(argv, sudo=True, fail_ok=True)
+        return result.returncode, result.stdout, result.stderr
+
+    @staticmethod
+    def _opts(argv):
+        opts = {}
+        for i, arg in enumerate(argv[:-1]):
+            if arg.startswith('-') and not argv[i + 1].startswith('-'):
+                opts[arg] = argv[i + 1]
+        return opts
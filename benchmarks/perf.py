@@ -0,0 +1,329 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Regression tracked microbenchmarks of dvot's find and mount hot paths.
+
+    ./benchmarks/perf.py --save perf-baseline.json
+    ./benchmarks/perf.py --compare perf-baseline.json --threshold 20
+
+Cases, each at several scales:
+
+* find_vol, find_si (both ``_find_impl``) and find_snap against the fake API
+  with N AppInstances, always looking up the last one
+* Parallel running N trivial tasks
+* _get_multipath_disk resolving a by-path link through the fake sysfs tree
+  of a host with N multipath maps, always the last map
+* _login of a two portal multipath target on a host with N maps, with the
+  sessions already up so only dvot's side of the login is timed
+
+Every case checks what it returned as well, a wrong result fails the run
+whatever its timing.  With --compare a case also fails when its median
+throughput dropped or its p95 latency rose by more than --threshold percent
+against the baseline (changes under --noise-ms are ignored).  The exit status
+is 1 when any case failed.
+"""
+from __future__ import unicode_literals, print_function, division
+
+import argparse
+import io
+import itertools
+import json
+import platform
+import re
+import sys
+import time
+import timeit
+
+from common import FakeApi, quiet, report, scales
+from fake_host import FakeHost
+
+HEADERS = ['case', 'p50_ms', 'p95_ms', 'ops_s', 'requests', 'ok']
+COMPARE_HEADERS = HEADERS + ['base_ops_s', 'base_p95_ms', 'change_pct',
+                             'status']
+PORTALS = ['172.28.0.1', '172.28.0.2']
+
+
+def sample(func, check, repeat, number=1, items=1, after=None):
+    """
+    Times repeat samples of number calls of func and checks the result of
+    every sample.  Latencies are per call, throughput is items per second at
+    the median latency.  after runs untimed after every sample
+    """
+    from dvot.utils import percentile
+    times = []
+    ok = True
+    with quiet():
+        for _ in range(repeat):
+            start = timeit.default_timer()
+            for _ in range(number):
+                result = func()
+            times.append((timeit.default_timer() - start) / number)
+            ok = ok and bool(check(result))
+            if after:
+                after()
+    p50, p95 = percentile(times, 50), percentile(times, 95)
+    return {'p50_ms': round(p50 * 1000, 4),
+            'p95_ms': round(p95 * 1000, 4),
+            'ops_s': round(items / p50, 1) if p50 else None,
+            'ok': ok}
+
+
+def target_iqns(count):
+    return ['iqn.2013-05.com.daterainc:tc:01:sn:{:016x}'.format(i)
+            for i in range(count)]
+
+
+def login_target(host, iqn):
+    for portal in PORTALS:
+        host.run(['iscsiadm', '-m', 'node', '-T', iqn, '-p',
+                  '{}:3260'.format(portal), '--login'])
+
+
+def logout_target(host, iqn):
+    for portal in PORTALS:
+        host.run(['iscsiadm', '-m', 'node', '-T', iqn, '-p',
+                  '{}:3260'.format(portal), '--logout'])
+    host.run(['multipath', '-f', host.dev_path(host.maps[(iqn, 0)])])
+
+
+def _device(host, iqn):
+    return host.dev_path(host.maps[(iqn, 0)])
+
+
+# Every case builder returns (func, check, extra sample() kwargs).  The find
+# cases take an API and FakeApi.targets(), the host cases a FakeHost and the
+# IQNs logged in on it, always looking up the last one
+
+def find_vol_case(api, targets):
+    from dvot import main as dvot
+    uuid = targets['vol_uuid']
+    return (lambda: dvot.find_vol(api, None, uuid),
+            lambda vol: vol and vol['uuid'] == uuid, {})
+
+
+def find_si_case(api, targets):
+    from dvot import main as dvot
+    iqn = targets['si_iqn']
+    return (lambda: dvot.find_si(api, iqn),
+            lambda si: si and si.access['iqn'] == iqn, {})
+
+
+def find_snap_case(api, targets):
+    from dvot import main as dvot
+    ts = targets['vol_snap_ts']
+    return (lambda: dvot.find_snap(api, ts),
+            lambda snap: snap and snap['utc_ts'] == ts, {})
+
+
+def multipath_disk_case(host, iqns):
+    from dvot.mount import by_path, _get_multipath_disk
+    path = by_path(PORTALS[0], iqns[-1], 0)
+    return (lambda: _get_multipath_disk(path),
+            lambda dpath: dpath == _device(host, iqns[-1]),
+            {'number': 20})
+
+
+def login_case(host, iqns):
+    from dvot.mount import _login
+    fresh = ('iqn.2013-05.com.daterainc:tc:01:sn:new{:013x}'.format(i)
+             for i in itertools.count())
+    current = [next(fresh)]
+
+    def _next():
+        logout_target(host, current[0])
+        current[0] = next(fresh)
+        login_target(host, current[0])
+
+    # The devices of the target are in place before the timing starts, so
+    # the simulated arrival isn't measured
+    login_target(host, current[0])
+    return (lambda: _login(current[0], PORTALS, True, 0),
+            lambda dpath: dpath == _device(host, current[0]),
+            {'after': _next})
+
+
+def parallel_case(tasks, workers=10):
+    from dvot.utils import Parallel
+    done = []
+
+    def _task(i):
+        done.append(i)
+
+    def _run():
+        del done[:]
+        Parallel([_task] * tasks, args_list=[(i,) for i in range(tasks)],
+                 max_workers=workers).run_threads()
+        return sorted(done)
+
+    return _run, lambda result: result == list(range(tasks)), {'items': tasks}
+
+
+FIND_CASES = [('find_vol', find_vol_case),
+              ('find_si', find_si_case),
+              ('find_snap', find_snap_case)]
+HOST_CASES = [('_get_multipath_disk', multipath_disk_case),
+              ('_login', login_case)]
+
+
+def _sample(args, func, check, kwargs):
+    if 'number' in kwargs:
+        kwargs['number'] = args.number
+    return sample(func, check, args.repeat, **kwargs)
+
+
+def bench_find(args, wanted):
+    rows = []
+    for scale in scales(args.api_scales):
+        with FakeApi(ais=scale, vols=1, snaps=1, latency=args.latency) as fake:
+            api = fake.api()
+            targets = fake.targets()
+            for name, build in FIND_CASES:
+                case = '{}/ais={}'.format(name, scale)
+                if not wanted(case):
+                    continue
+                fake.reset()
+                row = _sample(args, *build(api, targets))
+                row.update(case=case, requests=round(
+                    fake.stats().get('total', 0) / args.repeat, 1))
+                rows.append(_done(row))
+    return rows
+
+
+def bench_parallel(args, wanted):
+    rows = []
+    for scale in scales(args.task_scales):
+        case = 'Parallel/tasks={}'.format(scale)
+        if not wanted(case):
+            continue
+        row = _sample(args, *parallel_case(scale, args.workers))
+        row.update(case=case)
+        rows.append(_done(row))
+    return rows
+
+
+def bench_host(args, wanted):
+    from dvot.host import set_host
+    rows = []
+    for scale in scales(args.host_scales):
+        with FakeHost(luns=1, arrival_delay=0) as host:
+            set_host(host)
+            iqns = target_iqns(scale)
+            for iqn in iqns:
+                login_target(host, iqn)
+            for name, build in HOST_CASES:
+                case = '{}/maps={}'.format(name, scale)
+                if not wanted(case):
+                    continue
+                row = _sample(args, *build(host, iqns))
+                row.update(case=case)
+                rows.append(_done(row))
+        set_host(None)
+    return rows
+
+
+def _done(row):
+    print("{case}: p50 {p50_ms}ms p95 {p95_ms}ms{bad}".format(
+        bad='' if row['ok'] else ' WRONG RESULT', **row), file=sys.stderr)
+    return row
+
+
+def _slower(new, old, threshold, noise_ms):
+    return new - old > noise_ms and new > old * (1 + threshold / 100.0)
+
+
+def compare(rows, baseline, threshold, noise_ms):
+    """ Annotates rows with their baseline and status, returns failures """
+    base = dict((row['case'], row) for row in baseline['results'])
+    failed = 0
+    for row in rows:
+        old = base.get(row['case'])
+        if old:
+            row.update(base_ops_s=old['ops_s'], base_p95_ms=old['p95_ms'])
+            if old['p50_ms']:
+                row['change_pct'] = round(
+                    (row['p50_ms'] / old['p50_ms'] - 1) * 100, 1)
+        if not row['ok']:
+            row['status'] = 'WRONG'
+        elif not old:
+            row['status'] = 'new'
+        elif (_slower(row['p50_ms'], old['p50_ms'], threshold, noise_ms) or
+              _slower(row['p95_ms'], old['p95_ms'], threshold, noise_ms)):
+            row['status'] = 'REGRESSED'
+        else:
+            row['status'] = 'ok'
+        failed += row['status'] in ('WRONG', 'REGRESSED')
+    return failed
+
+
+def load(path):
+    """ Reads a baseline written by save """
+    with io.open(path, encoding='utf-8') as f:
+        baseline = json.load(f)
+    if baseline.get('python') != platform.python_version():
+        print("Baseline was recorded with Python {}".format(
+            baseline.get('python')), file=sys.stderr)
+    return baseline
+
+
+def save(path, rows, repeat):
+    """ Writes rows as a baseline for compare """
+    with io.open(path, 'w', encoding='utf-8') as f:
+        f.write(json.dumps({'created': int(time.time()),
+                            'python': platform.python_version(),
+                            'platform': platform.platform(),
+                            'repeat': repeat,
+                            'results': rows},
+                           indent=4, sort_keys=True) + '\n')
+
+
+def main(args):
+    only = re.compile(args.only) if args.only else None
+
+    def wanted(case):
+        return not only or only.search(case)
+
+    rows = []
+    rows.extend(bench_find(args, wanted))
+    rows.extend(bench_parallel(args, wanted))
+    rows.extend(bench_host(args, wanted))
+    failed = sum(not row['ok'] for row in rows)
+    headers = HEADERS
+    if args.compare:
+        failed = compare(rows, load(args.compare), args.threshold,
+                         args.noise_ms)
+        headers = COMPARE_HEADERS
+    report(rows, headers, args.json)
+    if args.save:
+        save(args.save, rows, args.repeat)
+    if failed:
+        print("{} of {} cases failed".format(failed, len(rows)),
+              file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--api-scales', default='100,1000',
+                        help='Comma separated AppInstance counts for finds')
+    parser.add_argument('--task-scales', default='100,1000,10000',
+                        help='Comma separated task counts for Parallel')
+    parser.add_argument('--host-scales', default='10,100,1000',
+                        help='Comma separated multipath map counts')
+    parser.add_argument('--only', help='Regex of the cases to run')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='Timed samples per case')
+    parser.add_argument('--number', type=int, default=20,
+                        help='Calls per sample for _get_multipath_disk')
+    parser.add_argument('--workers', type=int, default=10,
+                        help='max_workers passed to Parallel')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Milliseconds of API latency per request')
+    parser.add_argument('--save', help='Write the results as a baseline')
+    parser.add_argument('--compare', help='Baseline to compare against')
+    parser.add_argument('--threshold', type=float, default=20.0,
+                        help='Percent slowdown that counts as a regression')
+    parser.add_argument('--noise-ms', type=float, default=0.1,
+                        help='Ignore latency changes smaller than this')
+    parser.add_argument('--json', help='Also write results to this file')
+    sys.exit(main(parser.parse_args()))
@@ -0,0 +1,140 @@
+"""
+Response cache for SDK reads
+
+dvot reads the same AppInstances, StorageInstances and Snapshot lists many
+times per run.  The cache wraps the read methods of the SDK connection and
+serves repeated GETs of the same path and params from memory for `ttl`
+seconds.  The Datera REST API does not return ETag or Last-Modified headers,
+so there is nothing to revalidate against; entries simply expire.  Any
+create/update/delete through the same connection invalidates every cached
+path above or below the written one, eg. setting a Volume drops the cached
+Volume, its StorageInstance, AppInstance and the AppInstance listing.
+
+Poll loops that wait for state changed by the cluster itself must run their
+reads inside `uncached()`, those reads skip the lookup but still refresh the
+cache for later readers.
+"""
+from __future__ import unicode_literals, print_function, division
+
+import contextlib
+import copy
+import json
+import threading
+import time
+
+from dvot.utils import dprint
+
+READS = ('read_endpoint', 'read_entity')
+WRITES = ('create_entity', 'update_endpoint', 'update_entity',
+          'upload_endpoint', 'delete_entity')
+_LOCAL = threading.local()
+
+
+@contextlib.contextmanager
+def uncached():
+    """ Reads in this block go to the API """
+    prev = getattr(_LOCAL, 'bypass', False)
+    _LOCAL.bypass = True
+    try:
+        yield
+    finally:
+        _LOCAL.bypass = prev
+
+
+def fresh(obj):
+    """ Reloads obj from the API, bypassing the cache """
+    with uncached():
+        return obj.reload()
+
+
+class ResponseCache(object):
+
+    def __init__(self, conn, ttl):
+        self.conn = conn
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.pending = {}
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        # Bumped on every write so reads racing a write are not stored
+        self.generation = 0
+
+    def install(self):
+        for name in READS:
+            setattr(self.conn, name, self._reader(getattr(self.conn, name)))
+        for name in WRITES:
+            setattr(self.conn, name, self._writer(getattr(self.conn, name)))
+        return self
+
+    def _reader(self, func):
+        def _read(path, params=None, sensitive=False):
+            if sensitive:
+                return func(path, params, sensitive)
+            # The SDK pops the tenant out of params, key on a copy first
+            key = (func.__name__, path.rstrip('/'),
+                   json.dumps(params or {}, sort_keys=True))
+            bypass = getattr(_LOCAL, 'bypass', False)
+            while True:
+                with self.lock:
+                    entry = self.entries.get(key)
+                    if not bypass and entry and entry[0] > time.time():
+                        self.hits += 1
+                        return copy.deepcopy(entry[1])
+                    # Concurrent misses of the same key wait for the
+                    # first one instead of all going to the API
+                    waiting = None if bypass else self.pending.get(key)
+                    if not waiting:
+                        self.misses += 1
+                        generation = self.generation
+                        done = threading.Event()
+                        if not bypass:
+                            self.pending[key] = done
+                        break
+                waiting.wait()
+            try:
+                data = func(path, dict(params) if params else params,
+                            sensitive)
+                with self.lock:
+                    if generation == self.generation:
+                        self.entries[key] = (time.time() + self.ttl,
+                                             copy.deepcopy(data))
+                return data
+            finally:
+                with self.lock:
+                    if self.pending.get(key) is done:
+                        del self.pending[key]
+                done.set()
+        return _read
+
+    def _writer(self, func):
+        def _write(path, *args, **kwargs):
+            try:
+                return func(path, *args, **kwargs)
+            finally:
+                self.invalidate(path)
+        return _write
+
+    def invalidate(self, path):
+        """ Drops every cached read of path, its parents and children """
+        path = path.rstrip('/')
+        with self.lock:
+            self.generation += 1
+            for key in list(self.entries):
+                cached = key[1]
+                if (cached == path or path.startswith(cached + '/') or
+                        cached.startswith(path + '/')):
+                    del self.entries[key]
+                    self.invalidations += 1
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'invalidations': self.invalidations}
+
+
+def enable_cache(api, ttl):
+    """ Caches reads of api's connection for ttl seconds """
+    cache = ResponseCache(api.context.connection, ttl).install()
+    dprint("API response cache enabled, ttl {}s".format(ttl))
+    return cache
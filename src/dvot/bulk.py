@@ -0,0 +1,164 @@
+"""
+Operations applied to many AppInstances/Volumes in a single dvot run
+"""
+from __future__ import unicode_literals, print_function, division
+
+import io
+import re
+import threading
+import time
+
+from dvot.apicache import fresh
+from dvot.utils import Parallel, RateLimiter, dprint, percentile
+
+LEVELS = ('app', 'vol')
+
+
+def read_id_file(path):
+    with io.open(path) as f:
+        return set(line.strip() for line in f
+                   if line.strip() and not line.startswith('#'))
+
+
+def select_targets(api, level, name_re=None, id_file=None, select_all=False,
+                   workers=10):
+    """
+    Returns the AppInstances (level 'app') or Volumes (level 'vol') of the
+    tenant matching every selector given.  Names are matched against
+    name_re, ids against the AppInstance id/Volume uuid listed in id_file.
+    """
+    if level not in LEVELS:
+        raise ValueError("Unsupported target level: {}".format(level))
+    if not (name_re or id_file or select_all):
+        raise ValueError(
+            "One of --name-re, --id-file or --all MUST be provided")
+    regex = re.compile(name_re) if name_re else None
+    ids = read_id_file(id_file) if id_file else None
+
+    def _wanted(obj, oid):
+        if regex and not regex.search(obj['name']):
+            return False
+        if ids is not None and oid not in ids:
+            return False
+        return True
+
+    ais = api.app_instances.list()
+    if level == 'app':
+        return [ai for ai in ais if _wanted(ai, ai['id'])]
+
+    found = []
+
+    def _vol_helper(ai):
+        for si in ai.storage_instances.list():
+            for vol in si.volumes.list():
+                if _wanted(vol, vol['uuid']):
+                    found.append(vol)
+    if ais:
+        p = Parallel([_vol_helper] * len(ais),
+                     args_list=[(ai,) for ai in ais],
+                     max_workers=min(workers, len(ais)))
+        p.run_threads()
+    return sorted(found, key=lambda vol: vol.path)
+
+
+def run_bulk(func, targets, workers, rate=0, progress=False,
+             on_result=None, journal=None, step=None):
+    """
+    Calls func(target) for every target with at most `workers` in flight and
+    at most `rate` calls started per second (0 for no limit).
+
+    A failing target is recorded and does not stop the others.  Returns one
+    result dict per target with its path, name, ok, error and latency_s, plus
+    whatever dict func returned.  With progress set a line is printed as each
+    target finishes, on_result is called with each result as it finishes.
+    With a journal, every target that succeeds is recorded as `step` and
+    targets the journal already has are not run again, their result is
+    marked resumed.
+    """
+    limiter = RateLimiter(rate)
+    results = []
+    lock = threading.Lock()
+
+    def _bulk_helper(target):
+        result = {'target': target.path,
+                  'name': target.get('name'),
+                  'ok': True,
+                  'error': None}
+        start = time.time()
+        done = journal.get(step, target.path) if journal else None
+        try:
+            if done is not None:
+                result.update(done, resumed=True)
+            else:
+                limiter.acquire()
+                data = func(target) or {}
+                result.update(data)
+                if journal:
+                    journal.record(step, target.path, **data)
+        except Exception as e:
+            dprint("Bulk operation failed for {}: {}".format(target.path, e))
+            result['ok'] = False
+            result['error'] = str(e)
+        result['latency_s'] = round(time.time() - start, 3)
+        with lock:
+            results.append(result)
+            if on_result:
+                on_result(result)
+            if progress:
+                print("[{}/{}] {} {}".format(
+                    len(results), len(targets),
+                    'done' if result['ok'] else 'FAILED', target.path))
+    if targets:
+        p = Parallel([_bulk_helper] * len(targets),
+                     args_list=[(target,) for target in targets],
+                     max_workers=max(min(workers, len(targets)), 1))
+        p.run_threads()
+    return sorted(results, key=lambda r: r['target'])
+
+
+def wait_available(obj, timeout, interval=0.5):
+    deadline = time.time() + timeout
+    while True:
+        obj = fresh(obj)
+        if obj['op_state'] == 'available':
+            return obj
+        if time.time() >= deadline:
+            raise EnvironmentError(
+                "Timed out waiting for {} to become available, op_state: "
+                "{}".format(obj.path, obj['op_state']))
+        time.sleep(interval)
+        interval = min(interval * 2, 5)
+
+
+def bulk_snap(api, targets, workers, rate=0, wait=False, wait_timeout=300,
+              on_result=None, journal=None):
+    def _snap(target):
+        snap = target.snapshots.create()
+        result = {'snapshot': snap.path, 'utc_ts': snap['utc_ts']}
+        if wait:
+            start = time.time()
+            snap = wait_available(snap, wait_timeout)
+            result['ready_s'] = round(time.time() - start, 3)
+        result['op_state'] = snap.get('op_state')
+        return result
+    return run_bulk(_snap, targets, workers, rate, on_result=on_result,
+                    journal=journal, step='snapshot')
+
+
+def print_bulk_results(results, detail_key=None):
+    for r in results:
+        if r['ok']:
+            print("OK     {} {}s {}".format(
+                r['target'], r['latency_s'],
+                r.get(detail_key, '') if detail_key else ''))
+        else:
+            print("FAILED {} {}s {}".format(
+                r['target'], r['latency_s'], r['error']))
+    lat = [r['latency_s'] for r in results]
+    failed = len([r for r in results if not r['ok']])
+    print("\nTargets: {}, succeeded: {}, failed: {}".format(
+        len(results), len(results) - failed, failed))
+    if lat:
+        print("Latency min/avg/p99/max: {}/{}/{}/{}s".format(
+            min(lat), round(sum(lat) / len(lat), 3), percentile(lat, 99),
+            max(lat)))
@@ -0,0 +1,224 @@
+"""
+Tracks the AppInstances dvot cloned from snapshots so mounting the same
+snapshot again reuses an idle clone instead of creating a new one.
+
+Clones are recognized by their clone_snapshot_src and carry a descr recording
+the source snapshot and creation time.  Mounting a clone read-write (or
+handing it out with refresh) appends a used mark to the descr.  A clone is
+reusable when it still carries that descr without the mark and no initiator
+is connected to it.  Raw block writes through a --login only session leave
+no mark.
+"""
+from __future__ import unicode_literals, print_function, division
+
+import hashlib
+import re
+import threading
+import time
+import uuid
+
+from dfs_sdk import exceptions as dexceptions
+from dvot.apicache import fresh
+from dvot.bulk import run_bulk
+from dvot.utils import dprint
+
+CLONE_PREFIX = 'from-snap-'
+DESCR_TEMPLATE = "dvot clone of {src} created {created}"
+USED_TEMPLATE = " used {used}"
+DESCR_RE = re.compile(r"^dvot clone of (?P<src>\S+) created (?P<created>\d+)"
+                      r"(?: used (?P<used>\d+))?$")
+
+
+def clone_name(snap, unique=False):
+    if unique:
+        suffix = str(uuid.uuid4())[:8]
+    else:
+        suffix = hashlib.sha1(snap.path.encode('utf-8')).hexdigest()[:8]
+    return '{}{}-{}'.format(CLONE_PREFIX, snap['utc_ts'], suffix)
+
+
+def clone_source(ai):
+    src = ai.get('clone_snapshot_src')
+    if isinstance(src, dict) and src.get('path'):
+        return src['path']
+    match = DESCR_RE.match(ai.get('descr') or '')
+    if match:
+        return match.group('src')
+
+
+def clone_created(ai):
+    match = DESCR_RE.match(ai.get('descr') or '')
+    if match:
+        return int(match.group('created'))
+
+
+def is_attached(ai):
+    for si in ai.get('storage_instances') or []:
+        if si.get('active_initiators'):
+            return True
+    return False
+
+
+def is_idle(ai):
+    match = DESCR_RE.match(ai.get('descr') or '')
+    if (not match or match.group('src') != clone_source(ai) or
+            match.group('used')):
+        return False
+    return not is_attached(ai)
+
+
+def mark_used(ai):
+    """
+    Marks a dvot clone as written to so it is never reused.  Other
+    AppInstances and clones already marked are left alone
+    """
+    descr = ai.get('descr') or ''
+    match = DESCR_RE.match(descr)
+    if not match or match.group('used'):
+        return
+    dprint("Marking clone {} as used".format(ai['name']))
+    ai.set(descr=descr + USED_TEMPLATE.format(used=int(time.time())))
+
+
+def create_clone(api, snap, unique=False, used=False):
+    """
+    Creates a new AppInstance from snap carrying the dvot clone descr, already
+    marked as used when used is set
+    """
+    name = clone_name(snap, unique)
+    now = int(time.time())
+    descr = DESCR_TEMPLATE.format(src=snap.path, created=now)
+    if used:
+        descr += USED_TEMPLATE.format(used=now)
+    print("Creating new AppInstance {} from snapshot: {}".format(
+        name, snap.path))
+    return api.app_instances.create(
+        name=name, descr=descr, clone_snapshot_src={'path': snap.path})
+
+
+class CloneRegistry(object):
+
+    """
+    Index of existing clones by source snapshot path, built from a single
+    listing of the tenant's AppInstances
+    """
+
+    def __init__(self, api):
+        self.api = api
+        self.lock = threading.Lock()
+        self.clones = None
+        self.claimed = set()
+
+    def _load(self):
+        with self.lock:
+            if self.clones is None:
+                self.clones = {}
+                for ai in self.api.app_instances.list():
+                    src = clone_source(ai)
+                    if src:
+                        self.clones.setdefault(src, []).append(ai)
+        return self.clones
+
+    def find(self, snap):
+        return list(self._load().get(snap.path, []))
+
+    def _claim(self, snap):
+        for ai in self.find(snap):
+            with self.lock:
+                if ai['id'] in self.claimed:
+                    continue
+                self.claimed.add(ai['id'])
+            ai = fresh(ai)
+            if is_idle(ai):
+                return ai
+            dprint("Clone {} of {} is in use".format(ai['name'], snap.path))
+
+    def _create(self, snap, unique):
+        return create_clone(self.api, snap, unique)
+
+    def clone(self, snap, new=False):
+        """
+        Returns an idle existing clone of snap, or a newly created one when
+        there is none or `new` is set
+        """
+        if not new:
+            ai = self._claim(snap)
+            if ai:
+                print("Reusing AppInstance {} cloned from snapshot: {}".format(
+                    ai['name'], snap.path))
+                return ai
+        try:
+            # The first clone of a snapshot gets the deterministic name
+            ai = self._create(snap, unique=bool(self.find(snap)))
+        except dexceptions.ApiConflictError:
+            ai = self._create(snap, unique=True)
+        clones = self._load()
+        with self.lock:
+            self.claimed.add(ai['id'])
+            clones.setdefault(snap.path, []).append(ai)
+        return ai
+
+
+def is_dvot_clone(ai):
+    """ Whether dvot created ai, other tools' clones are never touched """
+    return bool(DESCR_RE.match(ai.get('descr') or '') or
+                ai['name'].startswith(CLONE_PREFIX))
+
+
+def find_stale_clones(api, older_than=None, unattached=False, force=False,
+                      now=None):
+    """
+    Returns (ai, age_s) for every dvot clone in the tenant created more
+    than older_than seconds ago, or with no initiator connected when
+    unattached is set.  Clones without a dvot descr have no known age and
+    only match on unattached.  Clones with connected initiators are only
+    returned with force.
+    """
+    if older_than is None and not unattached:
+        raise ValueError("One of --older-than or --unattached MUST be "
+                         "provided")
+    now = now or time.time()
+    stale = []
+    for ai in api.app_instances.list():
+        if not is_dvot_clone(ai):
+            continue
+        created = clone_created(ai)
+        age = now - created if created else None
+        attached = is_attached(ai)
+        if ((older_than is not None and age is not None and
+                age > older_than) or
+                (unattached and not attached)):
+            if attached and not force:
+                print("Skipping {}, initiators are connected to it (use "
+                      "--force to delete it anyway)".format(ai['name']))
+                continue
+            stale.append((ai, age))
+    return sorted(stale, key=lambda x: x[0]['name'])
+
+
+def delete_clone(ai):
+    ai.set(admin_state='offline', force=True)
+    ai.delete()
+
+
+def gc_clones(api, older_than=None, unattached=False, dry_run=False,
+              workers=10, rate=0, on_result=None, force=False):
+    stale = find_stale_clones(api, older_than, unattached, force)
+    print("Found {} stale clones".format(len(stale)))
+    plan = []
+    for ai, age in stale:
+        print("{} source: {} age: {} attached: {}".format(
+            ai['name'], clone_source(ai),
+            '{:.1f}h'.format(age / 3600) if age is not None else 'unknown',
+            is_attached(ai)))
+        plan.append({'target': ai.path,
+                     'name': ai['name'],
+                     'source': clone_source(ai),
+                     'age_s': round(age) if age is not None else None,
+                     'attached': is_attached(ai),
+                     'action': 'delete',
+                     'dry_run': True})
+    if dry_run:
+        return plan
+    return run_bulk(delete_clone, [ai for ai, _ in stale],
+                    workers, rate, progress=True, on_result=on_result)
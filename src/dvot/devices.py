@@ -0,0 +1,210 @@
+"""
+Inventory of the Datera iSCSI devices attached to this host
+
+The by-path links, the dm-* slave topology and the mount table are each read
+once and turned into one entry per attached LUN.  All LUNs are then resolved
+against the cluster from a single listing of the tenant's AppInstances.
+"""
+from __future__ import unicode_literals, print_function, division
+
+import glob
+import io
+import os
+import re
+import threading
+
+from tabulate import tabulate
+
+from dvot.host import get_host
+
+BY_PATH_RE = re.compile(r"ip-(?P<portal>[^:]+):\d+-iscsi-(?P<iqn>iqn\..+)"
+                        r"-lun-(?P<lun>\d+)$")
+# device argument -> (iqn, lun) for the life of the process
+_RESOLVED = {}
+_RESOLVED_LOCK = threading.Lock()
+# (by-path directory mtime, by_path_links()) of the last lookup
+_LINKS = [None, None]
+HEADERS = ['mount', 'fstype', 'device', 'paths', 'app_instance',
+           'storage_instance', 'volume', 'volume_uuid']
+
+
+def _unescape(field):
+    # Spaces and friends are octal escaped in the mount tables
+    return re.sub(r"\\([0-7]{3})", lambda m: chr(int(m.group(1), 8)), field)
+
+
+def by_path_links():
+    """ Returns {sd name: (iqn, lun, portal)} for every iSCSI by-path link """
+    links = {}
+    for link in glob.glob(get_host().dev_path('disk', 'by-path', '*-iscsi-*')):
+        match = BY_PATH_RE.match(os.path.basename(link))
+        if match:
+            links[os.path.basename(os.path.realpath(link))] = (
+                match.group('iqn'), int(match.group('lun')),
+                match.group('portal'))
+    return links
+
+
+def _cached_links():
+    """
+    by_path_links(), rebuilt only when a link was added or removed since the
+    last call (the by-path directory's mtime changed)
+    """
+    try:
+        mtime = os.stat(get_host().dev_path('disk', 'by-path')).st_mtime
+    except OSError:
+        return {}
+    with _RESOLVED_LOCK:
+        if _LINKS[0] == mtime:
+            return _LINKS[1]
+    links = by_path_links()
+    with _RESOLVED_LOCK:
+        _LINKS[:] = [mtime, links]
+    return links
+
+
+def _block_name(device):
+    """ sd/dm kernel name of a device path, /dev/mapper name or kernel name """
+    host = get_host()
+    if os.sep not in device:
+        device = host.dev_path(device)
+    name = os.path.basename(os.path.realpath(device))
+    if os.path.isdir(host.sys_path('block', name)):
+        return name
+    # /dev/mapper entries that are device nodes instead of links
+    try:
+        rdev = os.stat(device).st_rdev
+    except OSError:
+        return name
+    number = '{}:{}'.format(os.major(rdev), os.minor(rdev))
+    for dev in glob.glob(host.sys_path('block', '*', 'dev')):
+        with io.open(dev) as f:
+            if f.read().strip() == number:
+                return os.path.basename(os.path.dirname(dev))
+    return name
+
+
+def iqn_lun_from_device(device, links=None):
+    """
+    Returns (iqn, lun) of an sd, dm-N or /dev/mapper device, or (None, None).
+    Multipath devices resolve through their first slave with a by-path link.
+    Results are cached for the life of the process.  links is a
+    by_path_links() result to resolve against, by default the by-path links
+    are only read again when they changed since the last lookup
+    """
+    with _RESOLVED_LOCK:
+        if device in _RESOLVED:
+            return _RESOLVED[device]
+    name = _block_name(device)
+    if links is None:
+        links = _cached_links()
+    candidates = [name]
+    slaves = get_host().sys_path('block', name, 'slaves')
+    if os.path.isdir(slaves):
+        candidates.extend(sorted(os.listdir(slaves)))
+    for candidate in candidates:
+        if candidate in links:
+            iqn, lun, _ = links[candidate]
+            with _RESOLVED_LOCK:
+                _RESOLVED[device] = (iqn, lun)
+            return iqn, lun
+    return None, None
+
+
+def read_mounts():
+    """
+    Returns {device name: (mount point, fstype)} from mountinfo, falling back
+    to /proc/mounts
+    """
+    host = get_host()
+    mounts = {}
+    mountinfo = host.proc_path('self', 'mountinfo')
+    if os.path.exists(mountinfo):
+        numbers = {}
+        for dev in glob.glob(host.sys_path('block', '*', 'dev')):
+            with io.open(dev) as f:
+                numbers[f.read().strip()] = os.path.basename(
+                    os.path.dirname(dev))
+        with io.open(mountinfo) as f:
+            for line in f:
+                pre, _, post = line.partition(' - ')
+                pre, post = pre.split(), post.split()
+                if len(pre) < 5 or len(post) < 2:
+                    continue
+                name = numbers.get(pre[2]) or os.path.basename(
+                    os.path.realpath(_unescape(post[1])))
+                mounts.setdefault(name, (_unescape(pre[4]), post[0]))
+        return mounts
+    with io.open(host.proc_path('mounts')) as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) > 2:
+                name = os.path.basename(os.path.realpath(_unescape(parts[0])))
+                mounts.setdefault(name, (_unescape(parts[1]), parts[2]))
+    return mounts
+
+
+def scan_host():
+    """
+    Returns one dict per attached Datera LUN with its iqn, lun, portals,
+    sd paths, dm device and mount point/fstype
+    """
+    host = get_host()
+    luns = {}
+    devices = {}
+    for sd, (iqn, lun, portal) in by_path_links().items():
+        entry = luns.setdefault((iqn, lun), {'iqn': iqn, 'lun': lun,
+                                             'portals': [], 'paths': [],
+                                             'dm': None})
+        entry['portals'].append(portal)
+        entry['paths'].append(sd)
+        devices[sd] = entry
+    for slave in glob.glob(host.sys_path('block', 'dm-*', 'slaves', '*')):
+        entry = devices.get(os.path.basename(slave))
+        if entry:
+            entry['dm'] = slave.split(os.sep)[-3]
+    mounts = read_mounts()
+    for entry in luns.values():
+        entry['paths'].sort()
+        entry['mount'], entry['fstype'] = '', ''
+        for dev in [entry['dm']] + entry['paths']:
+            if dev in mounts:
+                entry['mount'], entry['fstype'] = mounts[dev]
+                break
+    return sorted(luns.values(), key=lambda e: (e['iqn'], e['lun']))
+
+
+def resolve(api, entries):
+    """
+    Adds the AppInstance, StorageInstance and Volume of every entry using a
+    single listing of the tenant's AppInstances
+    """
+    targets = {}
+    for ai in api.app_instances.list():
+        for si in ai.get('storage_instances') or []:
+            iqn = (si.get('access') or {}).get('iqn')
+            if iqn:
+                targets[iqn] = (ai, si)
+    for entry in entries:
+        ai, si = targets.get(entry['iqn'], (None, None))
+        vols = (si or {}).get('volumes') or []
+        vol = vols[entry['lun']] if entry['lun'] < len(vols) else None
+        entry['app_instance'] = ai['name'] if ai else None
+        entry['app_instance_id'] = ai['id'] if ai else None
+        entry['storage_instance'] = si['name'] if si else None
+        entry['volume'] = vol['name'] if vol else None
+        entry['volume_uuid'] = vol['uuid'] if vol else None
+    return entries
+
+
+def host_inventory(api):
+    return resolve(api, scan_host())
+
+
+def print_inventory(entries):
+    rows = []
+    for e in entries:
+        rows.append([e['mount'], e['fstype'], e['dm'] or e['paths'][0],
+                     ','.join(e['paths']), e['app_instance'],
+                     e['storage_instance'], e['volume'], e['volume_uuid']])
+    print(tabulate(rows, headers=HEADERS))
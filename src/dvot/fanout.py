@@ -0,0 +1,123 @@
+"""
+Running one operation against several clusters and tenants at once
+
+Every cluster config and tenant gets its own API object (and so its own
+connection and login).  The operation runs against all of them concurrently
+and the results are merged, each labelled with its cluster and tenant.
+"""
+from __future__ import unicode_literals, print_function, division
+
+from dfs_sdk import get_api, scaffold
+from tabulate import tabulate
+
+from dvot.utils import Parallel, dprint
+
+
+def _tenant_header(tenant):
+    """ Tenant header for a /tenants listing entry """
+    path = tenant.get('path') or tenant['name']
+    path = '/' + path.strip('/')
+    if path.startswith('/tenants'):
+        path = path[len('/tenants'):] or '/root'
+    if not path.startswith('/root'):
+        path = '/root' + path
+    return path
+
+
+def tenant_apis(api, workers=10, disable_log=False):
+    """
+    Returns {tenant: api} for the root tenant of api and its subtenants.
+    disable_log is passed on to the SDK like for the caller's own API
+    """
+    ctx = api.context
+    tenants = ['/root']
+    for tenant in api.tenants.list():
+        header = _tenant_header(tenant)
+        if header not in tenants:
+            tenants.append(header)
+    apis = {}
+
+    def _connect(tenant):
+        apis[tenant] = get_api(ctx.hostname, ctx.username, ctx.password,
+                               ctx.version, tenant=tenant, secure=ctx.secure,
+                               ldap_server=ctx.ldap_server,
+                               schema_loc=ctx.schema_loc,
+                               disable_log=disable_log)
+    p = Parallel([_connect] * len(tenants),
+                 args_list=[(tenant,) for tenant in tenants],
+                 max_workers=max(min(workers, len(tenants)), 1))
+    p.run_threads()
+    return apis
+
+
+def connect_all(config_files=None, all_tenants=False, workers=10,
+                disable_log=False):
+    """
+    Returns one {'cluster', 'tenant', 'api'} target per cluster config (or
+    the default config when none are given) and, with all_tenants, per
+    tenant of each cluster
+    """
+    apis = []
+    # scaffold keeps the config in a global, so configs are read serially
+    for config in config_files or [None]:
+        api = scaffold.get_api(config=config, reset_config=True,
+                               disable_log=disable_log)
+        apis.append((scaffold.get_config()['mgmt_ip'], api))
+    targets = []
+    for cluster, api in apis:
+        if not all_tenants:
+            targets.append({'cluster': cluster,
+                            'tenant': api.context.tenant,
+                            'api': api})
+            continue
+        for tenant, tapi in sorted(tenant_apis(api, workers,
+                                               disable_log).items()):
+            targets.append({'cluster': cluster, 'tenant': tenant,
+                            'api': tapi})
+    dprint("Fanning out to {} cluster/tenant targets".format(len(targets)))
+    return targets
+
+
+def fan_out(targets, func, workers=10):
+    """
+    Calls func(target) for every target concurrently.  A failing target does
+    not stop the others.  Returns one {'cluster', 'tenant', 'ok', 'error',
+    'result'} dict per target
+    """
+    results = []
+
+    def _fan_out_helper(target):
+        result = {'cluster': target['cluster'],
+                  'tenant': target['tenant'],
+                  'ok': True,
+                  'error': None,
+                  'result': None}
+        try:
+            result['result'] = func(target)
+        except Exception as e:
+            dprint("Failed for {} {}: {}".format(
+                target['cluster'], target['tenant'], e))
+            result['ok'] = False
+            result['error'] = str(e)
+        results.append(result)
+    if targets:
+        p = Parallel([_fan_out_helper] * len(targets),
+                     args_list=[(target,) for target in targets],
+                     max_workers=max(min(workers, len(targets)), 1))
+        p.run_threads()
+    return sorted(results, key=lambda r: (r['cluster'], r['tenant']))
+
+
+def print_merged(records, columns):
+    """ One table of the labelled records of every target """
+    print(tabulate([[r.get(c) for c in ['cluster', 'tenant'] + columns]
+                    for r in records],
+                   headers=['cluster', 'tenant'] + columns,
+                   disable_numparse=True))
+
+
+def print_failures(results):
+    for r in results:
+        if not r['ok']:
+            print("FAILED {} {}: {}".format(r['cluster'], r['tenant'],
+                                            r['error']))
@@ -0,0 +1,140 @@
+"""
+Cluster reachability checks
+
+Every network path is probed concurrently: ICMP through the ping binary and
+TCP connects to the iSCSI port on the access VIPs and to the REST API port on
+the management IP.  Each probe takes N samples and reports loss and
+min/avg/p99 round trip times.
+"""
+from __future__ import unicode_literals, print_function, division
+
+import re
+import socket
+import time
+
+from dfs_sdk import scaffold
+from dfs_sdk.constants import REST_PORT, REST_PORT_HTTPS
+from tabulate import tabulate
+
+from dvot.host import get_host
+from dvot.utils import Parallel, percentile
+
+ISCSI_PORT = 3260
+PROBE_TIMEOUT = 1
+# Shortest interval ping allows for non-root users
+PING_INTERVAL = 0.2
+PING_RTT_RE = re.compile(r"time[=<](?P<rtt>[\d.]+) ?ms")
+HEADERS = ['name', 'ip', 'probe', 'sent', 'loss %', 'min ms', 'avg ms',
+           'p99 ms']
+
+
+def ping(ip, samples):
+    """ Returns the RTTs in ms of the replies to `samples` echo requests """
+    result = get_host().run(
+        ['ping', '-n', '-c', str(samples), '-i', str(PING_INTERVAL),
+         '-W', str(PROBE_TIMEOUT), ip],
+        timeout=samples * PING_INTERVAL + PROBE_TIMEOUT + 5, fail_ok=True)
+    return [float(m.group('rtt'))
+            for m in PING_RTT_RE.finditer(result.stdout)]
+
+
+def tcp_connect(ip, port, samples):
+    """ Returns the times in ms of the successful connects to ip:port """
+    rtts = []
+    for _ in range(samples):
+        start = time.time()
+        try:
+            socket.create_connection((ip, port), PROBE_TIMEOUT).close()
+        except (socket.error, socket.timeout):
+            continue
+        rtts.append((time.time() - start) * 1000)
+    return rtts
+
+
+def summarize(rtts, sent):
+    loss = 100.0 * (sent - len(rtts)) / sent if sent else 100.0
+    if not rtts:
+        return {'sent': sent, 'loss': loss, 'min': None, 'avg': None,
+                'p99': None}
+    return {'sent': sent,
+            'loss': round(loss, 1),
+            'min': round(min(rtts), 3),
+            'avg': round(sum(rtts) / len(rtts), 3),
+            'p99': round(percentile(rtts, 99), 3)}
+
+
+def get_paths(api):
+    """ Returns (name, ip, [probes]) for the mgmt IP and every access VIP """
+    api_port = REST_PORT_HTTPS if api.context.secure else REST_PORT
+    config = scaffold.get_config()
+    paths = [('mgmt', config['mgmt_ip'], ['icmp', 'tcp/{}'.format(api_port)])]
+    av = api.system.network.access_vip.get()
+    for np in av['network_paths']:
+        if np.get('ip'):
+            paths.append((np.get('name'), np['ip'],
+                          ['icmp', 'tcp/{}'.format(ISCSI_PORT)]))
+    return paths
+
+
+def probe_paths(paths, samples):
+    """ Runs every probe of every path concurrently, returns result rows """
+    rows = []
+
+    def _probe_helper(name, ip, probe):
+        if probe == 'icmp':
+            rtts = ping(ip, samples)
+        else:
+            rtts = tcp_connect(ip, int(probe.split('/')[1]), samples)
+        row = summarize(rtts, samples)
+        row.update(name=name, ip=ip, probe=probe)
+        rows.append(row)
+    args_list = [(name, ip, probe) for name, ip, probes in paths
+                 for probe in probes]
+    p = Parallel([_probe_helper] * len(args_list), args_list=args_list,
+                 max_workers=len(args_list))
+    p.run_threads()
+    return sorted(rows, key=lambda r: (r['name'] != 'mgmt', r['name'],
+                                       r['probe']))
+
+
+def print_probes(rows):
+    print(tabulate([[r['name'], r['ip'], r['probe'], r['sent'], r['loss'],
+                     r['min'], r['avg'], r['p99']] for r in rows],
+                   headers=HEADERS))
+
+
+def run_health(api, samples=3, watch=0, on_probe=None):
+    """
+    Probes every path with `samples` samples.  With watch set, keeps
+    probing every `watch` seconds until interrupted.  on_probe is called
+    with every result row
+    """
+    try:
+        api.app_instances.list()
+    except Exception as e:
+        print("Could not connect to cluster", e)
+        return False
+    paths = get_paths(api)
+    rows = []
+    try:
+        while True:
+            rows = probe_paths(paths, samples)
+            if watch:
+                print(time.strftime('\n%Y-%m-%d %H:%M:%S'))
+            print_probes(rows)
+            if on_probe:
+                for row in rows:
+                    on_probe(row)
+            if not watch:
+                break
+            time.sleep(watch)
+    except KeyboardInterrupt:
+        pass
+    healthy = bool(rows) and all(r['loss'] < 100 for r in rows)
+    for r in rows:
+        if r['loss'] == 100:
+            print('Could not reach: {} {} {}'.format(
+                r['name'], r['ip'], r['probe']))
+    if healthy:
+        print("Health Check Completed Successfully")
+    return healthy
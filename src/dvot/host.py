@@ -0,0 +1,49 @@
+"""
+Host-side backend used by the mount path.
+
+Every command dvot runs on the client and every sysfs/devfs/procfs path it
+reads goes through the current Host object, so an alternate implementation
+(eg. the simulator in benchmarks/fake_host.py) can be swapped in with
+set_host() without touching the mount logic.
+"""
+from __future__ import unicode_literals, print_function, division
+
+import os
+
+from dvot.utils import run
+
+_HOST = None
+
+
+class Host(object):
+
+    sys_root = '/sys'
+    dev_root = '/dev'
+    proc_root = '/proc'
+
+    def run(self, argv, **kwargs):
+        return run(argv, **kwargs)
+
+    def sys_path(self, *parts):
+        return os.path.join(self.sys_root, *parts)
+
+    def dev_path(self, *parts):
+        return os.path.join(self.dev_root, *parts)
+
+    def proc_path(self, *parts):
+        return os.path.join(self.proc_root, *parts)
+
+    def exists(self, path):
+        return os.path.exists(path)
+
+
+def get_host():
+    global _HOST
+    if _HOST is None:
+        _HOST = Host()
+    return _HOST
+
+
+def set_host(host):
+    global _HOST
+    _HOST = host
@@ -0,0 +1,139 @@
+"""
+Data path benchmark for logged in Volumes
+
+Runs sequential and random tests against every portal path of a LUN and its
+multipath device with O_DIRECT I/O into page aligned (mmap) buffers.  Queue
+depth is emulated with one thread per outstanding I/O.  Only reads are done
+unless writes are explicitly allowed, since writing destroys the data on the
+Volume.
+"""
+from __future__ import unicode_literals, print_function, division
+
+import mmap
+import os
+import random
+import threading
+import time
+
+from tabulate import tabulate
+
+from dvot.mount import by_path, find_mount
+from dvot.utils import Parallel, dprint, percentile
+
+SEQ_BS = 1024 * 1024
+RAND_BS = 4096
+HEADERS = ['device', 'test', 'bs', 'qd', 'iops', 'MB/s', 'p50 ms', 'p99 ms',
+           'max ms']
+
+
+def bench_devices(si, lun, multipath):
+    """ Returns (label, device path) of every portal path and the dm device """
+    devices = []
+    for portal in si.access['ips']:
+        path = by_path(portal, si.access['iqn'], lun)
+        if os.path.exists(path):
+            real = os.path.realpath(path)
+            devices.append(('{} ({})'.format(portal, os.path.basename(real)),
+                            real))
+    if multipath:
+        _, path, device = find_mount(si, lun, True)
+        if device and device.startswith('dm-'):
+            devices.append(('multipath ({})'.format(device),
+                            os.path.realpath(path)))
+    return devices
+
+
+def _device_size(fd):
+    size = os.lseek(fd, 0, os.SEEK_END)
+    os.lseek(fd, 0, os.SEEK_SET)
+    return size
+
+
+def run_test(path, rw, pattern, bs, qd, runtime, direct=True):
+    """
+    Runs one test for `runtime` seconds and returns a dict with iops, MB/s
+    and latency percentiles in ms, all None if no I/O completed
+    """
+    if not hasattr(os, 'preadv'):
+        raise EnvironmentError("The data path benchmark needs Python 3.7+")
+    flags = os.O_RDWR if rw == 'write' else os.O_RDONLY
+    if direct:
+        flags |= os.O_DIRECT
+    fd = os.open(path, flags)
+    try:
+        blocks = _device_size(fd) // bs
+        if not blocks:
+            raise ValueError("{} is smaller than {} bytes".format(path, bs))
+        lats = []
+        lock = threading.Lock()
+        deadline = time.time() + runtime
+
+        def _io_helper(n):
+            # mmap buffers are page aligned as O_DIRECT requires
+            buf = mmap.mmap(-1, bs)
+            if rw == 'write':
+                buf.write(os.urandom(bs))
+            rng = random.Random(n)
+            block = n * blocks // qd
+            mine = []
+            while time.time() < deadline:
+                if pattern == 'rand':
+                    block = rng.randrange(blocks)
+                else:
+                    block = (block + 1) % blocks
+                start = time.time()
+                if rw == 'write':
+                    os.pwritev(fd, [buf], block * bs)
+                else:
+                    os.preadv(fd, [buf], block * bs)
+                mine.append(time.time() - start)
+            buf.close()
+            with lock:
+                lats.extend(mine)
+        start = time.time()
+        p = Parallel([_io_helper] * qd, args_list=[(n,) for n in range(qd)],
+                     max_workers=qd)
+        p.run_threads()
+        elapsed = time.time() - start
+    finally:
+        os.close(fd)
+    row = {'test': '{} {}'.format(pattern, rw),
+           'bs': bs,
+           'qd': qd,
+           'iops': None,
+           'MB/s': None,
+           'p50 ms': None,
+           'p99 ms': None,
+           'max ms': None}
+    if not lats or elapsed <= 0:
+        dprint("No I/O completed for {} {} on {}".format(pattern, rw, path))
+        return row
+    row.update({'iops': int(len(lats) / elapsed),
+                'MB/s': round(len(lats) * bs / elapsed / 1024 / 1024, 1),
+                'p50 ms': round(percentile(lats, 50) * 1000, 3),
+                'p99 ms': round(percentile(lats, 99) * 1000, 3),
+                'max ms': round(max(lats) * 1000, 3)})
+    return row
+
+
+def run_bench(devices, qd=16, runtime=10, allow_write=False, direct=True):
+    tests = [('read', 'seq', SEQ_BS), ('read', 'rand', RAND_BS)]
+    if allow_write:
+        tests.extend([('write', 'seq', SEQ_BS), ('write', 'rand', RAND_BS)])
+    # The devices are opened in-process, not through sudo like the rest of
+    # the host commands, so check up front instead of failing on EACCES
+    mode = os.R_OK | os.W_OK if allow_write else os.R_OK
+    denied = [path for _, path in devices if not os.access(path, mode)]
+    if denied:
+        raise EnvironmentError("--bench requires root, no {} access to "
+                               "{}".format('read/write' if allow_write
+                                           else 'read', ', '.join(denied)))
+    rows = []
+    for label, path in devices:
+        for rw, pattern, bs in tests:
+            row = run_test(path, rw, pattern, bs, qd, runtime, direct)
+            row['device'] = label
+            rows.append(row)
+    print(tabulate([[row[h] for h in HEADERS] for row in rows],
+                   headers=HEADERS))
+    return rows
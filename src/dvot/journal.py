@@ -0,0 +1,72 @@
+"""
+Append-only journal of the completed steps of a multi-step run
+
+Every step that finishes (clone created, ACL set, StorageInstance available,
+target logged in, device formatted, mounted, unmounted, logged out, snapshot
+created) is appended to the journal file as one JSON line and synced to disk
+before the run moves on.  A run started with `resume` loads the journal
+first so the steps that already completed can be skipped after a cheap check
+that their result still holds.  A Journal without a path only keeps the
+steps of the current run in memory.
+"""
+from __future__ import unicode_literals, print_function, division
+
+import io
+import json
+import os
+import threading
+import time
+
+from dvot.utils import dprint
+
+
+class Journal(object):
+
+    def __init__(self, path=None, resume=False):
+        self.path = path
+        self.lock = threading.Lock()
+        self.steps = {}
+        self.f = None
+        if resume and path and os.path.exists(path):
+            self._load()
+        if path:
+            self.f = io.open(path, 'a' if resume else 'w', encoding='utf-8')
+
+    def _load(self):
+        with io.open(self.path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Last line of a run killed mid-write
+                    dprint("Skipping partial journal line:", line.strip())
+                    continue
+                entry.pop('ts', None)
+                self.steps[(entry.pop('step'), entry.pop('key'))] = entry
+        dprint("Loaded {} completed steps from journal {}".format(
+            len(self.steps), self.path))
+
+    def get(self, step, key):
+        """ Data recorded with a completed step, None if it never completed """
+        with self.lock:
+            return self.steps.get((step, key))
+
+    def done(self, step, key):
+        return self.get(step, key) is not None
+
+    def record(self, step, key, **data):
+        with self.lock:
+            self.steps[(step, key)] = data
+            if not self.f:
+                return
+            entry = dict(data, step=step, key=key,
+                         ts=round(time.time(), 3))
+            self.f.write(json.dumps(entry, sort_keys=True) + '\n')
+            self.f.flush()
+            os.fsync(self.f.fileno())
+
+    def close(self):
+        with self.lock:
+            if self.f:
+                self.f.close()
+                self.f = None
@@ -3,6 +3,7 @@
 from __future__ import unicode_literals, print_function, division
 
 import argparse
+import io
 import re
 import sys
 import textwrap
@@ -16,12 +17,42 @@ except ImportError:
 
 from dfs_sdk import scaffold
 from dfs_sdk import exceptions as dexceptions
-from dvot.utils import exe, Parallel
-from dvot.mount import mount_volumes, clean_mounts
+from dvot.utils import Parallel, start_priv_helper, stop_priv_helper, \
+    dprint
+from dvot.apicache import enable_cache, fresh
+from dvot.host import get_host
+from dvot.health import run_health
+from dvot.devices import host_inventory, print_inventory, \
+    iqn_lun_from_device
+from dvot.iobench import bench_devices, run_bench
+from dvot.mount import mount_volumes, clean_mounts, clone_and_mount, \
+    extend_online, get_initiator, setup_acl, record_mounts
+from dvot import persist
+from dvot.clones import CloneRegistry, gc_clones
+from dvot.journal import Journal
+from dvot import records
+from dvot.snapindex import SnapIndex, parse_time
+from dvot.rollback import rollback_many, rollback_remount, \
+    print_rollback_results, print_downtime
+from dvot.retention import Policy, prune_snaps
+from dvot.refresh import refresh, read_initiators, write_manifest, \
+    read_manifest, pick_clone, mount_clone
+from dvot.output import Output, MODES, to_record
+from dvot.watch import Watcher, print_event
+from dvot.fanout import connect_all, fan_out, print_merged, print_failures
+from dvot.bulk import select_targets, bulk_snap, print_bulk_results, \
+    run_bulk
 
 SUCCESS = 0
 FAILURE = 1
 MAX_WORKERS = 20
+FAN_OUT_OPS = ('list-snaps', 'find-vol', 'find-app', 'find-snap',
+               'snap-many', 'prune-snaps', 'gc-clones')
+STATE_CHANGE_FLAGS = ('placement_mode', 'repair_priority', 'make_snap',
+                      'extend', 'bench', 'rollback', 'remount', 'clean',
+                      'mount', 'login')
+# --api-cache-ttl of find and list ops that change nothing
+READ_CACHE_TTL = 5
 
 
 VOL_SNAP_RE = re.compile(
@@ -30,42 +61,12 @@ VOL_SNAP_RE = re.compile(
 AI_SNAP_RE = re.compile(r"/app_instances/(?P<ai>.*)/snapshots/(?P<ts>.*)")
 VOL_RE = re.compile(r"/app_instances/(?P<ai>.*)/storage_instances/"
                     r"(?P<si>.*)/volumes/(?P<vol>.*)")
-IQN_RE = re.compile(r"(?P<iqn>iqn.2013-\d\d\.com\.daterainc:tc:\d\d:\w\w:"
-                    r"[a-f0-9]+)-lun-(?P<lun>\d+)")
 
 
 def hf(txt):
     return textwrap.fill(txt)
 
 
-def run_health(api):
-    config = scaffold.get_config()
-    try:
-        exe('ping -c 1 -w 1 {}'.format(config['mgmt_ip']))
-    except EnvironmentError:
-        print('Could not ping mgmt_ip:', config['mgmt_ip'])
-        return False
-    try:
-        api.app_instances.list()
-    except Exception as e:
-        print("Could not connect to cluster", e)
-        return False
-    npass = True
-    av = api.system.network.access_vip.get()
-    for np in av['network_paths']:
-        ip = np.get('ip')
-        if ip:
-            try:
-                exe('ping -c 1 -w 1 {}'.format(ip))
-            except EnvironmentError:
-                print('Could not ping: {} {}'.format(np.get('name'), ip))
-                npass = False
-    if not npass:
-        return False
-    print("Health Check Completed Successfully")
-    return True
-
-
 def _find_impl(api, func, args):
     found = []
     q = queue.Queue()
@@ -114,20 +115,34 @@ def find_snap(api, ts):
     if not ts:
         raise ValueError("You must specify --id when using find-snap")
 
-    def _snap_helper(q, found):
-        while len(found) == 0:
-            ai = q.get()
-            for snap in ai.snapshots.list():
-                if snap['utc_ts'] == ts or snap['uuid'] == ts:
-                    found.append(snap)
-                    q.task_done()
+    def _match(snap):
+        return snap['utc_ts'] == ts or snap['uuid'] == ts
+
+    def _search(ai, found):
+        for snap in ai.snapshots.list():
+            if _match(snap):
+                found.append(snap)
+                return
+        for si in ai.storage_instances.list():
+            for vol in si.volumes.list():
+                # Another thread may have found it in the meantime
+                if found:
                     return
-            for si in ai.storage_instances.list():
-                for vol in si.volumes.list():
-                    for snap in vol.snapshots.list():
-                        if snap['utc_ts'] == ts or snap['uuid'] == ts:
-                            found.append(snap)
-            q.task_done()
+                for snap in vol.snapshots.list():
+                    if _match(snap):
+                        found.append(snap)
+                        return
+
+    def _snap_helper(q, found):
+        while not found:
+            try:
+                ai = q.get(block=False)
+            except queue.Empty:
+                return
+            try:
+                _search(ai, found)
+            finally:
+                q.task_done()
     found = []
     q = queue.Queue()
     for ai in api.app_instances.list():
@@ -143,6 +158,43 @@ def find_snap(api, ts):
         return found[0]
 
 
+def find_resource(api, resource):
+    """
+    Returns the AppInstance or Volume identified by an AppInstance id/name,
+    a Volume uuid/name or a Volume path
+    """
+    match = VOL_RE.match(resource)
+    if match:
+        ai = api.app_instances.get(match.group('ai'))
+        si = ai.storage_instances.get(match.group('si'))
+        return si.volumes.get(match.group('vol'))
+    try:
+        return api.app_instances.get(resource)
+    except dexceptions.ApiNotFoundError:
+        pass
+    found = find_app(api, resource, None)
+    if found:
+        return found
+    try:
+        uuid.UUID(resource)
+        return find_vol(api, None, resource)
+    except ValueError:
+        return find_vol(api, resource, None)
+
+
+def find_snap_at(api, resource, before=None, after=None, latest=False):
+    """
+    Point-in-time Snapshot lookup within a single AppInstance or Volume,
+    see SnapIndex.select
+    """
+    found = find_resource(api, resource)
+    if not found:
+        raise ValueError(
+            "No AppInstance or Volume found matching {}".format(resource))
+    index = SnapIndex(found.snapshots.list())
+    return index.select(before, after, latest)
+
+
 def find_app(api, name, oid):
     if (name and oid) or (not name and not oid):
         raise ValueError("Either --name or --id MUST be provided")
@@ -151,32 +203,45 @@ def find_app(api, name, oid):
             return ai
 
 
-def find_snaps(api, name, oid):
+def find_snaps(api, name, oid, on_snap=None):
+    """
+    Returns (AppInstance snapshots, Volume snapshots) as SnapRecords.
+    on_snap is called with each snapshot and its level ('app' or 'vol') as
+    it is found
+    """
     if (name and oid):
         raise ValueError("Only one of --name or --id can be provided")
 
+    def _found(snaps, level):
+        if on_snap:
+            for snap in snaps:
+                on_snap(snap, level)
+        return snaps
+
     def _snap_helper(ai, vid, app_snaps, vol_snaps):
         if not vid:
-            app_snaps.extend(ai.snapshots.list())
-        for si in ai.storage_instances.list():
-            for vol in si.volumes.list():
+            app_snaps.extend(_found(records.snapshots(api, ai.path), 'app'))
+        for si in records.storage_instances(api, ai):
+            for vol in records.volumes(api, si):
                 if vid:
                     if vol.uuid == vid or vol.name == vid:
-                        vol_snaps.extend(vol.snapshots.list())
+                        vol_snaps.extend(_found(
+                            records.snapshots(api, vol.path), 'vol'))
                 else:
-                    vol_snaps.extend(vol.snapshots.list())
+                    vol_snaps.extend(_found(
+                        records.snapshots(api, vol.path), 'vol'))
     oid = name if name else oid
     app_snaps, vol_snaps = [], []
     found = None
     vid = None
     if oid:
         try:
-            found = api.app_instances.get(oid)
+            found = records.AppRecord(api, api.app_instances.get(oid))
             _snap_helper(found, None, app_snaps, vol_snaps)
             return app_snaps, vol_snaps
         except dexceptions.ApiNotFoundError:
             vid = oid
-    args_list = [(ai, vid, app_snaps, vol_snaps)
+    args_list = [(records.AppRecord(api, ai), vid, app_snaps, vol_snaps)
                  for ai in api.app_instances.list()]
     funcs = [_snap_helper] * len(args_list)
     p = Parallel(funcs,
@@ -186,16 +251,17 @@ def find_snaps(api, name, oid):
     return app_snaps, vol_snaps
 
 
-def new_app_from_snap(api, snap):
-    name = 'from-snap-{}-{}'.format(snap['utc_ts'], str(uuid.uuid4())[:8])
-    print("Creating new AppInstance {} from snapshot: {}".format(
-        name, snap.path))
-    return api.app_instances.create(name=name,
-                                    clone_snapshot_src={'path': snap.path})
+def new_app_from_snap(api, snap, registry=None, new_clone=False):
+    # Without a registry every call lists the whole tenant, pass one in when
+    # cloning more than one snapshot
+    if not registry:
+        registry = CloneRegistry(api)
+    return registry.clone(snap, new=new_clone)
 
 
 def find_from_mount(api, mount, t):
-    device = exe("df -P {} | tail -1 | cut -d' ' -f 1".format(mount)).strip()
+    out = get_host().run(['df', '-P', mount]).stdout.strip().splitlines()
+    device = out[-1].split()[0] if len(out) > 1 else None
     if not device:
         print("No device found for mount:", mount)
     if t == 'ai':
@@ -206,6 +272,9 @@ def find_from_mount(api, mount, t):
 
 def find_from_device_path(api, device_path):
     iqn, lun = iqn_lun_from_device(device_path)
+    if not iqn:
+        print("No /dev/disk/by-path link found for device:", device_path)
+        return
     si = find_si(api, iqn)
     if not si:
         print("No StorageInstance found for device path", device_path)
@@ -215,6 +284,9 @@ def find_from_device_path(api, device_path):
 
 def find_ai_from_device_path(api, device_path):
     iqn, lun = iqn_lun_from_device(device_path)
+    if not iqn:
+        print("No /dev/disk/by-path link found for device:", device_path)
+        return
     si = find_si(api, iqn)
     if not si:
         print("No StorageInstance found for device path", device_path)
@@ -223,36 +295,10 @@ def find_ai_from_device_path(api, device_path):
     return api.app_instances.get(ai_uuid)
 
 
-def iqn_lun_from_device(device):
-    links = exe("udevadm info --query=symlink --name={}".format(
-        device)).split()
-    links = filter(lambda x: 'by-path' in x, links)
-    if len(links) == 0:
-        if re.search('mapper',device):
-           dmpath= exe("udevadm info --query=path --name={}".format(device))
-           dmdev = dmpath.split("/")[-1].strip()
-        elif re.search('dm',device):
-           dmdev = device.split("/")[-1]
-        else:
-           print("No /dev/disk/by-path link found for device:", device)
-           return None, None
-        slaves = exe("ls /sys/block/{}/slaves".format(dmdev))
-        slave = slaves.split()[1]
-    links = exe("udevadm info --query=symlink --name=/dev/{}".format(
-        slave)).split()
-    links = filter(lambda x: 'by-path' in x, links)
-    link = links[0]
-    match = IQN_RE.search(link)
-    if not match:
-        print("No iqn found in link:", link)
-        return None, None
-    return match.group('iqn'), int(match.group('lun'))
-
-
 def _obj_poll(obj):
     timeout = 10
     while True:
-        obj = obj.reload()
+        obj = fresh(obj)
         if obj['op_state'] == 'available':
             break
         if not timeout:
@@ -274,7 +320,7 @@ def print_snaps(app_snaps, vol_snaps):
         print(snap.path, snap.op_state)
 
 
-def print_pretty_snaps(api, app_snaps, vol_snaps):
+def print_pretty_snaps(api, app_snaps, vol_snaps, on_snap=None):
     def _psnap_helper(api, snap, results):
         path = snap.path
         match = VOL_SNAP_RE.match(path)
@@ -289,6 +335,10 @@ def print_pretty_snaps(api, app_snaps, vol_snaps):
             s = '{} -- {} -- {} -- {}'.format(
                 ai.name, si.name, vol.name, ts)
             results[1].append(s)
+            if on_snap:
+                on_snap({'level': 'vol', 'app_instance': ai.name,
+                         'storage_instance': si.name, 'volume': vol.name,
+                         'utc_ts': ts, 'path': path})
         else:
             match = AI_SNAP_RE.match(path)
             ai_id = match.group('ai')
@@ -296,6 +346,9 @@ def print_pretty_snaps(api, app_snaps, vol_snaps):
             ai = api.app_instances.get(ai_id)
             s = '{} -- {}'.format(ai.name, ts)
             results[0].append(s)
+            if on_snap:
+                on_snap({'level': 'app', 'app_instance': ai.name,
+                         'utc_ts': ts, 'path': path})
     results = [[], []]
     funcs = [_psnap_helper] * (len(app_snaps) + len(vol_snaps))
     sn = app_snaps + vol_snaps
@@ -339,6 +392,28 @@ def set_size(api, vol, size):
     vol.set(size=int(size))
 
 
+def extend_vol(api, vol, size, multipath):
+    """
+    Grows the Volume on the array and, if it is logged in on this host, the
+    device and mounted filesystem in place
+    """
+    if size != vol['size']:
+        set_size(api, vol, size)
+    si, lun = si_lun_from_vol(api, vol)
+    return extend_online(si, lun, multipath)
+
+
+def si_lun_from_vol(api, vol):
+    """ Returns the StorageInstance of a Volume and the Volume's LUN """
+    match = VOL_RE.match(vol.path)
+    if not match:
+        raise ValueError("{} is not a Volume".format(vol.path))
+    ai = api.app_instances.get(match.group('ai'))
+    si = ai.storage_instances.get(match.group('si'))
+    names = [v['name'] for v in si.volumes.list()]
+    return si, names.index(vol['name'])
+
+
 def make_snap(api, found):
     if 'storage_instances' in found:
         return found.snapshots.create()
@@ -348,18 +423,20 @@ def make_snap(api, found):
         raise ValueError("Unsupported resource for 'make-snap' operation")
 
 
-def set_rollback(api, found, snap_id):
+def rollback_snap(api, found, snap_id):
+    """ Returns the Snapshot of found (or found itself) to roll back to """
     if 'utc_ts' in found:
         snap_id = found.utc_ts
         found = get_parent_resource(api, found)
-    found_snap = None
     for snap in found.snapshots.list():
         if snap.uuid == snap_id or snap.utc_ts == snap_id:
-            found_snap = snap
-            break
-    if not found_snap:
-        raise ValueError("Invalid snapshot id for resource {}".format(
-            found.path))
+            return snap
+    raise ValueError("Invalid snapshot id for resource {}".format(
+        found.path))
+
+
+def set_rollback(api, found, snap_id):
+    snap = rollback_snap(api, found, snap_id)
     path = snap.path
     print("Restoring:", snap.path)
     match = VOL_SNAP_RE.match(path)
@@ -386,6 +463,44 @@ def set_rollback(api, found, snap_id):
         # Nothing to poll on AppInstance level snapshots
 
 
+def read_rollback_pairs(api, path):
+    """
+    Reads a file with one rollback per line, either a Snapshot path or
+    "<resource> <snapshot utc_ts/uuid or 'latest'>" where resource is
+    anything find_resource accepts.  Returns the Snapshot paths
+    """
+    snap_paths = []
+    with io.open(path) as f:
+        for line in f:
+            parts = line.split('#')[0].split()
+            if not parts:
+                continue
+            if len(parts) == 1:
+                if not (VOL_SNAP_RE.match(parts[0]) or
+                        AI_SNAP_RE.match(parts[0])):
+                    raise ValueError(
+                        "Not a snapshot path: {}".format(parts[0]))
+                snap_paths.append(parts[0])
+                continue
+            resource, snap_id = parts[:2]
+            found = find_resource(api, resource)
+            if not found:
+                raise ValueError("No AppInstance or Volume found matching "
+                                 "{}".format(resource))
+            snaps = found.snapshots.list()
+            if snap_id == 'latest':
+                snap = SnapIndex(snaps).latest()
+            else:
+                snap = next((snap for snap in snaps
+                             if snap_id in (snap['utc_ts'], snap['uuid'])),
+                            None)
+            if not snap:
+                raise ValueError("No snapshot {} for resource {}".format(
+                    snap_id, found.path))
+            snap_paths.append(snap.path)
+    return snap_paths
+
+
 def ai_from_resource(api, resource):
     return api.app_instances.get(resource.path.split('/')[2])
 
@@ -407,28 +522,349 @@ def get_parent_resource(api, resource):
         ai = api.app_instances.get(ai_id)
         si = ai.storage_instances.get(si_id)
         return si
-    return ai_from_resource(resource)
+    return ai_from_resource(api, resource)
 
 
 def main(args):
-    api = scaffold.get_api()
+    out = Output(args.output)
+    stdout = sys.stdout
+    # Keep stdout for the records only
+    if out.machine:
+        sys.stdout = sys.stderr
+    if args.priv_helper:
+        start_priv_helper()
+    try:
+        return _main(args, out)
+    finally:
+        stop_priv_helper()
+        sys.stdout = stdout
+        out.close()
+
+
+def _cache_ttl(args):
+    """
+    --api-cache-ttl if given, otherwise the cache is only on for find and
+    list ops without state changing options, where no read follows a write
+    """
+    if args.api_cache_ttl is not None:
+        return args.api_cache_ttl
+    if (args.op.startswith(('find-', 'list-')) and
+            not any(getattr(args, flag) for flag in STATE_CHANGE_FLAGS)):
+        return READ_CACHE_TTL
+    return 0
+
+
+def _main(args, out):
+    if args.resume and not args.journal:
+        raise ValueError("--resume requires --journal")
+    if args.cluster_config or args.all_tenants:
+        return _fan_out_op(args, out)
+    if args.op == 'mount-manifest':
+        return _mount_manifest(args, out)
+    if args.op == 'restore-mounts':
+        out.emit_all(persist.restore_mounts(
+            not args.no_multipath, args.mount_workers, args.mount_state))
+        return SUCCESS
+    api = scaffold.get_api(disable_log=args.no_sdk_log)
     print('Using Config:')
     scaffold.print_config()
+    journal = Journal(args.journal, args.resume)
+    cache = None
+    ttl = _cache_ttl(args)
+    if ttl > 0:
+        cache = enable_cache(api, ttl)
+    try:
+        return _run_op(api, args, out, journal)
+    finally:
+        journal.close()
+        if cache:
+            dprint("API response cache: {}".format(cache.stats()))
+
+
+def _fan_out_op(args, out):
+    """
+    Runs a find, list or bulk operation against every --cluster-config
+    cluster and, with --all-tenants, every tenant of each, and prints the
+    merged results
+    """
+    if args.op not in FAN_OUT_OPS:
+        raise ValueError("{} is not supported with --cluster-config or "
+                         "--all-tenants, supported operations: {}".format(
+                             args.op, ', '.join(FAN_OUT_OPS)))
+    if any(getattr(args, flag) for flag in STATE_CHANGE_FLAGS):
+        raise ValueError("State changing options are not supported with "
+                         "--cluster-config or --all-tenants")
+    if args.journal:
+        raise ValueError("--journal is not supported with --cluster-config "
+                         "or --all-tenants")
+    if args.op == 'find-snap' and args.resource:
+        raise ValueError("find-snap --resource is not supported with "
+                         "--cluster-config or --all-tenants")
+    targets = connect_all(args.cluster_config, args.all_tenants, args.workers,
+                          args.no_sdk_log)
+    ttl = _cache_ttl(args)
+    if ttl > 0:
+        for target in targets:
+            enable_cache(target['api'], ttl)
+    records = []
+    lock = threading.Lock()
+
+    def _emitter(target):
+        def _emit(obj, **extra):
+            record = to_record(obj)
+            record.update(extra, cluster=target['cluster'],
+                          tenant=target['tenant'])
+            with lock:
+                records.append(record)
+            out.emit(record)
+        return _emit
+
+    def _find(target):
+        api, emit = target['api'], _emitter(target)
+        if args.op == 'find-vol':
+            found = find_vol(api, args.name, args.id)
+        elif args.op == 'find-app':
+            found = find_app(api, args.name, args.id)
+        else:
+            found = find_snap(api, args.id)
+        if found:
+            emit(found)
+        return bool(found)
+
+    def _list(target):
+        emit = _emitter(target)
+        find_snaps(target['api'], args.name, args.id,
+                   lambda snap, level: emit(snap, level=level))
+
+    def _bulk(target):
+        api, emit = target['api'], _emitter(target)
+        if args.op == 'snap-many':
+            found = select_targets(api, args.snap_level, args.name_re,
+                                   args.id_file, args.all, args.workers)
+            return bulk_snap(api, found, args.workers, args.rate, args.wait,
+                             args.wait_timeout, emit)
+        elif args.op == 'prune-snaps':
+            policy = Policy(args.keep_last, args.keep_hourly,
+                            args.keep_daily, args.keep_weekly)
+            results = prune_snaps(api, policy, args.name_re, args.dry_run,
+                                  args.workers, args.rate, emit)
+        else:
+            older_than = None
+            if args.older_than is not None:
+                older_than = args.older_than * 3600
+            results = gc_clones(api, older_than, args.unattached,
+                                args.dry_run, args.workers, args.rate, emit,
+                                args.force)
+        if args.dry_run:
+            # Plans don't go through on_result
+            for result in results:
+                emit(result)
+        return results
+
+    if args.op.startswith('find-'):
+        func, columns = _find, ['path', 'name', 'utc_ts']
+    elif args.op == 'list-snaps':
+        func, columns = _list, ['level', 'path', 'op_state']
+    else:
+        func, columns = _bulk, ['target', 'ok', 'latency_s', 'error']
+    results = fan_out(targets, func, args.workers)
+    records.sort(key=lambda r: (r['cluster'], r['tenant'],
+                                r.get('path') or r.get('target')))
+    print_merged(records, columns)
+    print_failures(results)
+    if args.op.startswith('find-'):
+        if any(r['result'] for r in results):
+            return SUCCESS
+        return FAILURE
+    if all(r['ok'] for r in results) and all(r.get('ok', True)
+                                             for r in records):
+        return SUCCESS
+    return FAILURE
+
+
+def _mount_manifest(args, out):
+    """
+    Logs into and mounts this host's clone from a refresh manifest.  The API
+    is only used when refresh was not given this host's initiator
+    """
+    if not args.manifest:
+        raise ValueError("mount-manifest requires --manifest")
+    manifest = read_manifest(args.manifest)
+    if args.slot is not None:
+        entry = pick_clone(manifest, slot=args.slot)
+    else:
+        entry = pick_clone(manifest, initiator=get_initiator())
+    print("Mounting clone {} of {}".format(entry['name'],
+                                           manifest['snapshot']))
+    if not entry['initiator']:
+        api = scaffold.get_api(disable_log=args.no_sdk_log)
+        setup_acl(api, api.app_instances.get(entry['id']))
+    entries = mount_clone(entry, not args.no_multipath, args.directory,
+                          args.login, args.mount_workers, args.fstype,
+                          args.fsargs)
+    if args.persist:
+        persist.persist_mounts(entries, args.persist, not args.no_multipath,
+                               args.mount_state)
+    out.emit_all(entries, clone=entry['name'])
+    return SUCCESS
+
+
+def watch(api, args, out):
+    """
+    Watches the AppInstances selected by --name-re/--id-file, --name/--id
+    or the whole tenant, printing and emitting each state change
+    """
+    ai_ids = None
+    if args.name_re or args.id_file:
+        ai_ids = [ai['id'] for ai in select_targets(
+            api, 'app', args.name_re, args.id_file, workers=args.workers)]
+    elif args.name or args.id:
+        ai = find_app(api, args.name, args.id)
+        if not ai:
+            print("No AppInstance found matching name {} or id {}".format(
+                args.name, args.id))
+            return FAILURE
+        ai_ids = [ai['id']]
+
+    def _on_event(event):
+        print_event(event)
+        out.emit(event)
+    watcher = Watcher(api, ai_ids, _on_event, args.interval,
+                      args.max_interval, args.workers)
+    print("Watching {}".format(
+        "{} AppInstances".format(len(ai_ids)) if ai_ids is not None
+        else "the tenant"))
+    try:
+        settled = watcher.run(args.settle,
+                              args.wait_timeout if args.settle else None)
+    except KeyboardInterrupt:
+        return SUCCESS
+    finally:
+        print("{} API requests".format(watcher.requests))
+    if settled:
+        return SUCCESS
+    print("Still in flight after {}s:".format(args.wait_timeout))
+    for path in watcher.pending():
+        print(path)
+    return FAILURE
 
+
+def _run_op(api, args, out, journal):
     found = None
 
     # LIST/HEALTH OPERATIONS
     if args.op == 'health-check':
-        run_health(api)
-        return SUCCESS
+        if run_health(api, args.samples, args.watch, out.emit):
+            return SUCCESS
+        return FAILURE
     elif args.op == 'list-snaps':
-        app_snaps, vol_snaps = find_snaps(api, args.name, args.id)
+        app_snaps, vol_snaps = find_snaps(
+            api, args.name, args.id,
+            lambda snap, level: out.emit(snap, level=level))
         print_snaps(app_snaps, vol_snaps)
         return SUCCESS
     elif args.op == 'list-snaps-pretty':
         app_snaps, vol_snaps = find_snaps(api, args.name, args.id)
-        print_pretty_snaps(api, app_snaps, vol_snaps)
+        print_pretty_snaps(api, app_snaps, vol_snaps, out.emit)
         return SUCCESS
+    elif args.op == 'host-inventory':
+        entries = host_inventory(api)
+        print_inventory(entries)
+        out.emit_all(entries)
+        return SUCCESS
+    elif args.op == 'watch':
+        return watch(api, args, out)
+
+    # BULK OPERATIONS
+    elif args.op == 'snap-many':
+        targets = select_targets(api, args.snap_level, args.name_re,
+                                 args.id_file, args.all, args.workers)
+        print("Snapshotting {} targets".format(len(targets)))
+        results = bulk_snap(api, targets, args.workers, args.rate,
+                            args.wait, args.wait_timeout, out.emit, journal)
+        print_bulk_results(results, 'snapshot')
+        if all(r['ok'] for r in results):
+            return SUCCESS
+        return FAILURE
+    elif args.op == 'prune-snaps':
+        policy = Policy(args.keep_last, args.keep_hourly, args.keep_daily,
+                        args.keep_weekly)
+        results = prune_snaps(api, policy, args.name_re, args.dry_run,
+                              args.workers, args.rate, out.emit)
+        if args.dry_run:
+            out.emit_all(results)
+            return SUCCESS
+        print_bulk_results(results)
+        if all(r['ok'] for r in results):
+            return SUCCESS
+        return FAILURE
+    elif args.op == 'extend-many':
+        if not args.extend:
+            raise ValueError("extend-many requires --extend")
+        targets = select_targets(api, 'vol', args.name_re, args.id_file,
+                                 args.all, args.workers)
+        print("Extending {} volumes to {}GB".format(len(targets),
+                                                    args.extend))
+
+        def _extend(vol):
+            return {'grown': extend_vol(api, vol, args.extend,
+                                        not args.no_multipath)}
+        results = run_bulk(_extend, targets, args.workers, args.rate,
+                           on_result=out.emit)
+        print_bulk_results(results, 'grown')
+        if all(r['ok'] for r in results):
+            return SUCCESS
+        return FAILURE
+    elif args.op == 'rollback-many':
+        if not args.pairs_file:
+            raise ValueError("rollback-many requires --pairs-file")
+        snap_paths = read_rollback_pairs(api, args.pairs_file)
+        if args.remount:
+            results, entries = rollback_remount(
+                api, snap_paths, not args.no_multipath, args.workers,
+                args.wait_timeout)
+        else:
+            results, entries = rollback_many(
+                api, snap_paths, args.workers, args.wait_timeout), []
+        out.emit_all(results)
+        print_rollback_results(results)
+        print_downtime(entries)
+        if all(r['ok'] for r in results):
+            return SUCCESS
+        return FAILURE
+    elif args.op == 'refresh':
+        if not args.manifest:
+            raise ValueError("refresh requires --manifest")
+        ai = find_app(api, args.name, args.id)
+        if not ai:
+            print("No AppInstance found matching name {} or id {}".format(
+                args.name, args.id))
+            return FAILURE
+        initiators = None
+        count = args.clones
+        if args.initiator_file:
+            initiators = read_initiators(args.initiator_file)
+            count = count or len(initiators)
+        manifest = refresh(api, ai, count, initiators, args.clone_workers,
+                           args.wait_timeout)
+        write_manifest(args.manifest, manifest)
+        print("Wrote manifest of {} clones of {} to {}".format(
+            count, manifest['snapshot'], args.manifest))
+        out.emit_all(manifest['clones'], snapshot=manifest['snapshot'])
+        return SUCCESS
+    elif args.op == 'gc-clones':
+        older_than = None
+        if args.older_than is not None:
+            older_than = args.older_than * 3600
+        results = gc_clones(api, older_than, args.unattached, args.dry_run,
+                            args.workers, args.rate, out.emit, args.force)
+        if args.dry_run:
+            out.emit_all(results)
+            return SUCCESS
+        print_bulk_results(results)
+        if all(r['ok'] for r in results):
+            return SUCCESS
+        return FAILURE
 
     # FIND RESOURCE
     elif args.op == 'find-vol':
@@ -450,10 +886,25 @@ def main(args):
                 args.name, args.id))
             return FAILURE
     elif args.op == 'find-snap':
-        found = find_snap(api, args.id)
+        if args.before or args.after or args.latest:
+            if not args.resource:
+                raise ValueError("--before, --after and --latest require "
+                                 "--resource")
+            found = find_snap_at(
+                api, args.resource,
+                parse_time(args.before) if args.before else None,
+                parse_time(args.after) if args.after else None,
+                args.latest)
+        else:
+            found = find_snap(api, args.id)
         if found:
-            print("Found Snapshot:", args.id)
+            print("Found Snapshot:", found['utc_ts'])
             print("=============")
+        elif args.resource:
+            print("No Snapshot of {} found matching before {} after {} "
+                  "latest {}".format(args.resource, args.before, args.after,
+                                     args.latest))
+            return FAILURE
         else:
             print("No Snapshot found matching name {} or id {}".format(
                 args.name, args.id))
@@ -484,6 +935,7 @@ def main(args):
         print("============")
 
     print(found)
+    out.emit(found)
 
     # CHANGE STATE OF FOUND RESOURCE
     if args.placement_mode:
@@ -499,10 +951,35 @@ def main(args):
     if args.make_snap:
         snap = make_snap(api, found)
         print("Created snapshot:", snap.path)
+        out.emit(snap)
 
     if args.extend:
-        set_size(api, found, args.extend)
-        print("Extended volume: %s", found.path)
+        grown = extend_vol(api, found, args.extend, not args.no_multipath)
+        print("Extended volume:", found.path)
+        if grown:
+            print("Grew online:", grown)
+
+    if args.bench:
+        si, lun = si_lun_from_vol(api, found)
+        devices = bench_devices(si, lun, not args.no_multipath)
+        if not devices:
+            raise EnvironmentError(
+                "{} is not logged in on this host, use --login first".format(
+                    found.path))
+        out.emit_all(run_bench(devices, args.bench_qd, args.bench_runtime,
+                               args.bench_allow_write))
+
+    if args.rollback and args.remount:
+        snap = rollback_snap(api, found, args.rollback)
+        results, entries = rollback_remount(
+            api, [snap.path], not args.no_multipath, args.workers,
+            args.wait_timeout)
+        out.emit_all(results)
+        print_rollback_results(results)
+        print_downtime(entries)
+        if all(r['ok'] for r in results):
+            return SUCCESS
+        return FAILURE
 
     if args.rollback:
         set_rollback(api, found, args.rollback)
@@ -521,25 +998,61 @@ def main(args):
             ai = ai_from_resource(api, found)
         else:
             print("Can't clean mounts for snapshot resources")
-        clean_mounts(api, [ai], args.directory, 1)
+        out.emit_all(clean_mounts(api, [ai], args.directory, 1, journal))
+        # A remount brings the same stable devices back on the same folders,
+        # so its persisted entries stay valid
+        if args.clean:
+            persist.forget_mounts([ai['id']], args.mount_state)
 
     # HANDLE LOGIN/MOUNT/REMOUNT
     if (args.mount or args.login) and found:
         ais = []
-        # Mount snapshot objects by creating a new AppInstance first
+        cloned = []
+        registry = CloneRegistry(api)
+
+        def _clone(api, snap):
+            # A clone created by the run being resumed is reused if it
+            # still exists
+            ai = None
+            ai_id = (journal.get('cloned', snap.path) or {}).get('ai_id')
+            if ai_id:
+                try:
+                    ai = api.app_instances.get(ai_id)
+                    print("Resuming with AppInstance {} cloned from "
+                          "snapshot: {}".format(ai['name'], snap.path))
+                except dexceptions.ApiNotFoundError:
+                    dprint("Journaled clone {} is gone".format(ai_id))
+            if not ai:
+                ai = new_app_from_snap(api, snap, registry, args.new_clone)
+                journal.record('cloned', snap.path, ai_id=ai['id'])
+            cloned.append(ai)
+            return ai
+
+        def _persist(ais):
+            if args.persist and args.mount:
+                persist.persist_mounts(
+                    record_mounts(ais, not args.no_multipath), args.persist,
+                    not args.no_multipath, args.mount_state)
+        # Mount snapshot objects by cloning them into an AppInstance first
         if hasattr(found, 'utc_ts'):
-            ai = new_app_from_snap(api, found)
+            ai = _clone(api, found)
             ais.append(ai)
         else:
             ai = ai_from_resource(api, found)
             if args.all_snaps:
                 app_snaps, vol_snaps = find_snaps(api, None, ai.id)
-                for snap in app_snaps + vol_snaps:
-                    ais.append(new_app_from_snap(api, snap))
-            else:
-                ais.append(ai)
-        mount_volumes(api, ais, not args.no_multipath, args.fstype,
-                      args.fsargs, args.directory, 1, args.login)
+                out.emit_all(clone_and_mount(
+                    api, app_snaps + vol_snaps, _clone,
+                    not args.no_multipath, args.fstype, args.fsargs,
+                    args.directory, args.clone_workers, args.mount_workers,
+                    args.login, journal))
+                _persist(cloned)
+                return SUCCESS
+            ais.append(ai)
+        out.emit_all(mount_volumes(api, ais, not args.no_multipath,
+                                   args.fstype, args.fsargs, args.directory,
+                                   1, args.login, journal))
+        _persist(ais)
     return SUCCESS
 
 
@@ -549,7 +1062,8 @@ if __name__ == '__main__':
         parents=[tparser], formatter_class=argparse.RawTextHelpFormatter)
     op_help = """Operation to perform
 * health-check
-    basic health check to ensure everything is functional
+    checks API access and probes every network path concurrently (ICMP,
+    iSCSI and API TCP ports) reporting loss and RTTs
 * list-snaps
     list all Snapshots available to the current tenant
 * list-snaps-pretty
@@ -564,6 +1078,37 @@ if __name__ == '__main__':
     same as find-from-mount but with device-path
 * find-ai-from-mount
 * find-ai-from-device-path
+* host-inventory
+    list every Datera device on this host with its mount, multipath
+    device, AppInstance, StorageInstance and Volume
+* snap-many
+    snapshot every AppInstance/Volume selected by --name-re, --id-file
+    or --all concurrently
+* gc-clones
+    delete dvot clone AppInstances older than --older-than hours or with
+    no connected initiators (--unattached).  Attached clones only with
+    --force
+* prune-snaps
+    delete Snapshots not kept by the --keep-* retention rules, optionally
+    only in AppInstances matching --name-re
+* rollback-many
+    roll back every resource/Snapshot pair in --pairs-file with one shared
+    offline window
+* extend-many
+    grow every Volume selected by --name-re, --id-file or --all to --extend
+    GB, growing logged in devices and mounted filesystems online
+* refresh
+    snapshot the AppInstance given by --name/--id once, create --clones
+    clones of it concurrently and write their targets to --manifest
+* mount-manifest
+    log into and mount this host's clone from a refresh --manifest
+* restore-mounts
+    log into and mount everything recorded with --persist, eg. at boot,
+    without any API lookups
+* watch
+    print op_state/admin_state changes of the AppInstances selected by
+    --name-re, --id-file, --name or --id (or the whole tenant) and their
+    StorageInstances, Volumes and Snapshots as they happen
     """
     parser.add_argument('op', choices=('health-check',
                                        'list-snaps',
@@ -574,11 +1119,67 @@ if __name__ == '__main__':
                                        'find-from-mount',
                                        'find-from-device-path',
                                        'find-ai-from-mount',
-                                       'find-ai-from-device-path'
+                                       'find-ai-from-device-path',
+                                       'host-inventory',
+                                       'snap-many',
+                                       'gc-clones',
+                                       'prune-snaps',
+                                       'rollback-many',
+                                       'extend-many',
+                                       'refresh',
+                                       'mount-manifest',
+                                       'restore-mounts',
+                                       'watch'
                                        ), help=op_help)
+    parser.add_argument('--no-sdk-log', action='store_true',
+                        help=hf('Don\'t let the Datera SDK write its '
+                                'dsdk_*.log files to the current directory'))
+    parser.add_argument('--output', choices=MODES, default='text',
+                        help=hf('Result format.  json, ndjson and table '
+                                'write only the result records to stdout '
+                                'and all other messages to stderr, ndjson '
+                                'streams records as they are produced'))
+    parser.add_argument('--api-cache-ttl', type=float,
+                        help=hf('Serve repeated API reads of the same object '
+                                'from memory for this many seconds, writes '
+                                'invalidate the affected objects.  Off (0) '
+                                'by default, {}s for find and list '
+                                'operations that change nothing'.format(
+                                    READ_CACHE_TTL)))
+    parser.add_argument('--samples', type=int, default=3,
+                        help='Samples per probe for health-check')
+    parser.add_argument('--watch', type=float, default=0,
+                        help=hf('Repeat health-check every WATCH seconds '
+                                'until interrupted'))
+    parser.add_argument('--interval', type=float, default=1,
+                        help=hf('watch: seconds between polls while '
+                                'something is in flight'))
+    parser.add_argument('--max-interval', type=float, default=30,
+                        help=hf('watch: longest poll interval when nothing '
+                                'changes, every watched AppInstance is read '
+                                'at least this often'))
+    parser.add_argument('--settle', action='store_true',
+                        help=hf('watch: exit once no watched object is in '
+                                'flight (degraded objects and the contents '
+                                'of offline AppInstances are not), failing '
+                                'after --wait-timeout'))
     parser.add_argument('--name')
     parser.add_argument('--id')
     parser.add_argument('--path')
+    parser.add_argument('--resource',
+                        help=hf('AppInstance id/name, Volume uuid/name or '
+                                'Volume path whose Snapshots are searched by '
+                                'find-snap --before/--after/--latest'))
+    parser.add_argument('--before',
+                        help=hf('find-snap: newest Snapshot at or before this '
+                                'time (epoch seconds or UTC '
+                                'YYYY-MM-DDTHH:MM:SS)'))
+    parser.add_argument('--after',
+                        help=hf('find-snap: oldest Snapshot at or after this '
+                                'time.  With --before, the newest Snapshot '
+                                'between the two'))
+    parser.add_argument('--latest', action='store_true',
+                        help='find-snap: newest Snapshot of --resource')
     parser.add_argument('--placement-mode', choices=[
         'hybrid', 'all_flash', 'single_flash'])
     parser.add_argument('--repair-priority', choices=[
@@ -593,26 +1194,104 @@ if __name__ == '__main__':
     parser.add_argument('--unmount', action='store_true',
                         help='Unmount volumes only.  Does not delete volume')
     parser.add_argument('--remount', action='store_true',
-                        help='Remount volume, useful for when running an '
-                             'or rollback operation')
+                        help=hf('Remount volume.  With --rollback or '
+                                'rollback-many only the affected targets are '
+                                'unmounted and logged out, rolled back, then '
+                                'logged back in and remounted in parallel and '
+                                'the downtime is reported'))
     parser.add_argument('--clean', action='store_true',
-                        help='Deletes volumes (implies --unmount and '
-                             '--logout)')
+                        help='Unmounts and logs out volumes (implies '
+                             '--unmount and --logout).  Use gc-clones to '
+                             'delete snapshot clones')
     parser.add_argument('--fstype', default='xfs',
                         help='Filesystem to use when formatting devices')
     parser.add_argument('--fsargs', default='',
                         help=hf('Extra args to give formatter, eg "-E '
                                 'lazy_table_init=1".  Make sure fstype matches'
                                 ' the args you are passing in'))
-    parser.add_argument('--extend', default=0,
-                        help='Used with the "extend" action to specify new '
-                             'size for volume')
+    parser.add_argument('--extend', type=int, default=0,
+                        help=hf('New size in GB for the found Volume (or '
+                                'extend-many Volumes).  Logged in devices '
+                                'and mounted filesystems are grown online'))
     parser.add_argument('--rollback', nargs='?', const='None',
                         help='Id or UUID of snapshot to use for rollback'
                              ' if used with "find-snap" --rollback can be '
                              'empty')
+    parser.add_argument('--pairs-file',
+                        help=hf('rollback-many: file with one Snapshot path '
+                                'or "<resource> <snapshot-id|latest>" per '
+                                'line'))
     parser.add_argument('--make-snap', action='store_true',
                         help="Make a snapshot of the found resource")
+    parser.add_argument('--name-re',
+                        help=hf('Regex selecting targets by name (snap-many, '
+                                'extend-many, prune-snaps, watch)'))
+    parser.add_argument('--id-file',
+                        help=hf('File with one AppInstance id/Volume uuid '
+                                'per line selecting targets (snap-many, '
+                                'extend-many, watch)'))
+    parser.add_argument('--all', action='store_true',
+                        help=hf('Select every target in the tenant '
+                                '(snap-many, extend-many)'))
+    parser.add_argument('--snap-level', choices=('app', 'vol'),
+                        default='app',
+                        help='Snapshot AppInstances or Volumes (snap-many)')
+    parser.add_argument('--cluster-config', action='append',
+                        help=hf('Run the operation against the cluster in '
+                                'this config file.  Repeat for several '
+                                'clusters, they are all queried '
+                                'concurrently and the results merged.  '
+                                'Supported by: ' + ', '.join(FAN_OUT_OPS)))
+    parser.add_argument('--all-tenants', action='store_true',
+                        help=hf('Run the operation against the root tenant '
+                                'and every subtenant concurrently'))
+    parser.add_argument('--workers', type=int, default=MAX_WORKERS,
+                        help='Max concurrent API operations for bulk ops')
+    parser.add_argument('--rate', type=float, default=0,
+                        help=hf('Max bulk operations started per second, '
+                                '0 for no limit'))
+    parser.add_argument('--wait', action='store_true',
+                        help=hf('Wait for each created snapshot to reach '
+                                'op_state "available"'))
+    parser.add_argument('--wait-timeout', type=int, default=300,
+                        help=hf('Seconds to wait with --wait, for '
+                                'rollback-many to bring resources back or '
+                                'for watch --settle'))
+    parser.add_argument('--older-than', type=float,
+                        help=hf('Select clones created more than this many '
+                                'hours ago (gc-clones)'))
+    parser.add_argument('--unattached', action='store_true',
+                        help=hf('Select clones with no connected initiators '
+                                '(gc-clones)'))
+    parser.add_argument('--force', action='store_true',
+                        help=hf('Also delete clones selected by '
+                                '--older-than that still have connected '
+                                'initiators (gc-clones)'))
+    parser.add_argument('--keep-last', type=int, default=0,
+                        help='Snapshots per parent always kept (prune-snaps)')
+    parser.add_argument('--keep-hourly', type=int, default=0,
+                        help='Hourly Snapshots kept (prune-snaps)')
+    parser.add_argument('--keep-daily', type=int, default=0,
+                        help='Daily Snapshots kept (prune-snaps)')
+    parser.add_argument('--keep-weekly', type=int, default=0,
+                        help='Weekly Snapshots kept (prune-snaps)')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='List what would be deleted without deleting')
+    parser.add_argument('--bench', action='store_true',
+                        help=hf('Benchmark the found (logged in) Volume on '
+                                'every portal path and its multipath device.  '
+                                'Read only unless --bench-allow-write'))
+    parser.add_argument('--bench-qd', type=int, default=16,
+                        help='Queue depth for --bench')
+    parser.add_argument('--bench-runtime', type=float, default=10,
+                        help='Seconds per --bench test')
+    parser.add_argument('--bench-allow-write', action='store_true',
+                        help=hf('Also run write tests with --bench.  THIS '
+                                'DESTROYS THE DATA ON THE VOLUME'))
+    parser.add_argument('--priv-helper', action='store_true',
+                        help=hf('Run privileged commands through a single '
+                                'persistent sudo helper process instead of '
+                                'invoking sudo once per command'))
     parser.add_argument('--directory', default='/mnt',
                         help='Directory under which to mount devices')
     parser.add_argument('--all-snaps', action='store_true',
@@ -622,6 +1301,52 @@ if __name__ == '__main__':
                                 'single-Volume\'s snapshots mounted, that '
                                 'Volume needs to be in an AppInstance by '
                                 'itself'))
+    parser.add_argument('--clones', type=int, default=0,
+                        help=hf('Number of clones created by refresh, '
+                                'defaults to one per --initiator-file line'))
+    parser.add_argument('--initiator-file',
+                        help=hf('refresh: file with one initiator IQN per '
+                                'line, clone N is made accessible to the '
+                                'initiator on line N'))
+    parser.add_argument('--manifest',
+                        help=hf('Clone manifest written by refresh and read '
+                                'by mount-manifest'))
+    parser.add_argument('--slot', type=int,
+                        help=hf('mount-manifest: mount clone number SLOT '
+                                'instead of the clone assigned to this '
+                                'host\'s initiator'))
+    parser.add_argument('--persist', choices=persist.MODES,
+                        help=hf('With --mount or mount-manifest, record the '
+                                'mounts in --mount-state and add a _netdev '
+                                'fstab line or a systemd mount unit for each '
+                                'so they survive reboots'))
+    parser.add_argument('--mount-state', default=persist.STATE_FILE,
+                        help=hf('State file of the --persist mounts, read '
+                                'by restore-mounts'))
+    parser.add_argument('--journal',
+                        help=hf('Append every completed step of --mount, '
+                                '--login, --clean, --remount and snap-many '
+                                '(clone created, ACL set, logged in, '
+                                'formatted, mounted, unmounted, logged out, '
+                                'snapshot created) to this file'))
+    parser.add_argument('--resume', action='store_true',
+                        help=hf('Skip the steps already completed in '
+                                '--journal by an earlier, interrupted run '
+                                'after checking they still hold'))
+    parser.add_argument('--new-clone', action='store_true',
+                        help=hf('When mounting snapshots always create a new '
+                                'AppInstance instead of reusing an idle clone '
+                                'of the same snapshot.  Clones dvot mounted '
+                                'are never reused, but writes made through a '
+                                '--login only session are not tracked'))
+    parser.add_argument('--clone-workers', type=int, default=10,
+                        help=hf('For use with --all-snaps and refresh.  Max '
+                                'concurrent AppInstance creations from '
+                                'snapshots'))
+    parser.add_argument('--mount-workers', type=int, default=4,
+                        help=hf('For use with --all-snaps and '
+                                'mount-manifest.  Max concurrent ACL '
+                                'setup/login/mount operations on this host'))
 
     args = parser.parse_args()
     sys.exit(main(args))
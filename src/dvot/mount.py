@@ -1,31 +1,113 @@
 from __future__ import unicode_literals, print_function, division
 
 import glob
+import io
 import os
+import shlex
+import sys
+import threading
 import time
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 from dfs_sdk import exceptions as dat_exceptions
-from dvot.utils import Parallel, exe, dprint, locker
+from six import reraise as raise_
+from dvot.apicache import fresh
+from dvot.clones import mark_used
+from dvot.host import get_host
+from dvot.journal import Journal
+from dvot.utils import Parallel, dprint, locker, CmdError
 
 DEV_TEMPLATE = "/dev/disk/by-path/ip-{ip}:3260-iscsi-{iqn}-lun-{lun}"
+BY_PATH_TEMPLATE = "ip-{ip}:3260-iscsi-{iqn}-lun-{lun}"
+# iscsiadm exit status for "session already exists"
+ISCSI_ERR_SESS_EXISTS = 15
+ISCSI_TIMEOUT = 30
+MKFS_TIMEOUT = 600
+# Seconds to wait for device links to appear/disappear
+LINK_TIMEOUT = 10
 
 
 def mount_volumes(api, ais, multipath, fs, fsargs, directory, workers,
-                  login_only):
+                  login_only, journal=None):
+    """
+    Logs into (and unless login_only mounts) every Volume of ais.  Returns
+    an entry per LUN with its target, device and mount point
+    """
+    journal = journal or Journal()
     funcs, args = [], []
     results = []
     for ai in ais:
         funcs.append(_mount_volume)
         args.append((api, ai, multipath, fs, fsargs, directory, login_only,
-                     results))
+                     results, journal))
     if funcs:
         p = Parallel(funcs, args_list=args, max_workers=workers)
         p.run_threads()
     return results
 
 
-def clean_mounts(api, ais, directory, workers):
+def clone_and_mount(api, snaps, clone_func, multipath, fs, fsargs, directory,
+                    clone_workers, mount_workers, login_only, journal=None):
+    """
+    Creates an AppInstance from every snapshot with clone_func(api, snap) and
+    mounts each one as soon as it exists instead of waiting for every clone
+    to be created first.  Clone creation and host-side ACL/login/mount have
+    separate worker limits.  Returns the entries of mount_volumes
+    """
+    journal = journal or Journal()
+    ready = queue.Queue()
+    results = []
+    errors = []
+
+    def _clone_helper(snap):
+        ready.put(clone_func(api, snap))
+
+    def _mount_helper():
+        while True:
+            ai = ready.get()
+            if ai is None:
+                return
+            try:
+                _mount_volume(api, ai, multipath, fs, fsargs, directory,
+                              login_only, results, journal)
+            except Exception as e:
+                dprint("Failed to mount {}: {}".format(ai.name, e))
+                errors.append(sys.exc_info())
+
+    mounters = []
+    for _ in range(max(mount_workers, 1)):
+        thread = threading.Thread(target=_mount_helper)
+        thread.daemon = True
+        thread.start()
+        mounters.append(thread)
+    try:
+        if snaps:
+            p = Parallel([_clone_helper] * len(snaps),
+                         args_list=[(snap,) for snap in snaps],
+                         max_workers=max(min(clone_workers, len(snaps)), 1))
+            p.run_threads()
+    finally:
+        # Let the mounters drain whatever was cloned before stopping them
+        for _ in mounters:
+            ready.put(None)
+        for thread in mounters:
+            thread.join()
+    if errors:
+        raise_(*errors[0])
+    return results
+
+
+def clean_mounts(api, ais, directory, workers, journal=None):
+    """
+    Unmounts and logs out of every Volume of ais.  Returns an entry per
+    Volume recording whether it was unmounted and its target logged out
+    """
+    journal = journal or Journal()
     funcs, args = [], []
+    results = []
     for ai in ais:
         for si in ai.storage_instances.list():
             iqn = si.access.get('iqn')
@@ -36,23 +118,58 @@ def clean_mounts(api, ais, directory, workers):
                     ai.name, si.name))
                 continue
             portals = si.access['ips']
-            for vol in si.volumes.list():
-                _unmount(ai.name, si.name, vol.name, directory)
-            funcs.append(_logout)
-            args.append((iqn, portals))
+            for lun, vol in enumerate(si.volumes.list()):
+                folder = get_dirname(directory, ai.name, si.name, vol.name)
+                entry = {'ai_id': ai['id'],
+                         'ai': ai.name,
+                         'si': si.name,
+                         'vol': vol.name,
+                         'iqn': iqn,
+                         'lun': lun,
+                         'mount': folder,
+                         'unmounted': False,
+                         'logged_out': False}
+                results.append(entry)
+                if journal.done('unmounted', folder) and not _mounted(folder):
+                    dprint("Already unmounted:", folder)
+                    entry['unmounted'] = True
+                    continue
+                if _unmount(ai.name, si.name, vol.name, directory):
+                    journal.record('unmounted', folder)
+                    entry['unmounted'] = True
+            if journal.done('logged_out', iqn) and not _target_links(iqn):
+                dprint("Already logged out:", iqn)
+                continue
+            funcs.append(_journaled_logout)
+            args.append((iqn, portals, journal))
     if funcs:
         p = Parallel(funcs, args_list=args)
         p.run_threads()
+    for entry in results:
+        entry['logged_out'] = journal.done('logged_out', entry['iqn'])
+    return results
+
+
+def _journaled_logout(iqn, portals, journal):
+    _logout(iqn, portals)
+    journal.record('logged_out', iqn)
 
 
 def _unmount(ai_name, si_name, vol_name, directory):
+    host = get_host()
     folder = get_dirname(directory, ai_name, si_name, vol_name)
     try:
-        exe("sudo umount {}".format(folder))
-    except EnvironmentError as e:
+        host.run(["umount", folder], sudo=True, timeout=ISCSI_TIMEOUT)
+    except CmdError as e:
         dprint(e)
-        return
-    exe("sudo rmdir {}".format(folder))
+        return False
+    host.run(["rmdir", folder], sudo=True)
+    return True
+
+
+def by_path(ip, iqn, lun):
+    return get_host().dev_path(
+        "disk", "by-path", BY_PATH_TEMPLATE.format(ip=ip, iqn=iqn, lun=lun))
 
 
 def get_dirname(directory, ai_name, si_name, vol_name):
@@ -60,59 +177,107 @@ def get_dirname(directory, ai_name, si_name, vol_name):
 
 
 def _mount_volume(api, ai, multipath, fs, fsargs, directory, login_only,
-                  results):
-    _setup_acl(api, ai)
-    ai.set(admin_state='online')
+                  results, journal=None):
+    journal = journal or Journal()
+    # Steps completed by an earlier run are skipped as long as their result
+    # can still be seen without another API write or iSCSI command
+    if not journal.done('acl', ai['id']):
+        setup_acl(api, ai)
+        journal.record('acl', ai['id'])
+    if not (journal.done('online', ai['id']) and
+            ai['admin_state'] == 'online'):
+        ai.set(admin_state='online')
+        journal.record('online', ai['id'])
+    if not login_only:
+        # Whatever gets written through the mount makes the clone unfit
+        # for reuse
+        mark_used(ai)
     for si in ai.storage_instances.list():
-        _si_poll(si)
-        si = si.reload()
+        if not (journal.done('available', si.path) and
+                si['op_state'] == 'available'):
+            _si_poll(si)
+            si = si.reload()
+            journal.record('available', si.path)
         ac = si.access
         for i, vol in enumerate(si.volumes.list()):
-            path = _login(ac['iqn'], ac['ips'], multipath, i)
-            if login_only:
-                results.append(path)
+            key = '{}:{}'.format(ac['iqn'], i)
+            path = (journal.get('login', key) or {}).get('path')
+            if not (path and os.path.exists(path)):
+                path = _login(ac['iqn'], ac['ips'], multipath, i)
+                journal.record('login', key, path=path)
             print("Volume device path:", path)
+            entry = {'ai_id': ai['id'],
+                     'ai': ai.name,
+                     'si': si.name,
+                     'vol': vol.name,
+                     'iqn': ac['iqn'],
+                     'portals': ac['ips'],
+                     'lun': i,
+                     'device': path,
+                     'mount': ''}
             if not login_only:
                 folder = get_dirname(directory, ai.name, si.name, vol.name)
-                results.append(folder)
-                _format_mount_device(path, fs, fsargs, folder)
+                _format_mount_device(path, fs, fsargs, folder, journal)
+                entry['mount'] = folder
+            results.append(entry)
+
+
+def _fs_type(path):
+    """ Filesystem type found on the device, '' if there is none """
+    result = get_host().run(["blkid", "-o", "value", "-s", "TYPE", path],
+                            sudo=True, timeout=ISCSI_TIMEOUT, fail_ok=True)
+    if not result.ok:
+        return ''
+    return result.stdout.strip().lower()
+
+
+def _format_mount_device(path, fs, fsargs, folder, journal=None):
+    journal = journal or Journal()
+    if (journal.done('mounted', folder) and
+            mount_entry(os.path.realpath(path))[0] == folder):
+        print("Volume already mounted:", folder)
+        return
+    if journal.done('formatted', folder) and _fs_type(path) == fs.lower():
+        dprint("Already formatted:", path)
+    else:
+        _format_device(path, fs, fsargs)
+        journal.record('formatted', folder, device=path)
+    _mount_device(path, folder)
+    journal.record('mounted', folder, device=path)
 
 
-def _format_mount_device(path, fs, fsargs, folder):
+def _format_device(path, fs, fsargs):
+    host = get_host()
     timeout = 5
     while True:
         try:
-            exe("sudo mkfs.{} {} {} ".format(fs, fsargs, path))
+            host.run(["mkfs.{}".format(fs)] + shlex.split(fsargs) + [path],
+                     sudo=True, timeout=MKFS_TIMEOUT)
             break
-        except EnvironmentError:
+        except CmdError:
             dprint("Checking for existing filesystem on:", path)
-            try:
-                out = exe(
-                    "sudo blkid {} | grep -Eo '(TYPE=\".*\")'".format(
-                        path))
-                parts = out.split("=")
-                if len(parts) == 2:
-                    found_fs = parts[-1].lower().strip().strip('"')
-                    if found_fs == fs.lower():
-                        dprint("Found existing filesystem, continuing")
-                        break
-            except EnvironmentError:
-                pass
+            if _fs_type(path) == fs.lower():
+                dprint("Found existing filesystem, continuing")
+                break
             dprint("Failed to format {}. Waiting for device to be "
                    "ready".format(path))
             if not timeout:
                 raise
             time.sleep(1)
             timeout -= 1
-    exe("sudo mkdir -p /{}".format(folder.strip("/")))
-    exe("sudo mount {} {}".format(path, folder))
+
+
+def _mount_device(path, folder):
+    host = get_host()
+    host.run(["mkdir", "-p", "/{}".format(folder.strip("/"))], sudo=True)
+    host.run(["mount", path, folder], sudo=True, timeout=ISCSI_TIMEOUT)
     print("Volume mount:", folder)
 
 
 def _si_poll(si):
     timeout = 10
     while True:
-        si = si.reload()
+        si = fresh(si)
         if si.op_state == 'available':
             break
         if not timeout:
@@ -123,22 +288,26 @@ def _si_poll(si):
         timeout -= 1
 
 
-def _get_initiator():
+def get_initiator():
+    """ IQN of this host's iSCSI initiator """
     file_path = '/etc/iscsi/initiatorname.iscsi'
     try:
-        out = exe('sudo cat {}'.format(file_path))
+        out = get_host().run(['cat', file_path], sudo=True).stdout
         for line in out.splitlines():
             if line.startswith('InitiatorName='):
                 return line.split("=", 1)[-1].strip()
-    except EnvironmentError:
+    except CmdError:
         dprint("Could not find the iSCSI Initiator File %s", file_path)
         raise
 
 
 @locker
-def _setup_initiator(api):
-    initiator = _get_initiator()
-    host = exe('hostname').strip()
+def _setup_initiator(api, initiator=None):
+    if initiator:
+        host = initiator
+    else:
+        initiator = get_initiator()
+        host = get_host().run(['hostname']).stdout.strip()
     initiator_obj = None
     try:
         initiator_obj = api.initiators.get(initiator)
@@ -154,8 +323,12 @@ def _setup_initiator(api):
     return initiator_obj
 
 
-def _setup_acl(api, ai):
-    initiator = _setup_initiator(api)
+def setup_acl(api, ai, initiator=None):
+    """
+    Allows this host's initiator, or the given initiator IQN, to access
+    every StorageInstance of ai
+    """
+    initiator = _setup_initiator(api, initiator)
     for si in ai.storage_instances.list():
         try:
             si.acl_policy.initiators.add(initiator.path)
@@ -179,7 +352,8 @@ def _get_multipath_disk(path):
     # Fallback to iterating through all the entries under /sys/block/dm-* and
     # check to see if any have an entry under /sys/block/dm-*/slaves matching
     # the device the symlink was pointing at
-    dmpaths = glob.glob("/sys/block/dm-*")
+    host = get_host()
+    dmpaths = glob.glob(host.sys_path("block", "dm-*"))
     for dmpath in dmpaths:
         sdevices = glob.glob(os.path.join(dmpath, "slaves", "*"))
         for spath in sdevices:
@@ -187,7 +361,7 @@ def _get_multipath_disk(path):
             if sdevice == s:
                 # We've found a matching entry, return the path for the
                 # dm-* device it was found under
-                p = os.path.join("/dev", os.path.basename(dmpath))
+                p = host.dev_path(os.path.basename(dmpath))
                 dprint("Found matching device: {} under dm-* device path "
                        "{}".format(sdevice, dmpath))
                 return p
@@ -197,22 +371,18 @@ def _get_multipath_disk(path):
 
 
 def _set_noop_scheduler(portals, iqn, lun):
+    host = get_host()
     for portal in portals:
-        path = DEV_TEMPLATE.format(ip=portal, iqn=iqn, lun=lun)
-        device = None
-        while True:
-            out = exe("ls -l {} | awk '{{print $NF}}'".format(path))
-            device = out.split("/")[-1].strip()
-            if device:
-                break
-            dprint("Waiting for device to be ready:", path)
-            time.sleep(1)
+        path = by_path(portal, iqn, lun)
+        _wait_link(path)
+        device = os.path.basename(os.path.realpath(path))
         dprint("Setting noop scheduler for device:", device)
-        exe("echo 'noop' | sudo tee /sys/block/{}/queue/scheduler".format(
-            device))
+        host.run(["tee", host.sys_path("block", device, "queue", "scheduler")],
+                 sudo=True, input="noop")
 
 
 def _login(iqn, portals, multipath, lun):
+    host = get_host()
     retries = 10
     if not multipath:
         portals = [portals[0]]
@@ -221,13 +391,15 @@ def _login(iqn, portals, multipath, lun):
             while True:
                 dprint("Trying to log into target:", portal)
                 try:
-                    exe("sudo iscsiadm -m discovery -t st -p {}:3260".format(
-                        portal))
-                    exe("sudo iscsiadm -m node -T {iqn} -p {ip}:3260 "
-                        "--login".format(iqn=iqn, ip=portal))
+                    host.run(["iscsiadm", "-m", "discovery", "-t", "st",
+                              "-p", "{}:3260".format(portal)],
+                             sudo=True, timeout=ISCSI_TIMEOUT)
+                    host.run(["iscsiadm", "-m", "node", "-T", iqn,
+                              "-p", "{}:3260".format(portal), "--login"],
+                             sudo=True, timeout=ISCSI_TIMEOUT)
                     break
-                except EnvironmentError as e:
-                    if 'returned non-zero exit status 15' in str(e):
+                except CmdError as e:
+                    if e.returncode == ISCSI_ERR_SESS_EXISTS:
                         break
                     retries -= 1
                     if not retries:
@@ -237,42 +409,294 @@ def _login(iqn, portals, multipath, lun):
                     dprint("Failed to login to portal, retrying")
                     time.sleep(2)
     _set_noop_scheduler(portals, iqn, lun)
-    path = DEV_TEMPLATE.format(ip=portals[0], iqn=iqn, lun=lun)
+    path = by_path(portals[0], iqn, lun)
     if multipath:
-        dprint('Sleeping to allow for multipath devices to finish linking')
-        time.sleep(2)
-        dpath = _get_multipath_disk(path)
+        dpath = _wait_multipath_disk(path)
     else:
         dpath = path
     return dpath
 
 
+def _wait_link(path, timeout=LINK_TIMEOUT, interval=0.1):
+    """ Polls until the device link path shows up """
+    deadline = time.time() + timeout
+    while not os.path.islink(path):
+        if time.time() >= deadline:
+            raise EnvironmentError(
+                "Device link {} did not show up within {}s of logging "
+                "in".format(path, timeout))
+        dprint("Waiting for device to be ready:", path)
+        time.sleep(interval)
+
+
+def _wait_multipath_disk(path, timeout=LINK_TIMEOUT, interval=0.1):
+    """ Polls until the multipath device for path has been linked """
+    deadline = time.time() + timeout
+    while True:
+        try:
+            return _get_multipath_disk(path)
+        except EnvironmentError:
+            if time.time() >= deadline:
+                raise
+            dprint("Waiting for multipath device for:", path)
+        time.sleep(interval)
+
+
+def _wait_logged_out(iqn, timeout=LINK_TIMEOUT, interval=0.1):
+    """
+    Polls until no by-path links of the target remain, returns False (after
+    a warning) if some are still there after timeout seconds
+    """
+    deadline = time.time() + timeout
+    while _target_links(iqn):
+        if time.time() >= deadline:
+            print("WARNING: {} device links of {} still present {}s after "
+                  "logging out".format(len(_target_links(iqn)), iqn,
+                                       timeout))
+            return False
+        time.sleep(interval)
+    return True
+
+
+def _target_links(iqn):
+    """ by-path links of every LUN of the target on any portal """
+    return glob.glob(get_host().dev_path(
+        "disk", "by-path", "*-iscsi-{}-lun-*".format(iqn)))
+
+
 def _logout(iqn, portals):
+    host = get_host()
     for portal in portals:
-        exe("sudo iscsiadm -m node -T {iqn} -p {ip}:3260 --logout".format(
-            iqn=iqn, ip=portal), fail_ok=True)
-        exe("sudo iscsiadm -m node -T {iqn} -p {ip}:3260 --op delete".format(
-            iqn=iqn, ip=portal), fail_ok=True)
-        exe("sudo iscsiadm -m discoverydb -p {ip}:3260 --op delete".format(
-            ip=portal),
-            fail_ok=True)
-    exe("sudo iscsiadm -m session --rescan", fail_ok=True)
-    exe("sudo multipath -F", fail_ok=True)
-    dprint("Sleeping to wait for logout")
-    time.sleep(2)
+        target = "{}:3260".format(portal)
+        host.run(["iscsiadm", "-m", "node", "-T", iqn, "-p", target,
+                  "--logout"],
+                 sudo=True, timeout=ISCSI_TIMEOUT, fail_ok=True)
+        host.run(["iscsiadm", "-m", "node", "-T", iqn, "-p", target,
+                  "--op", "delete"],
+                 sudo=True, timeout=ISCSI_TIMEOUT, fail_ok=True)
+        host.run(["iscsiadm", "-m", "discoverydb", "-p", target,
+                  "--op", "delete"],
+                 sudo=True, timeout=ISCSI_TIMEOUT, fail_ok=True)
+    host.run(["iscsiadm", "-m", "session", "--rescan"],
+             sudo=True, timeout=ISCSI_TIMEOUT, fail_ok=True)
+    host.run(["multipath", "-F"],
+             sudo=True, timeout=ISCSI_TIMEOUT, fail_ok=True)
+    _wait_logged_out(iqn)
     dprint("Logout complete")
 
 
+def _logout_target(iqn, portals, maps):
+    """
+    Logs out of a single target and flushes only its multipath maps,
+    leaving the discovery records and every other target alone
+    """
+    host = get_host()
+    for portal in portals:
+        host.run(["iscsiadm", "-m", "node", "-T", iqn,
+                  "-p", "{}:3260".format(portal), "--logout"],
+                 sudo=True, timeout=ISCSI_TIMEOUT, fail_ok=True)
+    for dm in maps:
+        host.run(["multipath", "-f", dm],
+                 sudo=True, timeout=ISCSI_TIMEOUT, fail_ok=True)
+    _wait_logged_out(iqn)
+
+
 def find_mount(si, lun, multipath):
     ip = si.access['ips'][0]
     iqn = si.access['iqn']
-    path = DEV_TEMPLATE.format(ip=ip, iqn=iqn, lun=lun)
+    path = by_path(ip, iqn, lun)
     if multipath:
         path = _get_multipath_disk(path)
-    out = exe("ls -l {} | awk '{{print $NF}}'".format(path))
-    device = out.split("/")[-1].strip()
+    if not path or not os.path.exists(path):
+        return None, path, ''
+    real = os.path.realpath(path)
+    device = os.path.basename(real)
+    mount, _ = mount_entry(real)
+    return mount, path, device
+
+
+def stable_device_path(iqn, portals, lun, multipath):
+    """
+    Device path of a logged in LUN that survives reboots: the
+    dm-uuid-mpath-<WWID> link (or /dev/mapper name) of its multipath device,
+    or its by-path link
+    """
+    path = by_path(portals[0], iqn, lun)
+    if not multipath:
+        return path
+    device = os.path.basename(os.path.realpath(_get_multipath_disk(path)))
+    host = get_host()
+    try:
+        with io.open(host.sys_path("block", device, "dm", "uuid")) as f:
+            uuid = f.read().strip()
+    except (IOError, OSError):
+        uuid = ''
+    link = host.dev_path("disk", "by-id", "dm-uuid-{}".format(uuid))
+    if uuid and os.path.exists(link):
+        return link
+    return host.dev_path("mapper", _dm_name(device))
+
+
+def _mounted(folder):
+    """ Whether something is mounted on folder """
+    with io.open(get_host().proc_path('mounts')) as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) > 1 and parts[1] == folder:
+                return True
+    return False
+
+
+def mount_entry(real):
+    """ Returns (mount point, fstype) of a device, empty if not mounted """
+    with io.open(get_host().proc_path('mounts')) as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) > 2 and os.path.realpath(parts[0]) == real:
+                return parts[1], parts[2]
+    return '', ''
+
+
+def _dm_name(device):
+    with io.open(get_host().sys_path("block", device, "dm", "name")) as f:
+        return f.read().strip()
+
+
+def _grow_fs(fstype, mount, device):
+    if fstype == 'xfs':
+        argv = ["xfs_growfs", mount]
+    elif fstype in ('ext2', 'ext3', 'ext4'):
+        argv = ["resize2fs", device]
+    else:
+        raise ValueError(
+            "Don't know how to grow a {} filesystem".format(fstype))
+    get_host().run(argv, sudo=True, timeout=MKFS_TIMEOUT)
+
+
+def extend_online(si, lun, multipath):
+    """
+    Makes this host see the new size of an already resized Volume and grows
+    the filesystem mounted on it without unmounting or logging out.  Only
+    the Volume's own target is rescanned.  Returns the mount point (or
+    device path) grown, None if the Volume isn't logged in here
+    """
+    host = get_host()
+    mount, path, device = find_mount(si, lun, multipath)
     if not device:
-        return None, path, device
-    mount = exe("cat /proc/mounts | grep {} | awk '{{print $2}}'".format(
-        device))
-    return mount.strip(), path, device
+        return None
+    host.run(["iscsiadm", "-m", "node", "-T", si.access['iqn'], "-R"],
+             sudo=True, timeout=ISCSI_TIMEOUT)
+    if device.startswith('dm-'):
+        host.run(["multipathd", "resize", "map", _dm_name(device)],
+                 sudo=True, timeout=ISCSI_TIMEOUT)
+    if not mount:
+        return path
+    _grow_fs(mount_entry(os.path.realpath(path))[1], mount,
+             host.dev_path(device))
+    print("Grew filesystem on:", mount)
+    return mount
+
+
+def record_mounts(ais, multipath):
+    """
+    Returns an entry for every LUN of the AppInstances logged in on this
+    host with its target, device and (if mounted) mount point and fstype
+    """
+    entries = []
+    for ai in ais:
+        for si in ai.storage_instances.list():
+            if not si.access.get('iqn'):
+                continue
+            for lun, vol in enumerate(si.volumes.list()):
+                try:
+                    mount, path, device = find_mount(si, lun, multipath)
+                except EnvironmentError as e:
+                    dprint(e)
+                    continue
+                if not device:
+                    continue
+                entries.append({'ai_id': ai['id'],
+                                'ai': ai['name'],
+                                'si': si['name'],
+                                'vol': vol['name'],
+                                'iqn': si.access['iqn'],
+                                'portals': si.access['ips'],
+                                'lun': lun,
+                                'device': device,
+                                'mount': mount,
+                                'fstype': mount_entry(
+                                    os.path.realpath(path))[1]})
+    return entries
+
+
+def _by_target(entries):
+    targets = {}
+    for entry in entries:
+        targets.setdefault(entry['iqn'], []).append(entry)
+    return [sorted(items, key=lambda e: e['lun'])
+            for items in targets.values()]
+
+
+def teardown(entries, multipath, workers):
+    """
+    Unmounts and logs out of only the targets of the entries from
+    record_mounts, recording when each mount went down (down_at) and which
+    entries were logged out (logged_out)
+    """
+    host = get_host()
+    errors = []
+
+    def _teardown_helper(items):
+        # Errors are only raised once every target is done, so the caller
+        # knows exactly what was taken down when one fails
+        try:
+            for entry in items:
+                if entry['mount']:
+                    down_at = time.time()
+                    host.run(["umount", entry['mount']], sudo=True,
+                             timeout=ISCSI_TIMEOUT)
+                    entry['down_at'] = down_at
+            maps = []
+            if multipath:
+                maps = [host.dev_path(e['device']) for e in items
+                        if e['device'].startswith('dm-')]
+            _logout_target(items[0]['iqn'], items[0]['portals'], maps)
+            for entry in items:
+                entry['logged_out'] = True
+        except Exception as e:
+            dprint("Failed to tear down {}: {}".format(items[0]['iqn'], e))
+            errors.append(sys.exc_info())
+    targets = _by_target(entries)
+    if targets:
+        p = Parallel([_teardown_helper] * len(targets),
+                     args_list=[(items,) for items in targets],
+                     max_workers=max(min(workers, len(targets)), 1))
+        p.run_threads()
+    if errors:
+        raise_(*errors[0])
+
+
+def bring_up(entries, multipath, workers, fs=None, fsargs=''):
+    """
+    Logs back into the targets of the entries from record_mounts and
+    remounts them on their previous mount points.  The filesystems are
+    expected to exist so nothing is formatted, unless fs is given, then
+    devices without any filesystem are formatted with it first
+    """
+    def _up_helper(items):
+        iqn, portals = items[0]['iqn'], items[0]['portals']
+        if items[0]['lun'] != 0:
+            _login(iqn, portals, multipath, 0)
+        for entry in items:
+            path = _login(iqn, portals, multipath, entry['lun'])
+            if entry['mount']:
+                if fs and not _fs_type(path):
+                    _format_device(path, fs, fsargs)
+                _mount_device(path, entry['mount'])
+                entry['up_at'] = time.time()
+    targets = _by_target(entries)
+    if targets:
+        p = Parallel([_up_helper] * len(targets),
+                     args_list=[(items,) for items in targets],
+                     max_workers=max(min(workers, len(targets)), 1))
+        p.run_threads()
@@ -0,0 +1,85 @@
+"""
+Machine readable output of operation results
+
+In json, ndjson and table modes the records of an operation are the only
+thing written to stdout, every other message goes to stderr.  ndjson writes
+each record as soon as it is produced, json and table write everything once
+the operation is done.
+"""
+from __future__ import unicode_literals, print_function, division
+
+import json
+import sys
+import threading
+
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
+from tabulate import tabulate
+
+MODES = ('text', 'json', 'ndjson', 'table')
+
+
+def _default(obj):
+    # SDK entities are Mappings
+    if isinstance(obj, Mapping):
+        return dict(obj)
+    return str(obj)
+
+
+def to_record(obj):
+    """ Plain JSON compatible dict of an SDK entity or dict """
+    return json.loads(json.dumps(obj, default=_default))
+
+
+class Output(object):
+
+    def __init__(self, mode='text', stream=None):
+        if mode not in MODES:
+            raise ValueError("Unsupported output mode: {}".format(mode))
+        self.mode = mode
+        self.stream = stream or sys.stdout
+        self.records = []
+        self.lock = threading.Lock()
+
+    @property
+    def machine(self):
+        return self.mode != 'text'
+
+    def emit(self, obj, **extra):
+        """ Records one result, safe to call from worker threads """
+        if not self.machine:
+            return
+        record = to_record(obj)
+        record.update(extra)
+        with self.lock:
+            if self.mode == 'ndjson':
+                self.stream.write(json.dumps(record, sort_keys=True) + '\n')
+                self.stream.flush()
+            else:
+                self.records.append(record)
+
+    def emit_all(self, objs, **extra):
+        for obj in objs:
+            self.emit(obj, **extra)
+
+    def close(self):
+        if self.mode == 'json':
+            json.dump(self.records, self.stream, indent=2, sort_keys=True)
+            self.stream.write('\n')
+        elif self.mode == 'table' and self.records:
+            headers = []
+            for record in self.records:
+                headers.extend(k for k in record if k not in headers)
+            rows = [[_cell(r.get(h)) for h in headers] for r in self.records]
+            self.stream.write(tabulate(rows, headers=headers,
+                                       disable_numparse=True) + '\n')
+        self.stream.flush()
+
+
+def _cell(value):
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, sort_keys=True)
+    return value
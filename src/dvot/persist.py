@@ -0,0 +1,242 @@
+"""
+Keeping the mounts dvot makes across reboots
+
+Every persisted mount is recorded in a state file with its target (IQN,
+portals, LUN), a stable device path and its mount point.  The stable path is
+the dm-uuid-mpath-<WWID> link for multipath devices and the by-path link
+otherwise, so it does not depend on the order devices show up in.  Each
+mount also gets a `_netdev` /etc/fstab line (inside a block managed by dvot)
+or a systemd .mount unit, and its target's node record is set to log in
+automatically.  restore-mounts logs into and mounts everything in the state
+file straight from it, without any API lookups.
+"""
+from __future__ import unicode_literals, print_function, division
+
+import json
+import os
+import string
+
+from dvot.host import get_host
+from dvot.mount import bring_up, stable_device_path, mount_entry, \
+    ISCSI_TIMEOUT
+from dvot.utils import CmdError, dprint
+
+MODES = ('fstab', 'systemd')
+STATE_FILE = '/etc/dvot/mounts.json'
+FSTAB = '/etc/fstab'
+UNIT_DIR = '/etc/systemd/system'
+OPTIONS = '_netdev,nofail'
+# Characters systemd leaves unescaped in unit names
+SAFE = set(string.ascii_letters + string.digits + ':_')
+# ls exit status when a command line argument can't be accessed
+LS_MISSING = 2
+BEGIN = '# BEGIN dvot mounts, managed by dvot'
+END = '# END dvot mounts'
+UNIT_TEMPLATE = """\
+[Unit]
+Description=dvot mount of {name}
+After=iscsid.service multipathd.service network-online.target
+Wants=network-online.target
+
+[Mount]
+What={device}
+Where={mount}
+Type={fstype}
+Options={options}
+
+[Install]
+WantedBy=remote-fs.target
+"""
+
+
+def _read(path):
+    """
+    Contents of path, None if it doesn't exist.  Any other failure raises so
+    that a failed read is never taken for an empty file and written back
+    """
+    host = get_host()
+    result = host.run(['cat', path], sudo=True, fail_ok=True)
+    if result.ok:
+        return result.stdout
+    if host.run(['ls', '-d', path], sudo=True,
+                fail_ok=True).returncode == LS_MISSING:
+        return None
+    raise CmdError(result)
+
+
+def _write(path, text, backup=False):
+    """
+    Replaces path with text through a synced temporary file next to it that
+    is renamed into place, so path is never left half written.  With backup
+    the previous version is kept as path.bak
+    """
+    host = get_host()
+    tmp = path + '.dvot-new'
+    host.run(['mkdir', '-p', os.path.dirname(path)], sudo=True)
+    host.run(['tee', tmp], sudo=True, input=text)
+    host.run(['sync', tmp], sudo=True)
+    if backup:
+        host.run(['cp', '-p', path, path + '.bak'], sudo=True)
+    host.run(['mv', '-f', tmp, path], sudo=True)
+
+
+def load_state(path=STATE_FILE):
+    """ Returns {mount point: entry} of the persisted mounts """
+    text = _read(path)
+    if text is None:
+        return {}
+    # An existing but unreadable state raises instead of reading as empty,
+    # saving over it would forget every persisted mount
+    return json.loads(text)['mounts']
+
+
+def unit_name(mount):
+    """ systemd-escape --path --suffix=mount """
+    path = os.path.normpath(mount).strip('/')
+    if not path:
+        return '-.mount'
+    out = []
+    for i, c in enumerate(path):
+        if c == '/':
+            out.append('-')
+        elif c in SAFE or (c == '.' and i):
+            out.append(c)
+        else:
+            out.extend('\\x{:02x}'.format(b)
+                       for b in bytearray(c.encode('utf-8')))
+    return ''.join(out) + '.mount'
+
+
+def _name(entry):
+    return '/'.join(entry.get(k) or '?' for k in ('ai', 'si', 'vol'))
+
+
+def fstab_line(entry):
+    return '{} {} {} {} 0 0'.format(entry['device'], entry['mount'],
+                                    entry['fstype'] or 'auto', OPTIONS)
+
+
+def mount_unit(entry):
+    return UNIT_TEMPLATE.format(name=_name(entry), device=entry['device'],
+                                mount=entry['mount'],
+                                fstype=entry['fstype'] or 'auto',
+                                options=OPTIONS)
+
+
+def _fstab_block(fstab, lines):
+    """ fstab with the dvot block replaced by lines """
+    kept, inside = [], False
+    for line in fstab.splitlines():
+        if line == BEGIN:
+            inside = True
+        elif line == END:
+            inside = False
+        elif not inside:
+            kept.append(line)
+    if lines:
+        kept.extend([BEGIN] + lines + [END])
+    return '\n'.join(kept) + '\n'
+
+
+def _save(state, previous, path):
+    host = get_host()
+    _write(path, json.dumps({'mounts': state}, indent=2, sort_keys=True) +
+           '\n', backup=bool(previous))
+    in_fstab = [e for e in state.values() if e['persist'] == 'fstab']
+    if in_fstab or any(e['persist'] == 'fstab' for e in previous.values()):
+        fstab = _read(FSTAB)
+        if fstab is None:
+            raise EnvironmentError("{} not found".format(FSTAB))
+        _write(FSTAB, _fstab_block(fstab, [
+            fstab_line(e) for e in sorted(in_fstab,
+                                          key=lambda e: e['mount'])]),
+               backup=True)
+    units = dict((unit_name(e['mount']), e) for e in state.values()
+                 if e['persist'] == 'systemd')
+    gone = set(unit_name(e['mount']) for e in previous.values()
+               if e['persist'] == 'systemd') - set(units)
+    for unit in sorted(gone):
+        host.run(['systemctl', 'disable', unit], sudo=True,
+                 timeout=ISCSI_TIMEOUT, fail_ok=True)
+        host.run(['rm', '-f', os.path.join(UNIT_DIR, unit)], sudo=True)
+    for unit, entry in sorted(units.items()):
+        _write(os.path.join(UNIT_DIR, unit), mount_unit(entry))
+    if units or gone:
+        host.run(['systemctl', 'daemon-reload'], sudo=True,
+                 timeout=ISCSI_TIMEOUT, fail_ok=True)
+    for unit in sorted(units):
+        host.run(['systemctl', 'enable', unit], sudo=True,
+                 timeout=ISCSI_TIMEOUT, fail_ok=True)
+
+
+def persist_mounts(entries, mode, multipath, path=STATE_FILE):
+    """
+    Records the mounted entries (from record_mounts or mount_clone) so they
+    come back after a reboot.  Returns the persisted entries
+    """
+    if mode not in MODES:
+        raise ValueError("Unsupported persist mode: {}".format(mode))
+    host = get_host()
+    previous = load_state(path)
+    state = dict(previous)
+    added = []
+    for entry in entries:
+        if not entry.get('mount'):
+            continue
+        device = stable_device_path(entry['iqn'], entry['portals'],
+                                    entry['lun'], multipath)
+        fstype = (entry.get('fstype') or
+                  mount_entry(os.path.realpath(device))[1])
+        persisted = {'mount': entry['mount'],
+                     'device': device,
+                     'fstype': fstype,
+                     'iqn': entry['iqn'],
+                     'portals': entry['portals'],
+                     'lun': entry['lun'],
+                     'ai_id': entry.get('ai_id'),
+                     'ai': entry.get('ai'),
+                     'si': entry.get('si'),
+                     'vol': entry.get('vol'),
+                     'persist': mode}
+        state[entry['mount']] = persisted
+        added.append(persisted)
+    targets = set((e['iqn'], tuple(e['portals'])) for e in added)
+    for iqn, portals in sorted(targets):
+        for portal in portals:
+            host.run(["iscsiadm", "-m", "node", "-T", iqn,
+                      "-p", "{}:3260".format(portal), "--op", "update",
+                      "-n", "node.startup", "-v", "automatic"],
+                     sudo=True, timeout=ISCSI_TIMEOUT, fail_ok=True)
+    if added:
+        _save(state, previous, path)
+        print("Persisted {} mounts in {} ({})".format(len(added), path,
+                                                      mode))
+    return added
+
+
+def forget_mounts(ai_ids, path=STATE_FILE):
+    """ Drops the persisted mounts of the given AppInstances """
+    # Nothing was ever persisted, don't bother sudo with the state file
+    if not get_host().exists(path):
+        return
+    previous = load_state(path)
+    state = dict((mount, e) for mount, e in previous.items()
+                 if e.get('ai_id') not in ai_ids)
+    if len(state) != len(previous):
+        _save(state, previous, path)
+        dprint("Forgot {} persisted mounts".format(
+            len(previous) - len(state)))
+
+
+def restore_mounts(multipath, workers, path=STATE_FILE):
+    """
+    Logs into and mounts every persisted mount that is not mounted yet, all
+    targets in parallel.  Returns the restored entries
+    """
+    state = load_state(path)
+    entries = [dict(e) for mount, e in sorted(state.items())
+               if mount_entry(os.path.realpath(e['device']))[0] != mount]
+    print("Restoring {} of {} persisted mounts".format(len(entries),
+                                                       len(state)))
+    bring_up(entries, multipath, workers)
+    return entries
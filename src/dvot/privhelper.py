@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Persistent privileged command helper.
+
+Started once under ``sudo`` by ``dvot.utils.PrivHelper`` and then fed
+newline-delimited JSON requests on stdin, one per command:
+
+    {"id": 1, "argv": ["iscsiadm", "-m", "session"], "timeout": 30,
+     "input": null}
+
+Each command runs in its own thread without a shell and the result is
+written back on stdout as a single JSON line:
+
+    {"id": 1, "rc": 0, "out": "...", "err": "", "timed_out": false}
+
+This module must only depend on the standard library since it may be run by
+an interpreter that does not have the dvot requirements installed.
+"""
+from __future__ import unicode_literals, print_function, division
+
+import io
+import json
+import subprocess
+import sys
+import threading
+
+
+def _decode(data):
+    if data is None:
+        return ''
+    return data.decode('utf-8', 'replace')
+
+
+def execute(argv, timeout=None, input=None):
+    """
+    Runs argv without a shell, returns (returncode, stdout, stderr, timed_out)
+    """
+    try:
+        proc = subprocess.Popen(argv,
+                                stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+    except OSError as e:
+        # Mirror the shell's "command not found" exit status
+        return 127, '', str(e), False
+    timed_out = []
+
+    def _kill():
+        timed_out.append(True)
+        try:
+            proc.kill()
+        except OSError:
+            pass
+    timer = None
+    if timeout:
+        timer = threading.Timer(timeout, _kill)
+        timer.daemon = True
+        timer.start()
+    try:
+        if input is not None:
+            input = input.encode('utf-8')
+        out, err = proc.communicate(input)
+    finally:
+        if timer:
+            timer.cancel()
+    return proc.returncode, _decode(out), _decode(err), bool(timed_out)
+
+
+def serve(stdin, stdout):
+    lock = threading.Lock()
+
+    def _handle(req):
+        rc, out, err, timed_out = execute(req['argv'],
+                                          timeout=req.get('timeout'),
+                                          input=req.get('input'))
+        resp = json.dumps({'id': req['id'],
+                           'rc': rc,
+                           'out': out,
+                           'err': err,
+                           'timed_out': timed_out})
+        with lock:
+            stdout.write(resp.encode('utf-8') + b'\n')
+            stdout.flush()
+
+    threads = []
+    for line in iter(stdin.readline, b''):
+        line = line.strip()
+        if not line:
+            continue
+        req = json.loads(line.decode('utf-8'))
+        thread = threading.Thread(target=_handle, args=(req,))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+        threads = [t for t in threads if t.is_alive()]
+    # Let in-flight commands finish before exiting on EOF
+    for thread in threads:
+        thread.join()
+
+
+if __name__ == '__main__':
+    serve(io.open(sys.stdin.fileno(), 'rb', buffering=0),
+          io.open(sys.stdout.fileno(), 'wb', buffering=0))
@@ -0,0 +1,142 @@
+"""
+Compact records for tenant wide scans
+
+Scanning a large tenant with SDK entities keeps every API field of every
+object plus its client references alive.  The scanners project the API
+responses into these __slots__ records instead, holding only the fields dvot
+uses.  Records are read-only Mappings so `rec['utc_ts']` and `rec.path` work
+as they do on entities, and the full entity of the few objects an operation
+acts on is fetched with `rec.entity()`.
+"""
+from __future__ import unicode_literals, print_function, division
+
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
+from dfs_sdk import exceptions as dexceptions
+from six.moves import intern
+
+
+def _intern(value):
+    # Repeated enum like values (op_state) share one string
+    return intern(value) if value is not None else None
+
+
+class Record(Mapping):
+
+    __slots__ = ('_api',)
+    fields = ()
+
+    def __init__(self, api, data):
+        self._api = api
+        for field in self.fields:
+            setattr(self, field, data.get(field))
+        if 'op_state' in self.fields:
+            self.op_state = _intern(self.op_state)
+
+    def __getitem__(self, key):
+        if key not in self.fields:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __iter__(self):
+        return iter(self.fields)
+
+    def __len__(self):
+        return len(self.fields)
+
+    def __repr__(self):
+        return '<{} {}>'.format(self.__class__.__name__, self.path)
+
+    def entity(self):
+        """ Fetches the full SDK entity """
+        return self._api.app_instances.entity_from_path(self.path)
+
+    def delete(self):
+        self._api.context.connection.delete_entity(self.path)
+
+
+class SnapRecord(Record):
+
+    # The path is rebuilt from the parent path shared by all snapshots of
+    # the same AppInstance/Volume instead of being stored per snapshot
+    __slots__ = ('parent', 'uuid', 'utc_ts', 'op_state')
+    fields = ('path', 'uuid', 'utc_ts', 'op_state')
+
+    def __init__(self, api, data, parent=None):
+        self._api = api
+        self.uuid = data.get('uuid')
+        self.utc_ts = data.get('utc_ts')
+        self.op_state = _intern(data.get('op_state'))
+        self.parent = parent
+        if data.get('path') != self.path:
+            self.parent = data.get('path', '').rsplit('/snapshots/', 1)[0]
+
+    @property
+    def path(self):
+        return '{}/snapshots/{}'.format(self.parent, self.utc_ts)
+
+
+class VolRecord(Record):
+
+    __slots__ = fields = ('path', 'uuid', 'name', 'size', 'op_state')
+
+
+class SiRecord(Record):
+
+    __slots__ = fields = ('path', 'name', 'iqn', 'ips', 'op_state',
+                          'volumes')
+
+    def __init__(self, api, data):
+        super(SiRecord, self).__init__(api, data)
+        access = data.get('access') or {}
+        self.iqn = access.get('iqn')
+        self.ips = tuple(access.get('ips') or ())
+        # None when the volumes were not embedded in the response
+        if data.get('volumes') is not None:
+            self.volumes = tuple(VolRecord(api, vol)
+                                 for vol in data['volumes'])
+
+
+class AppRecord(Record):
+
+    __slots__ = fields = ('path', 'id', 'name', 'storage_instances')
+
+    def __init__(self, api, data):
+        super(AppRecord, self).__init__(api, data)
+        if data.get('storage_instances') is not None:
+            self.storage_instances = tuple(
+                SiRecord(api, si) for si in data['storage_instances'])
+
+
+def read_list(api, path):
+    """ Raw data of the collection at path, [] when it is empty """
+    try:
+        data = api.context.connection.read_endpoint(path)
+    except dexceptions.ApiNotFoundError:
+        return []
+    if isinstance(data, dict):
+        return list(data.values())
+    return data or []
+
+
+def storage_instances(api, ai):
+    if ai.storage_instances is not None:
+        return ai.storage_instances
+    return [SiRecord(api, si)
+            for si in read_list(api, ai.path + '/storage_instances')]
+
+
+def volumes(api, si):
+    if si.volumes is not None:
+        return si.volumes
+    return [VolRecord(api, vol)
+            for vol in read_list(api, si.path + '/volumes')]
+
+
+def snapshots(api, parent_path):
+    """ SnapRecords of the AppInstance or Volume at parent_path """
+    return [SnapRecord(api, snap, parent_path)
+            for snap in read_list(api, parent_path + '/snapshots')]
@@ -0,0 +1,144 @@
+"""
+Test/dev refresh of one AppInstance onto many hosts
+
+`refresh` takes a single AppInstance level Snapshot (consistent across all
+of its Volumes), creates every clone from that Snapshot concurrently, brings
+them online and writes a manifest with the targets of each clone.  Each host
+then runs mount-manifest, which logs into and mounts only the clone assigned
+to it straight from the manifest, without any tenant lookups.
+"""
+from __future__ import unicode_literals, print_function, division
+
+import io
+import json
+import time
+
+from dvot.apicache import fresh
+from dvot.bulk import wait_available
+from dvot.clones import create_clone
+from dvot.mount import setup_acl, get_dirname, bring_up, \
+    stable_device_path
+from dvot.rollback import wait_ready
+from dvot.utils import Parallel, dprint
+
+
+def refresh(api, ai, count, initiators=None, workers=10, timeout=300):
+    """
+    Snapshots ai once and creates `count` clones of it concurrently.  With
+    initiators (one IQN per clone) clone i is made accessible to
+    initiators[i].  Returns the manifest once every clone is available
+    """
+    if initiators and len(initiators) != count:
+        raise ValueError("Got {} initiators for {} clones".format(
+            len(initiators), count))
+    if count < 1:
+        raise ValueError("refresh needs at least one clone")
+    snap = ai.snapshots.create()
+    print("Created snapshot:", snap.path)
+    snap = wait_available(snap, timeout)
+    clones = [None] * count
+
+    def _clone_helper(slot):
+        # The hosts mount it read-write without telling the API, so it is
+        # never offered for reuse
+        clone = create_clone(api, snap, unique=True, used=True)
+        if initiators:
+            setup_acl(api, clone, initiators[slot])
+        clone.set(admin_state='online')
+        clones[slot] = clone
+    p = Parallel([_clone_helper] * count,
+                 args_list=[(slot,) for slot in range(count)],
+                 max_workers=max(min(workers, count), 1))
+    p.run_threads()
+    ready_at = wait_ready(clones, timeout, workers)
+    waiting = [c['name'] for c in clones if c['id'] not in ready_at]
+    if waiting:
+        raise EnvironmentError(
+            "Clones not available after {}s: {}".format(
+                timeout, ', '.join(waiting)))
+    entries = [None] * count
+
+    def _entry_helper(slot):
+        clone = fresh(clones[slot])
+        entries[slot] = {
+            'slot': slot,
+            'name': clone['name'],
+            'id': clone['id'],
+            'path': clone.path,
+            'initiator': initiators[slot] if initiators else None,
+            'storage_instances': [
+                {'name': si['name'],
+                 'iqn': si['access']['iqn'],
+                 'portals': si['access']['ips'],
+                 'volumes': [vol['name'] for vol in si['volumes']]}
+                for si in clone['storage_instances']]}
+    p = Parallel([_entry_helper] * count,
+                 args_list=[(slot,) for slot in range(count)],
+                 max_workers=max(min(workers, count), 1))
+    p.run_threads()
+    return {'source': ai.path,
+            'source_name': ai['name'],
+            'snapshot': snap.path,
+            'utc_ts': snap['utc_ts'],
+            'created': int(time.time()),
+            'clones': entries}
+
+
+def read_initiators(path):
+    with io.open(path) as f:
+        return [line.strip() for line in f
+                if line.strip() and not line.startswith('#')]
+
+
+def write_manifest(path, manifest):
+    with io.open(path, 'w', encoding='utf-8') as f:
+        f.write(json.dumps(manifest, indent=2, sort_keys=True) + '\n')
+
+
+def read_manifest(path):
+    with io.open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def pick_clone(manifest, slot=None, initiator=None):
+    """ The manifest entry for slot, or else the one assigned to initiator """
+    for entry in manifest['clones']:
+        if slot is not None:
+            if entry['slot'] == slot:
+                return entry
+        elif initiator and entry['initiator'] == initiator:
+            return entry
+    raise ValueError("No clone in the manifest for {}".format(
+        "slot {}".format(slot) if slot is not None else initiator))
+
+
+def mount_clone(entry, multipath, directory, login_only, workers, fs,
+                fsargs=''):
+    """
+    Logs into every target of a manifest entry and mounts its Volumes under
+    directory.  The clones carry the filesystems of the source, only blank
+    Volumes are formatted with fs.  Returns the LUN entries with the stable
+    device path of each, as persist records it
+    """
+    entries = []
+    for si in entry['storage_instances']:
+        for lun, vol in enumerate(si['volumes']):
+            mount = ''
+            if not login_only:
+                mount = get_dirname(directory, entry['name'], si['name'],
+                                    vol)
+            entries.append({'ai_id': entry['id'],
+                            'ai': entry['name'],
+                            'si': si['name'],
+                            'vol': vol,
+                            'iqn': si['iqn'],
+                            'portals': si['portals'],
+                            'lun': lun,
+                            'mount': mount})
+    dprint("Mounting {} LUNs of clone {}".format(len(entries), entry['name']))
+    bring_up(entries, multipath, workers, fs, fsargs)
+    for lun_entry in entries:
+        lun_entry['device'] = stable_device_path(
+            lun_entry['iqn'], lun_entry['portals'], lun_entry['lun'],
+            multipath)
+    return entries
@@ -0,0 +1,131 @@
+"""
+Snapshot retention policies
+
+Snapshots are grouped by the AppInstance or Volume they belong to and each
+group keeps its newest snapshots plus the newest snapshot of each of the most
+recent hourly, daily and (ISO) weekly UTC buckets.  Everything else, except
+snapshots backing a clone, is pruned.
+"""
+from __future__ import unicode_literals, print_function, division
+
+import datetime
+import re
+
+from dvot import records
+from dvot.bulk import run_bulk
+from dvot.clones import clone_source
+from dvot.utils import Parallel
+
+MAX_WORKERS = 20
+
+
+def _hour(ts):
+    return int(ts // 3600)
+
+
+def _day(ts):
+    return int(ts // 86400)
+
+
+def _week(ts):
+    return datetime.datetime.utcfromtimestamp(ts).isocalendar()[:2]
+
+
+class Policy(object):
+
+    def __init__(self, last=0, hourly=0, daily=0, weekly=0):
+        if not any((last, hourly, daily, weekly)):
+            raise ValueError("At least one of --keep-last, --keep-hourly, "
+                             "--keep-daily or --keep-weekly MUST be provided")
+        self.last = last
+        self.rules = ((hourly, _hour), (daily, _day), (weekly, _week))
+
+    def keep(self, timestamps):
+        """ Returns the subset of the float timestamps to keep """
+        ordered = sorted(timestamps, reverse=True)
+        keep = set(ordered[:self.last])
+        for count, bucket in self.rules:
+            seen = set()
+            for ts in ordered:
+                if len(seen) >= count:
+                    break
+                b = bucket(ts)
+                if b not in seen:
+                    seen.add(b)
+                    keep.add(ts)
+        return keep
+
+    def __str__(self):
+        return "last={} hourly={} daily={} weekly={}".format(
+            self.last, *[count for count, _ in self.rules])
+
+
+def collect_snapshots(api, name_re=None, workers=MAX_WORKERS):
+    """
+    Walks the tenant once and returns ({parent_path: [SnapRecords]},
+    protected) where protected is the set of snapshot paths backing clones
+    """
+    regex = re.compile(name_re) if name_re else None
+    protected = set()
+    ais = []
+    for ai in api.app_instances.list():
+        if clone_source(ai):
+            protected.add(clone_source(ai))
+        if not regex or regex.search(ai['name']):
+            ais.append(records.AppRecord(api, ai))
+    groups = {}
+
+    def _snap_helper(ai):
+        snaps = records.snapshots(api, ai.path)
+        if snaps:
+            groups[ai.path] = snaps
+        for si in records.storage_instances(api, ai):
+            for vol in records.volumes(api, si):
+                snaps = records.snapshots(api, vol.path)
+                if snaps:
+                    groups[vol.path] = snaps
+    if ais:
+        p = Parallel([_snap_helper] * len(ais),
+                     args_list=[(ai,) for ai in ais],
+                     max_workers=min(workers, len(ais)))
+        p.run_threads()
+    return groups, protected
+
+
+def plan_prune(groups, policy, protected):
+    """ Returns (keep, prune) lists of snapshots """
+    keep, prune = [], []
+    for parent in sorted(groups):
+        snaps = groups[parent]
+        kept = policy.keep([float(snap['utc_ts']) for snap in snaps])
+        for snap in snaps:
+            if float(snap['utc_ts']) in kept or snap.path in protected:
+                keep.append(snap)
+            else:
+                prune.append(snap)
+    return keep, prune
+
+
+def _delete(snap):
+    snap.delete()
+
+
+def prune_snaps(api, policy, name_re=None, dry_run=False, workers=10,
+                rate=0, on_result=None):
+    groups, protected = collect_snapshots(api, name_re, max(workers, 1))
+    keep, prune = plan_prune(groups, policy, protected)
+    print("Policy {}: {} parents, {} snapshots, keeping {} ({} backing "
+          "clones), pruning {}".format(
+              policy, len(groups), len(keep) + len(prune), len(keep),
+              len([s for s in keep if s.path in protected]), len(prune)))
+    if dry_run:
+        plan = []
+        for snap in prune:
+            print("Would delete:", snap.path)
+            plan.append({'target': snap.path,
+                         'utc_ts': snap.utc_ts,
+                         'action': 'delete',
+                         'dry_run': True})
+        return plan
+    return run_bulk(_delete, prune, workers, rate, progress=True,
+                    on_result=on_result)
@@ -0,0 +1,187 @@
+"""
+Consistent rollback of many AppInstances/Volumes to snapshots at once
+"""
+from __future__ import unicode_literals, print_function, division
+
+import time
+
+from dvot.apicache import fresh
+from dvot.bulk import run_bulk
+from dvot.mount import record_mounts, teardown, bring_up
+from dvot.utils import Parallel, dprint
+
+
+def plan_rollback(snap_paths):
+    """
+    Groups snapshot paths by AppInstance id.  Returns
+    {ai_id: {resource_path: ts}}
+    """
+    plan = {}
+    for path in snap_paths:
+        resource, ts = path.rstrip('/').rsplit('/snapshots/', 1)
+        restores = plan.setdefault(resource.split('/')[2], {})
+        if restores.get(resource, ts) != ts:
+            raise ValueError("Conflicting snapshots {} and {} for {}".format(
+                restores[resource], ts, resource))
+        restores[resource] = ts
+    return plan
+
+
+def _get_resources(api, plan, workers):
+    """ Fetches every AppInstance and Volume in the plan up front """
+    ais, resources = {}, {}
+
+    def _get_helper(ai_id):
+        ai = api.app_instances.get(ai_id)
+        ais[ai_id] = ai
+        for path in plan[ai_id]:
+            parts = path.strip('/').split('/')
+            if len(parts) == 2:
+                resources[path] = ai
+            else:
+                si = ai.storage_instances.get(parts[3])
+                resources[path] = si.volumes.get(parts[5])
+    p = Parallel([_get_helper] * len(plan),
+                 args_list=[(ai_id,) for ai_id in plan],
+                 max_workers=max(min(workers, len(plan)), 1))
+    p.run_threads()
+    return ais, resources
+
+
+def wait_ready(ais, timeout, workers, interval=0.25):
+    """
+    Polls all AppInstances together until every StorageInstance of each is
+    available.  Returns {ai_id: time it was first seen ready}
+    """
+    pending = dict((ai['id'], ai) for ai in ais)
+    ready_at = {}
+    deadline = time.time() + timeout
+
+    def _ready(ai):
+        ai = fresh(ai)
+        sis = ai.get('storage_instances') or []
+        if all(si['op_state'] == 'available' for si in sis):
+            ready_at[ai['id']] = time.time()
+    while pending:
+        run_bulk(_ready, list(pending.values()), workers)
+        for ai_id in ready_at:
+            pending.pop(ai_id, None)
+        if not pending or time.time() >= deadline:
+            break
+        time.sleep(interval)
+        interval = min(interval * 2, 1)
+    return ready_at
+
+
+def rollback_many(api, snap_paths, workers=10, timeout=300):
+    """
+    Rolls back every resource to its snapshot with a single offline window:
+    all affected AppInstances are taken offline together, the restores run
+    concurrently, everything is brought back online and readiness is polled
+    in one shared loop.  Returns one result per AppInstance including its
+    measured offline window (offline_s).
+    """
+    plan = plan_rollback(snap_paths)
+    if not plan:
+        return []
+    ais, resources = _get_resources(api, plan, workers)
+    offline_at = {}
+    errors = {}
+
+    def _offline(ai):
+        offline_at[ai['id']] = time.time()
+        ai.set(admin_state='offline', force=True)
+
+    def _restore(resource):
+        ts = plan[resource.path.split('/')[2]][resource.path]
+        print("Restoring {} to {}".format(resource.path, ts))
+        resource.set(restore_point=ts)
+
+    def _online(ai):
+        ai.set(admin_state='online')
+
+    def _record(results):
+        for r in results:
+            if not r['ok']:
+                errors.setdefault(r['target'].split('/')[2], r['error'])
+        return [r for r in results if r['ok']]
+
+    offlined = _record(run_bulk(_offline, list(ais.values()), workers))
+    offline_ids = set(r['target'].split('/')[2] for r in offlined)
+    _record(run_bulk(_restore, [res for path, res in resources.items()
+                                if path.split('/')[2] in offline_ids],
+                     workers))
+    # Bring back everything that was taken offline, even if its restore
+    # failed
+    _record(run_bulk(_online, [ais[ai_id] for ai_id in offline_ids],
+                     workers))
+    ready_at = wait_ready([ais[ai_id] for ai_id in offline_ids], timeout,
+                          workers)
+    results = []
+    for ai_id, ai in sorted(ais.items(), key=lambda x: x[1]['name']):
+        error = errors.get(ai_id)
+        if not error and ai_id not in ready_at:
+            error = "Not available after {}s".format(timeout)
+        offline_s = None
+        if ai_id in offline_at:
+            offline_s = round(
+                ready_at.get(ai_id, time.time()) - offline_at[ai_id], 3)
+        dprint("Rollback of {} offline for {}s".format(ai['name'], offline_s))
+        results.append({'target': ai.path,
+                        'name': ai['name'],
+                        'ok': not error,
+                        'error': error,
+                        'restores': len(plan[ai_id]),
+                        'offline_s': offline_s})
+    return results
+
+
+def rollback_remount(api, snap_paths, multipath, workers=10, timeout=300):
+    """
+    rollback_many for resources in use on this host.  The logged in LUNs and
+    mounts of the affected AppInstances are recorded first, only those
+    targets are unmounted and logged out, and after the rollback they are
+    logged back into and remounted in parallel without formatting.
+    Returns (rollback results, mount entries with down_at/up_at)
+    """
+    plan = plan_rollback(snap_paths)
+    ais = [api.app_instances.get(ai_id) for ai_id in plan]
+    entries = record_mounts(ais, multipath)
+    dprint("Recorded {} logged in LUNs".format(len(entries)))
+    try:
+        teardown(entries, multipath, workers)
+        results = rollback_many(api, snap_paths, workers, timeout)
+    finally:
+        # Bring back whatever was taken down, even if the teardown of other
+        # targets or some restores failed
+        bring_up([e for e in entries
+                  if e.get('down_at') or e.get('logged_out')],
+                 multipath, workers)
+    return results, entries
+
+
+def print_downtime(entries):
+    mounts = [e for e in entries if e.get('down_at')]
+    for e in mounts:
+        print("{} down for {}s".format(
+            e['mount'], round(e.get('up_at', time.time()) - e['down_at'], 3)))
+    if mounts:
+        start = min(e['down_at'] for e in mounts)
+        end = max(e.get('up_at', time.time()) for e in mounts)
+        print("Application-visible downtime: {}s".format(
+            round(end - start, 3)))
+
+
+def print_rollback_results(results):
+    for r in results:
+        print("{:6} {} restores: {} offline: {}s {}".format(
+            'OK' if r['ok'] else 'FAILED', r['target'], r['restores'],
+            r['offline_s'], r['error'] or ''))
+    windows = [r['offline_s'] for r in results if r['offline_s'] is not None]
+    failed = len([r for r in results if not r['ok']])
+    print("\nAppInstances: {}, succeeded: {}, failed: {}".format(
+        len(results), len(results) - failed, failed))
+    if windows:
+        print("Offline window min/avg/max: {}/{}/{}s".format(
+            min(windows), round(sum(windows) / len(windows), 3),
+            max(windows)))
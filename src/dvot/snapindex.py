@@ -0,0 +1,79 @@
+"""
+Point-in-time lookups over the Snapshots of a single AppInstance or Volume
+"""
+from __future__ import unicode_literals, print_function, division
+
+import bisect
+import calendar
+import datetime
+
+TIME_FORMATS = ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M', '%Y-%m-%d %H:%M:%S',
+                '%Y-%m-%d %H:%M', '%Y-%m-%d')
+
+
+def parse_time(txt):
+    """ Accepts epoch seconds or a UTC date/time like 2018-03-01T12:00 """
+    try:
+        return float(txt)
+    except ValueError:
+        pass
+    txt = txt.rstrip('Z')
+    for fmt in TIME_FORMATS:
+        try:
+            dt = datetime.datetime.strptime(txt, fmt)
+        except ValueError:
+            continue
+        return calendar.timegm(dt.utctimetuple())
+    raise ValueError("Could not parse time: {}".format(txt))
+
+
+class SnapIndex(object):
+
+    """ Snapshots sorted by utc_ts for O(log n) lookups """
+
+    def __init__(self, snaps):
+        snaps = sorted(snaps, key=lambda snap: float(snap['utc_ts']))
+        self.snaps = snaps
+        self.ts = [float(snap['utc_ts']) for snap in snaps]
+
+    def __len__(self):
+        return len(self.snaps)
+
+    def latest(self):
+        if self.snaps:
+            return self.snaps[-1]
+
+    def before(self, t):
+        """ Newest snapshot taken at or before t """
+        i = bisect.bisect_right(self.ts, t)
+        if i:
+            return self.snaps[i - 1]
+
+    def after(self, t):
+        """ Oldest snapshot taken at or after t """
+        i = bisect.bisect_left(self.ts, t)
+        if i < len(self.snaps):
+            return self.snaps[i]
+
+    def between(self, start, end):
+        """ Snapshots taken in [start, end], oldest first """
+        lo = bisect.bisect_left(self.ts, start) if start is not None else 0
+        hi = (bisect.bisect_right(self.ts, end) if end is not None
+              else len(self.ts))
+        return self.snaps[lo:hi]
+
+    def select(self, before=None, after=None, latest=False):
+        """
+        Picks one snapshot: the newest one in the [after, before] window when
+        both bounds are given, otherwise the newest at/before `before`, the
+        oldest at/after `after` or the latest one
+        """
+        if before is not None and after is not None:
+            snaps = self.between(after, before)
+            return snaps[-1] if snaps else None
+        if before is not None:
+            return self.before(before)
+        if after is not None:
+            return self.after(after)
+        if latest:
+            return self.latest()
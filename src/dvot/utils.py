@@ -1,7 +1,9 @@
 from __future__ import (unicode_literals, print_function, absolute_import,
                         division)
 
+import json
 import logging
+import math
 # Py2-3 compatibility
 try:
     import queue
@@ -13,17 +15,24 @@ import string
 import subprocess
 import sys
 import threading
+import time
 from time import sleep
 
-from six import reraise as raise_
-from six.moves import zip_longest
+from six import reraise as raise_, string_types
+from six.moves import range, zip_longest
 from dfs_sdk import scaffold
 
+from dvot.privhelper import execute
+
 DVOT_REPO = 'http://github.com/Datera/dvot'
 ASSETS = os.path.join(
         os.path.dirname(
             os.path.dirname(os.path.abspath(__file__))), 'assets')
 LOCKS = {}
+SUDO = ('sudo',)
+PRIV_HELPER = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           'privhelper.py')
+_PRIV_HELPER = None
 
 
 class Parallel(object):
@@ -74,9 +83,10 @@ class Parallel(object):
                 func, args, kwargs = self.queue.get(block=False)
             except queue.Empty:
                 break
+            # Lazy formatting, args can be large shared result lists
             self.logger.debug(
-                "Running {} with args: {} and kwargs {} with thread {}".format(
-                    func, args, kwargs, threading.current_thread()))
+                "Running %s with args: %s and kwargs %s with thread %s",
+                func, args, kwargs, threading.current_thread())
             try:
                 # Rename this thread to reflect the function we're running
                 orig_name = threading.current_thread().name
@@ -103,12 +113,12 @@ class Parallel(object):
                     self.funcs, self.args_list, self.kwargs_list,
                     fillvalue={}):
                 # Flag a common (and confusing) user error:
-                if isinstance(args, str) or isinstance(args, unicode):
+                if isinstance(args, string_types):
                     msg = "args_list must be list of lists not list of strings"
                     raise ValueError(msg)
                 self.queue.put((func, args, kwargs))
 
-            for _ in xrange(self.max_workers):
+            for _ in range(self.max_workers):
                 thread = threading.Thread(target=self._wrapped)
                 thread.setDaemon(True)
                 thread.start()
@@ -131,7 +141,11 @@ class Parallel(object):
                     raise_(*exc)
                 except queue.Empty:
                     pass
-                sleep(0.2)
+                # Wake up as soon as the last task is done instead of
+                # sleeping a fixed interval
+                with self.queue.all_tasks_done:
+                    if self.queue.unfinished_tasks:
+                        self.queue.all_tasks_done.wait(0.2)
 
         # Ensure all threads will exit regardless of the current
         # state of the main thread
@@ -149,18 +163,194 @@ class Parallel(object):
                 pass
 
 
-def exe(cmd, fail_ok=False):
-    cmd = '{{ {}; }} 2>/dev/null'.format(cmd)
-    dprint("Running command:", cmd)
-    try:
-        # Redirect stderr
-        return subprocess.check_output(cmd, shell=True)
-    except subprocess.CalledProcessError as e:
+class CmdResult(object):
+
+    def __init__(self, argv, returncode, stdout, stderr, timed_out=False):
+        self.argv = argv
+        self.returncode = returncode
+        self.stdout = stdout
+        self.stderr = stderr
+        self.timed_out = timed_out
+
+    @property
+    def ok(self):
+        return self.returncode == 0 and not self.timed_out
+
+    def __repr__(self):
+        return "<CmdResult {} rc={}{}>".format(
+            " ".join(self.argv), self.returncode,
+            " timed out" if self.timed_out else "")
+
+
+class CmdError(EnvironmentError):
+
+    def __init__(self, result):
+        self.result = result
+        self.argv = result.argv
+        self.returncode = result.returncode
+        self.stderr = result.stderr
+        self.timed_out = result.timed_out
+        if result.timed_out:
+            reason = "timed out"
+        else:
+            reason = "exit status {}".format(result.returncode)
+        super(CmdError, self).__init__(
+            "Encountered error running command: {}, {}, stderr: {}".format(
+                " ".join(result.argv), reason, result.stderr.strip()))
+
+
+class PrivHelper(object):
+
+    """
+    A single long-lived root process (see dvot.privhelper) that runs
+    privileged commands on our behalf, so sudo authentication is only paid
+    once per dvot run instead of once per command.  Safe to share between
+    threads, commands are executed concurrently by the helper.
+    """
+
+    def __init__(self, sudo_cmd=None):
+        cmd = list(sudo_cmd or SUDO) + [sys.executable, PRIV_HELPER]
+        dprint("Starting privileged helper:", " ".join(cmd))
+        self.proc = subprocess.Popen(cmd,
+                                     stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE,
+                                     bufsize=0)
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.next_id = 0
+        self.reader = threading.Thread(target=self._read_responses)
+        self.reader.daemon = True
+        self.reader.start()
+
+    def _read_responses(self):
+        for line in iter(self.proc.stdout.readline, b''):
+            resp = json.loads(line.decode('utf-8'))
+            with self.lock:
+                waiter = self.pending.pop(resp['id'], None)
+            if waiter:
+                waiter[1].append(resp)
+                waiter[0].set()
+        # Helper exited, wake up anyone still waiting
+        with self.lock:
+            waiters, self.pending = list(self.pending.values()), {}
+        for event, _ in waiters:
+            event.set()
+
+    def call(self, argv, timeout=None, input=None):
+        event, box = threading.Event(), []
+        with self.lock:
+            self.next_id += 1
+            rid = self.next_id
+            self.pending[rid] = (event, box)
+            req = json.dumps({'id': rid,
+                              'argv': argv,
+                              'timeout': timeout,
+                              'input': input})
+            try:
+                self.proc.stdin.write(req.encode('utf-8') + b'\n')
+                self.proc.stdin.flush()
+            except (IOError, OSError) as e:
+                self.pending.pop(rid, None)
+                raise EnvironmentError(
+                    "Privileged helper is not running: {}".format(e))
+        event.wait()
+        if not box:
+            raise EnvironmentError(
+                "Privileged helper exited while running: {}".format(
+                    " ".join(argv)))
+        resp = box[0]
+        return resp['rc'], resp['out'], resp['err'], resp['timed_out']
+
+    def close(self):
+        try:
+            self.proc.stdin.close()
+        except (IOError, OSError):
+            pass
+        self.proc.wait()
+
+
+def start_priv_helper(sudo_cmd=None):
+    global _PRIV_HELPER
+    if _PRIV_HELPER is None and os.geteuid() != 0:
+        _PRIV_HELPER = PrivHelper(sudo_cmd)
+    return _PRIV_HELPER
+
+
+def stop_priv_helper():
+    global _PRIV_HELPER
+    if _PRIV_HELPER is not None:
+        _PRIV_HELPER.close()
+        _PRIV_HELPER = None
+
+
+def run(argv, sudo=False, timeout=None, fail_ok=False, input=None):
+    """
+    Runs a command given as an argv list without a shell.
+
+    :param sudo: Run the command as root, either through the privileged
+                 helper (if started) or by prefixing it with sudo
+    :param timeout: Seconds after which the command is killed
+    :param fail_ok: Return the CmdResult instead of raising CmdError when the
+                    command fails or times out
+    :param input: Text to write to the command's stdin
+    """
+    argv = [str(arg) for arg in argv]
+    dprint("Running command:", " ".join(argv))
+    if sudo and _PRIV_HELPER is not None:
+        rc, out, err, timed_out = _PRIV_HELPER.call(
+            argv, timeout=timeout, input=input)
+    else:
+        full = argv
+        if sudo and os.geteuid() != 0:
+            full = list(SUDO) + argv
+        rc, out, err, timed_out = execute(full, timeout=timeout, input=input)
+    result = CmdResult(argv, rc, out, err, timed_out)
+    if not result.ok:
         if fail_ok:
-            dprint(e)
-            return None
-        raise EnvironmentError(
-            "Encountered error running command: {}, error : {}".format(cmd, e))
+            dprint(result, err.strip())
+            return result
+        raise CmdError(result)
+    return result
+
+
+class RateLimiter(object):
+
+    """
+    Token bucket shared between threads.  acquire() blocks until the caller
+    is allowed to issue one more operation, keeping the overall rate at or
+    below `rate` operations per second.  A rate of 0 disables limiting.
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = max(burst, 1)
+        self.tokens = float(self.burst)
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if not self.rate:
+            return
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.burst,
+                                  self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            sleep(wait)
+
+
+def percentile(values, pct):
+    """ Nearest-rank percentile of values, None if there are none """
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = int(math.ceil(pct / 100.0 * len(ordered))) - 1
+    return ordered[min(max(rank, 0), len(ordered) - 1)]
 
 
 def rand_file_name(directory):
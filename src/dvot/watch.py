@@ -0,0 +1,233 @@
+"""
+Watching AppInstances, StorageInstances, Volumes and Snapshots for state
+changes
+
+One AppInstance read returns its StorageInstances, Volumes and Volume
+Snapshots with their op_state embedded, so a round costs one request per
+watched AppInstance (or one listing for the whole tenant).  AppInstance
+Snapshots are embedded by path only and are read once when they appear and
+then only while they are not available.
+
+Full rounds read every watched AppInstance.  While something is in flight
+(op_state neither available nor degraded, not counting the StorageInstances
+and Volumes of offline AppInstances) the rounds in between only re-read the
+AppInstances holding it, every `min_interval` seconds.  Once nothing changes
+and nothing is in flight the interval doubles up to `max_interval`.  The
+Datera API has no change feed or conditional GETs, so this is as close to
+fetching only the changed objects as polling gets.
+"""
+from __future__ import unicode_literals, print_function, division
+
+import threading
+import time
+
+from dfs_sdk import exceptions as dexceptions
+
+from dvot.apicache import uncached
+from dvot.utils import Parallel, dprint
+
+# Watching more AppInstances than this lists the whole tenant instead of
+# reading each one
+LIST_THRESHOLD = 20
+SETTLED = 'available'
+# op_states that don't change without somebody acting on the object
+RESTING = (SETTLED, 'degraded')
+
+
+def _parent(path):
+    return '/'.join(path.split('/')[:3])
+
+
+class Watcher(object):
+
+    def __init__(self, api, ai_ids=None, on_event=None, min_interval=1,
+                 max_interval=30, workers=10):
+        self.api = api
+        self.conn = api.context.connection
+        self.ai_paths = None
+        if ai_ids is not None:
+            self.ai_paths = set('/app_instances/{}'.format(ai_id)
+                                for ai_id in ai_ids)
+        self.on_event = on_event
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.workers = workers
+        # path: {'kind', 'name', 'state', 'ai'}
+        self.states = None
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def pending(self):
+        """
+        Paths of the watched objects still in flight.  The StorageInstances
+        and Volumes of an offline AppInstance stay unavailable until it is
+        brought online, so they are not waited for
+        """
+        states = self.states or {}
+        offline = set(path for path, obj in states.items()
+                      if obj['kind'] == 'app_instance' and
+                      obj['state'] == 'offline')
+        return sorted(path for path, obj in states.items()
+                      if obj['kind'] != 'app_instance' and
+                      obj['state'] not in RESTING and
+                      not (obj['kind'] in ('storage_instance', 'volume') and
+                           obj['ai'] in offline))
+
+    def _count(self):
+        # Called from the Parallel workers
+        with self.lock:
+            self.requests += 1
+
+    def _read(self, path):
+        self._count()
+        # uncached() is per thread, so it is entered in every worker
+        try:
+            with uncached():
+                return self.conn.read_entity(path)
+        except dexceptions.ApiNotFoundError:
+            return None
+
+    def _read_ais(self, paths):
+        """ Raw AppInstances at paths, or the whole tenant when None """
+        if paths is None or len(paths) > LIST_THRESHOLD:
+            self._count()
+            with uncached():
+                ais = [dict(ai) for ai in self.api.app_instances.list()]
+            if paths is None:
+                return ais, None
+            return [ai for ai in ais if ai['path'] in paths], set(paths)
+        found = []
+
+        def _read_helper(path):
+            ai = self._read(path)
+            if ai:
+                found.append(ai)
+        paths = sorted(paths)
+        if paths:
+            p = Parallel([_read_helper] * len(paths),
+                         args_list=[(path,) for path in paths],
+                         max_workers=max(min(self.workers, len(paths)), 1))
+            p.run_threads()
+        return found, set(paths)
+
+    def _scan(self, ai, seen):
+        def _add(obj, kind, state):
+            seen[obj['path']] = {'kind': kind,
+                                 'name': obj.get('name') or
+                                 obj.get('utc_ts'),
+                                 'state': state,
+                                 'ai': ai['path']}
+        _add(ai, 'app_instance', ai.get('admin_state'))
+        for snap in ai.get('snapshots') or []:
+            _add(snap, 'snapshot', snap.get('op_state'))
+        for si in ai.get('storage_instances') or []:
+            _add(si, 'storage_instance', si.get('op_state'))
+            for vol in si.get('volumes') or []:
+                _add(vol, 'volume', vol.get('op_state'))
+                for snap in vol.get('snapshots') or []:
+                    _add(snap, 'snapshot', snap.get('op_state'))
+
+    def _resolve_snaps(self, seen):
+        """ Reads the Snapshots that were only embedded by path """
+        unknown = []
+        for path, obj in seen.items():
+            if obj['state'] is not None:
+                continue
+            known = (self.states or {}).get(path)
+            if known and known['state'] == SETTLED:
+                obj['state'] = SETTLED
+            else:
+                unknown.append(path)
+
+        def _snap_helper(path):
+            snap = self._read(path)
+            if snap:
+                seen[path]['state'] = snap.get('op_state')
+                seen[path]['name'] = snap.get('utc_ts')
+        if unknown:
+            p = Parallel([_snap_helper] * len(unknown),
+                         args_list=[(path,) for path in unknown],
+                         max_workers=max(min(self.workers, len(unknown)), 1))
+            p.run_threads()
+
+    def _event(self, path, obj, previous):
+        if obj is None:
+            kind, state = previous['kind'], 'removed'
+            name = previous['name']
+        else:
+            kind, state, name = obj['kind'], obj['state'], obj['name']
+        event = {'time': round(time.time(), 3),
+                 'event': '{} {}'.format(kind, state),
+                 'kind': kind,
+                 'path': path,
+                 'name': name,
+                 'state': state,
+                 'previous': previous['state'] if previous else None}
+        if self.on_event:
+            self.on_event(event)
+        return event
+
+    def poll(self, full=True):
+        """
+        Reads the watched AppInstances (only those with objects in flight
+        unless full) and returns the state change events since the last
+        poll.  The first poll only records the current states
+        """
+        paths = self.ai_paths
+        if not full:
+            paths = set(_parent(path) for path in self.pending())
+        ais, scanned = self._read_ais(paths)
+        seen = {}
+        for ai in ais:
+            self._scan(ai, seen)
+        self._resolve_snaps(seen)
+        if self.states is None:
+            self.states = seen
+            return []
+        events = []
+        for path, obj in sorted(seen.items()):
+            previous = self.states.get(path)
+            if not previous or previous['state'] != obj['state']:
+                events.append(self._event(path, obj, previous))
+        for path, previous in sorted(self.states.items()):
+            if path in seen:
+                continue
+            if scanned is None or previous['ai'] in scanned:
+                events.append(self._event(path, None, previous))
+                del self.states[path]
+        self.states.update(seen)
+        return events
+
+    def run(self, settle=False, timeout=None):
+        """
+        Polls until interrupted, or with settle until nothing watched is in
+        flight.  Returns False if timeout seconds passed first
+        """
+        deadline = time.time() + timeout if timeout else None
+        interval = self.min_interval
+        next_full = 0
+        while True:
+            now = time.time()
+            full = self.states is None or now >= next_full
+            if full:
+                next_full = now + self.max_interval
+            events = self.poll(full)
+            pending = self.pending()
+            dprint("Watch round: full {} events {} in flight {} "
+                   "requests {}".format(full, len(events), len(pending),
+                                        self.requests))
+            if settle and not pending:
+                return True
+            if deadline and time.time() >= deadline:
+                return False
+            if events or pending:
+                interval = self.min_interval
+            else:
+                interval = min(interval * 2, self.max_interval)
+            time.sleep(interval)
+
+
+def print_event(event):
+    print("{} {} {} {} -> {}".format(
+        time.strftime('%H:%M:%S', time.localtime(event['time'])),
+        event['event'], event['path'], event['previous'], event['state']))
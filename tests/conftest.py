@@ -0,0 +1,139 @@
+"""
+Fixtures for the dvot tests.  They run against benchmarks/fake_api.py and
+benchmarks/fake_host.py, no Datera cluster or iSCSI host is needed.
+
+Every test also times what it checks.  The timings can be saved as a
+baseline and later runs compared against it, the same JSON that
+benchmarks/perf.py reads and writes
+
+    python -m pytest --perf-save perf-baseline.json
+    python -m pytest --perf-baseline perf-baseline.json --perf-threshold 20
+
+The 1000 AppInstance finds take minutes and are marked slow, they only run
+with --slow.
+"""
+from __future__ import unicode_literals, print_function, division
+
+import os
+import sys
+
+import pytest
+
+BENCHMARKS = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks')
+if BENCHMARKS not in sys.path:
+    sys.path.insert(0, BENCHMARKS)
+
+from common import FakeApi  # noqa
+from fake_host import FakeHost  # noqa
+import perf as perf_cases  # noqa
+
+API_SCALES = (100, pytest.param(1000, marks=pytest.mark.slow))
+HOST_SCALES = (10, 100, 1000)
+
+
+def pytest_addoption(parser):
+    parser.addoption('--slow', action='store_true',
+                     help='Also run the tests marked slow')
+    group = parser.getgroup('dvot-perf')
+    group.addoption('--perf-baseline',
+                    help='Fail tests that got slower than this baseline')
+    group.addoption('--perf-save',
+                    help='Write the timings of this run as a baseline')
+    group.addoption('--perf-threshold', type=float, default=20.0,
+                    help='Percent slowdown that counts as a regression')
+    group.addoption('--perf-noise-ms', type=float, default=0.1,
+                    help='Ignore latency changes smaller than this')
+    group.addoption('--perf-repeat', type=int, default=5,
+                    help='Timed samples per test')
+
+
+class Perf(object):
+
+    """
+    Times a case with perf.sample, fails it on a wrong result and, with
+    --perf-baseline, when it regressed past --perf-threshold
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.rows = []
+        path = config.getoption('perf_baseline')
+        self.baseline = perf_cases.load(path) if path else None
+
+    def __call__(self, case, func, check, **kwargs):
+        kwargs.setdefault('repeat', self.config.getoption('perf_repeat'))
+        row = perf_cases.sample(func, check, **kwargs)
+        row['case'] = case
+        self.rows.append(row)
+        assert row['ok'], "{} returned a wrong result".format(case)
+        if self.baseline:
+            perf_cases.compare([row], self.baseline,
+                               self.config.getoption('perf_threshold'),
+                               self.config.getoption('perf_noise_ms'))
+            if row['status'] == 'REGRESSED':
+                pytest.fail("{case} regressed: p50 {p50_ms}ms p95 {p95_ms}ms"
+                            ", baseline p95 {base_p95_ms}ms".format(**row))
+        return row
+
+    def save(self):
+        path = self.config.getoption('perf_save')
+        if path and self.rows:
+            perf_cases.save(path, self.rows,
+                            self.config.getoption('perf_repeat'))
+
+
+def pytest_configure(config):
+    config.addinivalue_line('markers', 'slow: only runs with --slow')
+    config.dvot_perf = Perf(config)
+
+
+def pytest_collection_modifyitems(config, items):
+    if config.getoption('slow'):
+        return
+    skip = pytest.mark.skip(reason='needs --slow')
+    for item in items:
+        if 'slow' in item.keywords:
+            item.add_marker(skip)
+
+
+def pytest_sessionfinish(session):
+    perf = getattr(session.config, 'dvot_perf', None)
+    if perf:
+        perf.save()
+
+
+@pytest.fixture
+def perf(request):
+    return request.config.dvot_perf
+
+
+@pytest.fixture(scope='session', params=API_SCALES,
+                ids=lambda scale: 'ais={}'.format(scale))
+def fake_api(request):
+    """ A fake API with request.param AppInstances of one volume each """
+    with FakeApi(ais=request.param, vols=1, snaps=1) as fake:
+        yield fake
+
+
+@pytest.fixture
+def api(fake_api):
+    fake_api.reset()
+    return fake_api.api()
+
+
+@pytest.fixture(params=HOST_SCALES, ids=lambda scale: 'maps={}'.format(scale))
+def fake_host(request):
+    """
+    A fake host plugged in with set_host, with request.param multipath
+    targets logged in over perf.PORTALS
+    """
+    from dvot.host import set_host
+    with FakeHost(luns=1, arrival_delay=0) as host:
+        for iqn in perf_cases.target_iqns(request.param):
+            perf_cases.login_target(host, iqn)
+        set_host(host)
+        try:
+            yield host
+        finally:
+            set_host(None)
@@ -0,0 +1,23 @@
+from __future__ import unicode_literals, print_function, division
+
+import perf as perf_cases
+import pytest
+
+from dvot import main as dvot
+
+
+@pytest.mark.parametrize('name, build', perf_cases.FIND_CASES,
+                         ids=[name for name, _ in perf_cases.FIND_CASES])
+def test_find(name, build, fake_api, api, perf):
+    func, check, kwargs = build(api, fake_api.targets())
+    perf('{}/ais={}'.format(name, fake_api.opts['ais']), func, check,
+         **kwargs)
+
+
+def test_find_vol_missing(api):
+    assert not dvot.find_vol(api, None, 'no-such-uuid')
+
+
+def test_find_vol_needs_name_or_id(api):
+    with pytest.raises(ValueError):
+        dvot.find_vol(api, None, None)
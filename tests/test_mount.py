@@ -0,0 +1,13 @@
+from __future__ import unicode_literals, print_function, division
+
+import perf as perf_cases
+import pytest
+
+
+@pytest.mark.parametrize('name, build', perf_cases.HOST_CASES,
+                         ids=[name for name, _ in perf_cases.HOST_CASES])
+def test_host(name, build, fake_host, perf):
+    # Every target has a single LUN, so each map is one logged in target
+    count = len(fake_host.maps)
+    func, check, kwargs = build(fake_host, perf_cases.target_iqns(count))
+    perf('{}/maps={}'.format(name, count), func, check, **kwargs)
@@ -0,0 +1,10 @@
+from __future__ import unicode_literals, print_function, division
+
+import perf as perf_cases
+import pytest
+
+
+@pytest.mark.parametrize('tasks', (100, 1000, 10000))
+def test_parallel(tasks, perf):
+    func, check, kwargs = perf_cases.parallel_case(tasks)
+    perf('Parallel/tasks={}'.format(tasks), func, check, **kwargs)